@@ -0,0 +1,32 @@
+import logging
+from ckan.plugins import toolkit
+from ckanext.superset.config import get_config
+from ckanext.superset.data.columns import resolve_columns
+from ckanext.superset.data.main import SupersetCKAN
+
+
+log = logging.getLogger(__name__)
+
+
+@toolkit.side_effect_free
+def superset_chart_list(context, data_dict):
+    """ List all the charts from Superset
+
+    :param columns: the chart fields to get, a list or a preset name
+        (see ckanext/superset/data/columns.py). All the fields if missing.
+    """
+
+    toolkit.check_access('superset_chart_list', context, data_dict)
+
+    try:
+        columns = resolve_columns('chart', data_dict.get('columns'))
+    except ValueError as e:
+        raise toolkit.ValidationError({'columns': [str(e)]})
+    cfg = get_config()
+    sc = SupersetCKAN(**cfg)
+    sc.load_charts(columns=columns)
+    return {
+        'count': len(sc.charts),
+        'columns': columns,
+        'result': [chart.data for chart in sc.charts],
+    }
@@ -1,6 +1,7 @@
 import logging
 from ckan.plugins import toolkit
 from ckanext.superset.config import get_config
+from ckanext.superset.data.columns import resolve_columns
 from ckanext.superset.data.main import SupersetCKAN
 
 
@@ -9,12 +10,20 @@ log = logging.getLogger(__name__)
 
 @toolkit.side_effect_free
 def superset_dataset_list(context, data_dict):
-    """ get the /api/v1/dataset list from Superset """
+    """ get the /api/v1/dataset list from Superset
+
+    :param columns: the dataset fields to get, a list or a preset name
+        (see ckanext/superset/data/columns.py). All the fields if missing.
+    """
 
     toolkit.check_access('superset_dataset_list', context, data_dict)
 
+    try:
+        columns = resolve_columns('dataset', data_dict.get('columns'))
+    except ValueError as e:
+        raise toolkit.ValidationError({'columns': [str(e)]})
     # Get the configuration values
     cfg = get_config()
     sc = SupersetCKAN(**cfg)
-    sc.load_datasets()
+    sc.load_datasets(columns=columns)
     return sc.datasets_response
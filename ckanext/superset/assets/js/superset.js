@@ -1,49 +1,91 @@
 $(document).ready(function() {
     // Toggle info row
-    $('.superset-toggle-info').on('click', function(e) {
+    $('#superset-charts-table').on('click', '.superset-toggle-info', function(e) {
         e.preventDefault();
         var chartId = $(this).data('chart-id');
         $('#chart-info-' + chartId).toggle();
         $(this).find('i').toggleClass('fa-plus-circle fa-minus-circle');
     });
 
-    // Filters
-    var $vizFilter = $('#superset-viz-filter');
-    var $ckanFilter = $('#superset-ckan-filter');
-    var $table = $('#superset-charts-table');
+    // Thumbnails Superset is still computing get a placeholder: ask until they are ready
+    function watchThumbnail(img) {
+        var statusUrl = $(img).data('status-url');
+        var attempts = 0;
+        var pending = false;
+        $(img).removeAttr('data-status-url');
 
-    function filterCharts() {
-        var selectedTypes = $vizFilter.val() || [];
-        var ckanVal = $ckanFilter.val();
+        function check() {
+            $.getJSON(statusUrl).done(function(data) {
+                if (data.status === 'pending' && ++attempts < 40) {
+                    pending = true;
+                    setTimeout(check, 3000);
+                } else if (data.status === 'ready' && pending) {
+                    // The placeholder is not cached, but the same URL is not reloaded
+                    img.src = img.src + '&ready=' + Date.now();
+                }
+            });
+        }
+        // Lazy images are requested (and the fetch enqueued) when they get visible
+        if (img.complete) {
+            check();
+        } else {
+            $(img).one('load', check);
+        }
+    }
 
-        $table.find('tr[data-viz-type]').each(function() {
-            var vizType = $(this).data('viz-type');
-            var hasCkan = $(this).attr('data-has-ckan') === 'true';
+    function watchThumbnails($root) {
+        $root.find('img[data-status-url]').each(function() {
+            watchThumbnail(this);
+        });
+    }
 
-            // Skip info rows — they stay hidden until toggled
-            if (this.id && this.id.indexOf('chart-info-') === 0) {
-                return;
-            }
+    var $table = $('#superset-charts-table');
+    watchThumbnails($table);
+
+    // Load the next charts (see superset_blueprint.charts_json) while scrolling
+    var $loading = $('#superset-charts-loading');
+    var nextUrl = $table.data('next-url');
+    var loading = false;
 
-            var matchType = selectedTypes.length === 0 || selectedTypes.indexOf(vizType) !== -1;
-            var matchCkan = ckanVal === 'all' || (ckanVal === 'with' && hasCkan) || (ckanVal === 'without' && !hasCkan);
+    if (!nextUrl || !('IntersectionObserver' in window)) {
+        return;
+    }
+    // The pager is the fallback without JavaScript
+    $('#superset-charts-pager').hide();
+    $loading.show();
 
-            if (matchType && matchCkan) {
-                $(this).show();
+    function loadMore() {
+        if (loading || !nextUrl) {
+            return;
+        }
+        loading = true;
+        $.getJSON(nextUrl).done(function(data) {
+            var $rows = $($.parseHTML(data.html));
+            $table.find('tbody').append($rows);
+            watchThumbnails($rows);
+            nextUrl = data.next_url;
+            if (!nextUrl) {
+                observer.disconnect();
+                $loading.hide();
             } else {
-                $(this).hide();
-                // Also hide the info row if the main row is hidden
-                var chartId = $(this).find('.superset-toggle-info').data('chart-id');
-                if (chartId) {
-                    $('#chart-info-' + chartId).hide();
-                }
+                // Observe again: loads more if the new rows do not fill the screen
+                observer.unobserve($loading[0]);
+                observer.observe($loading[0]);
             }
+        }).fail(function() {
+            // Give up, the pager still works
+            observer.disconnect();
+            $loading.hide();
+            $('#superset-charts-pager').show();
+        }).always(function() {
+            loading = false;
         });
     }
 
-    $vizFilter.on('change', filterCharts);
-    $ckanFilter.on('change', filterCharts);
-
-    // Apply default filter on load
-    filterCharts();
-});
\ No newline at end of file
+    var observer = new IntersectionObserver(function(entries) {
+        if (entries[0].isIntersecting) {
+            loadMore();
+        }
+    }, {rootMargin: '400px'});
+    observer.observe($loading[0]);
+});
@@ -1,29 +1,170 @@
 import logging
+import os
 from flask import Blueprint
-from flask import send_file
+from flask import Response, jsonify, send_file
+from ckan.common import request
 
 from ckanext.superset.config import get_config
 from ckanext.superset.decorators import require_sysadmin_user
 from ckanext.superset.data.main import SupersetCKAN
 from ckanext.superset.data.chart import SupersetChart
+from ckanext.superset.data.thumbnails import (
+    VALID_DIGEST_RE, VARIANT_FORMATS, VARIANT_WIDTHS, get_cache, get_cached_digest,
+)
+from ckanext.superset.data import thumbnail_jobs
+from ckanext.superset.exceptions import SupersetPendingException, SupersetRequestException
 
 
 log = logging.getLogger(__name__)
 superset_images_bp = Blueprint('superset_images', __name__, url_prefix='/superset-images')
 
+# A URL with the digest (?d=) always points to the same image
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# Without it, the browser must check again soon
+MUTABLE_MAX_AGE = 5 * 60
+# Served while Superset computes a thumbnail
+PLACEHOLDER = os.path.join(
+    os.path.dirname(__file__), '..', 'public', 'base', 'images', 'superset-thumbnail-pending.svg'
+)
 
-@superset_images_bp.route('/chart/<int:chart_id>', methods=['GET'])
-@require_sysadmin_user
-def chart_image(chart_id):
-    """ Expose a supersrt chart thumbnail as an image """
 
+def _send_placeholder():
+    response = send_file(PLACEHOLDER, mimetype='image/svg+xml', etag=False)
+    # The browser must ask again, the real image will be there soon
+    response.cache_control.no_store = True
+    response.headers['X-Superset-Thumbnail'] = thumbnail_jobs.STATUS_PENDING
+    return response
+
+
+def _etag(chart_id, digest, variant=None):
+    etag = f'{chart_id}-{digest}'
+    if variant:
+        etag += '-w{}.{}'.format(*variant)
+    return etag
+
+
+def _send_thumbnail(path, etag, immutable, mimetype='image/png'):
+    response = send_file(
+        path,
+        mimetype=mimetype,
+        etag=etag,
+        conditional=True,
+        max_age=IMMUTABLE_MAX_AGE if immutable else MUTABLE_MAX_AGE,
+    )
+    # Only sysadmins can see them: keep them out of shared caches
+    response.cache_control.private = True
+    response.cache_control.public = False
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+
+def _send_variant(cache, chart_id, digest, variant, immutable):
+    """ Send a (generated on demand) thumbnail variant, None if not possible """
+    path = cache.get_variant(chart_id, digest, *variant)
+    if not path:
+        return None
+    mimetype = VARIANT_FORMATS[variant[1]][1]
+    return _send_thumbnail(path, _etag(chart_id, digest, variant), immutable, mimetype)
+
+
+def _get_variant_args():
+    """ The requested (width, format) variant, None for the original image.
+        Raises ValueError for sizes or formats we do not generate
+    """
+    width = request.args.get('w')
+    fmt = request.args.get('f')
+    if not width and not fmt:
+        return None
+    width = int(width) if width else max(VARIANT_WIDTHS)
+    fmt = fmt or 'webp'
+    if width not in VARIANT_WIDTHS or fmt not in VARIANT_FORMATS:
+        raise ValueError("Unsupported thumbnail variant")
+    return width, fmt
+
+
+def _fetch_original(cache, chart_id):
+    """ Get the current thumbnail of a chart from Superset into the cache.
+        Returns its path and digest, or (None, None, response) with the
+        error or placeholder response to send instead
+    """
     cfg = get_config()
     sc = SupersetCKAN(**cfg)
     chart = SupersetChart(superset_instance=sc)
-    chart.get_from_superset(chart_id)
-    thumbnail = chart.get_thumbnail()
+    try:
+        chart.get_from_superset(chart_id)
+    except SupersetRequestException:
+        return None, None, (f"Chart {chart_id} not found", 404)
+    digest = chart.thumbnail_digest
+    if not digest:
+        return None, None, (f"Thumbnail not found for chart {chart_id}", 404)
+    path = cache.get(chart_id, digest)
+    if path:
+        return path, digest, None
+    try:
+        thumbnail = chart.get_thumbnail(raise_pending=True)
+    except SupersetPendingException:
+        # Do not wait for Superset here, a background job will
+        thumbnail_jobs.enqueue_fetch(chart_id, digest)
+        return None, None, _send_placeholder()
     if not thumbnail:
-        return f"Thumbnail not found for chart {chart_id}", 404
+        return None, None, (f"Thumbnail not found for chart {chart_id}", 404)
+    return cache.put(chart_id, digest, thumbnail), digest, None
+
+
+@superset_images_bp.route('/chart/<int:chart_id>', methods=['GET'])
+@require_sysadmin_user
+def chart_image(chart_id):
+    """ Expose a superset chart thumbnail as an image.
+        `d` is the thumbnail digest (see SupersetChart.thumbnail_digest), the
+        image is then served from the local cache without asking Superset.
+        `w` (width) and `f` (webp, jpeg or png) ask for a smaller variant
+        (requires Pillow, the original is served without it)
+    """
+    requested_digest = request.args.get('d')
+    if requested_digest and not VALID_DIGEST_RE.match(requested_digest):
+        return "Invalid thumbnail digest", 400
+    try:
+        variant = _get_variant_args()
+    except ValueError as e:
+        return str(e), 400
 
-    # drop the image content to be used externally
-    return send_file(thumbnail, mimetype='image/png')
+    # Answer the browser revalidation without touching the disk
+    if requested_digest and _etag(chart_id, requested_digest, variant) in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(_etag(chart_id, requested_digest, variant))
+        response.cache_control.private = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        return response
+
+    cache = get_cache()
+    digest = requested_digest or get_cached_digest(chart_id)
+    if variant and digest:
+        # The variant may still be cached after the original was evicted
+        response = _send_variant(cache, chart_id, digest, variant, digest == requested_digest)
+        if response:
+            return response
+    path = cache.get(chart_id, digest) if digest else None
+    if not path:
+        path, digest, response = _fetch_original(cache, chart_id)
+        if response is not None:
+            return response
+
+    immutable = digest == requested_digest
+    if variant:
+        response = _send_variant(cache, chart_id, digest, variant, immutable)
+        if response:
+            return response
+    return _send_thumbnail(path, _etag(chart_id, digest), immutable)
+
+
+@superset_images_bp.route('/chart/<int:chart_id>/status', methods=['GET'])
+@require_sysadmin_user
+def chart_image_status(chart_id):
+    """ Is the thumbnail (digest `d`) ready? See data/thumbnail_jobs.py """
+    digest = request.args.get('d')
+    if not digest or not VALID_DIGEST_RE.match(digest):
+        return jsonify({'success': False, 'error': 'Invalid thumbnail digest'}), 400
+    status = thumbnail_jobs.get_status(chart_id, digest)
+    return jsonify({'success': True, 'status': status})
@@ -1,14 +1,17 @@
 import logging
-import tempfile
-from flask import Blueprint
-from werkzeug.datastructures import FileStorage
+from flask import Blueprint, jsonify
 from ckan import model
 from ckan.common import current_user, request
 from ckan.plugins import toolkit as tk
 
 from ckanext.superset.config import get_config
 from ckanext.superset.decorators import require_sysadmin_user
+from ckanext.superset.data import chart_list
+from ckanext.superset.data.columns import resolve_columns
+from ckanext.superset.data.downloads import download_chart
+from ckanext.superset.data.links import get_package_by_chart_id
 from ckanext.superset.data.main import SupersetCKAN
+from ckanext.superset.data.thumbnails import uncached_chart_ids
 from ckanext.superset.data import sync as sync_module
 from ckanext.superset.exceptions import SupersetRequestException
 from ckanext.superset.utils import slug
@@ -25,18 +28,107 @@ def index():
     superset_url = tk.config.get('ckanext.superset.instance.url')
     cfg = get_config()
     sc = SupersetCKAN(**cfg)
-    sc.load_charts()
-    charts_count = sc.charts_response.get('count', 'ERROR')
-    charts = sc.charts
+    # Only the requested page of charts is read from Superset
+    params = chart_list.parse_args(request.args)
+    page_size = chart_list.get_index_page_size()
+    try:
+        charts_count, charts = chart_list.list_charts(sc, page_size=page_size, **params)
+    except SupersetRequestException as e:
+        log.error(f"Unable to list the Superset charts: {e}")
+        tk.h.flash_error(tk._('Unable to get the charts from Superset'))
+        charts_count, charts = 0, []
+
+    def pager_url(page=None, **kwargs):
+        return tk.h.url_for('superset_blueprint.index', **dict(params, filtered=1, page=page))
+
+    page = tk.h.Page(
+        collection=charts,
+        page=params['page'],
+        url=pager_url,
+        item_count=charts_count,
+        items_per_page=page_size,
+        presliced_list=True,
+    )
+
+    # The charts after this page are lazy loaded from `charts_json`
+    cursor = chart_list.next_cursor(
+        params['sort'], params['page'], charts, params['page'] * page_size < charts_count
+    )
+    next_url = None
+    if cursor:
+        list_params = {k: v for k, v in params.items() if k != 'page'}
+        # `filtered`: the charts JSON must read viz_type as the index does (none means all)
+        next_url = tk.h.url_for(
+            'superset_blueprint.charts_json', cursor=cursor, html=1, filtered=1, **list_params
+        )
 
     extra_vars = {
         'superset_url': superset_url,
         'charts_count': charts_count,
         'charts': charts,
+        'next_url': next_url,
+        'page': page,
+        'params': params,
+        'viz_types': chart_list.VIZ_TYPES,
+        'viz_icons': chart_list.VIZ_ICONS,
+        'uncached_thumbnails': uncached_chart_ids(charts),
+        'sort_options': chart_list.SORT_COLUMNS,
     }
     return tk.render('superset/index.html', extra_vars)
 
 
+@superset_bp.route('/charts.json', methods=['GET'])
+@require_sysadmin_user
+def charts_json():
+    """ A page of Superset charts as JSON, for lazy loading of the charts index.
+        Takes the index filters plus:
+        - cursor: `next_cursor` from the previous response
+        - limit: max number of charts
+        - fields: chart fields (a list preset name or comma separated fields)
+        - html: also return the rendered table rows
+    """
+    params = chart_list.parse_args(request.args)
+    params.pop('page')
+    fields = request.args.get('fields') or 'index'
+    try:
+        columns = resolve_columns('chart', fields)
+        # At most one Superset page (chart_list.MAX_PAGE_SIZE)
+        limit = chart_list.clamp_page_size(int(request.args.get('limit', 0)) or chart_list.get_index_page_size())
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if 'id' not in columns:
+        columns.insert(0, 'id')
+
+    sc = SupersetCKAN(**get_config())
+    try:
+        count, charts, cursor = chart_list.list_charts_after(
+            sc, cursor=request.args.get('cursor'), limit=limit, columns=columns, **params
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except SupersetRequestException as e:
+        log.error(f"Unable to list the Superset charts: {e}")
+        return jsonify({'success': False, 'error': 'Unable to get the charts from Superset'}), 502
+
+    next_url = None
+    if cursor:
+        next_url = tk.h.url_for('superset_blueprint.charts_json', **dict(request.args.to_dict(flat=False), cursor=cursor))
+    data = {
+        'success': True,
+        'count': count,
+        'columns': columns,
+        'next_cursor': cursor,
+        'next_url': next_url,
+        'result': [dict(chart.data, ckan_dataset=chart.ckan_dataset) for chart in charts],
+    }
+    if request.args.get('html'):
+        data['html'] = tk.render_snippet(
+            'superset/snippets/chart_rows.html', charts=charts, viz_icons=chart_list.VIZ_ICONS,
+            uncached_thumbnails=uncached_chart_ids(charts),
+        )
+    return jsonify(data)
+
+
 @superset_bp.route('/create-dataset/<string:chart_id>', methods=['GET', 'POST'])
 @require_sysadmin_user
 def create_dataset(chart_id):
@@ -107,7 +199,7 @@ def create_dataset(chart_id):
 
         # Crear el recurso asociado
         try:
-            csv_data = superset_chart.get_chart_csv()
+            export = download_chart(superset_chart, 'csv')
         except (SupersetRequestException, Exception) as e:
             log.error(f"Failed to download CSV for chart {chart_id}: {e}")
             tk.h.flash_success("Dataset created successfully, but the CSV file could not be downloaded from Superset. "
@@ -116,20 +208,18 @@ def create_dataset(chart_id):
             return tk.redirect_to(url)
 
         resource_name = request.form.get('ckan_dataset_resource_name')
-        f = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
-        f.write(csv_data)
-        f.close()
-        upload_file = FileStorage(filename=resource_name, stream=open(f.name, 'rb'))
-        action = tk.get_action("resource_create")
-        context = {'user': current_user.name}
-        data = {
-            'package_id': pkg['id'],
-            'upload': upload_file,
-            'url_type': 'upload',
-            'format': 'csv',
-            'name': resource_name,
-        }
-        action(context, data)
+        # The temporary file is removed once uploaded
+        with export:
+            action = tk.get_action("resource_create")
+            context = {'user': current_user.name}
+            data = {
+                'package_id': pkg['id'],
+                'upload': export.upload(resource_name),
+                'url_type': 'upload',
+                'format': 'csv',
+                'name': resource_name,
+            }
+            action(context, data)
 
         # Mensaje de éxito
         tk.h.flash_success("Dataset created successfully and added to the selected groups.")
@@ -152,17 +242,9 @@ def update_dataset(chart_id):
     if not current_user or not current_user.is_authenticated:
         tk.abort(403, "Login required")
 
-    pkgs = tk.get_action('package_search')(
-        {'ignore_auth': True},
-        {
-            'fq': f'{sync_module.EXTRA_CHART_ID}:{chart_id}',
-            'include_private': True,
-            'include_drafts': True,
-        },
-    )
-    if pkgs.get('count', 0) == 0:
+    ckan_dataset = get_package_by_chart_id(chart_id)
+    if not ckan_dataset:
         tk.abort(404, f"CKAN Dataset not found for chart {chart_id}")
-    ckan_dataset = pkgs['results'][0]
 
     context = {'user': current_user.name}
     try:
@@ -171,8 +253,10 @@ def update_dataset(chart_id):
         tk.abort(403, "Not authorized to update this dataset")
 
     result = sync_module.sync_dataset(ckan_dataset['id'], context=context)
-    if result['status'] == 'ok':
+    if result['status'] == sync_module.STATUS_OK:
         tk.h.flash_success("CSV resource updated successfully.")
+    elif result['status'] == sync_module.STATUS_UNCHANGED:
+        tk.h.flash_success("The CSV resource is already up to date.")
     else:
         tk.h.flash_error(f"Sync failed: {result['error']}")
 
@@ -253,7 +337,7 @@ def list_datasets():
     cfg = get_config()
     sc = SupersetCKAN(**cfg)
     # Obtener los datasets de Superset
-    datasets = sc.get_datasets()
+    datasets = sc.get_datasets(columns='list')
     superset_url = tk.config.get('ckanext.superset.instance.url')
     extra_vars = {
         'datasets': datasets,
@@ -1,7 +1,13 @@
 import logging
+import signal
 import click
 from ckan.plugins import toolkit as tk
+from ckanext.superset.data import schedule
 from ckanext.superset.data import sync as sync_module
+from ckanext.superset.data.scheduler import SyncScheduler
+from ckanext.superset.data import sync_runner
+from ckanext.superset.data import thumbnail_jobs
+from ckanext.superset.exceptions import SupersetRequestException
 
 
 log = logging.getLogger(__name__)
@@ -16,10 +22,42 @@ def superset():
     name="run-due-syncs",
     short_help="Run pending periodic syncs for Superset-linked datasets"
 )
-def run_due_syncs():
-    """ Enqueue a sync job for every dataset whose `superset_next_sync` has arrived. """
-    package_ids = sync_module.find_due_package_ids()
+@click.option("--workers", type=int, default=0,
+              help="Sync in this process with N threads sharing one Superset login "
+                   "(default: enqueue one background job per dataset)")
+@click.option("--batch-size", type=int, default=0,
+              help="Enqueue one background job per N datasets, sharing one Superset login")
+@click.option("--limit", type=int, default=0,
+              help="Claim at most N due datasets, leaving the rest to other nodes")
+def run_due_syncs(workers, batch_size, limit):
+    """ Sync every dataset whose `superset_next_sync` has arrived.
+        The datasets are leased to this node, it can run on several nodes at once.
+    """
+    if workers > 0 and batch_size > 0:
+        raise click.UsageError("Use either --workers or --batch-size")
+    superset = None
+    if workers > 0:
+        # Do not lease the due packages if we can not sync them
+        try:
+            superset = sync_runner.login()
+        except SupersetRequestException as e:
+            raise click.ClickException(f"Unable to connect to Superset: {e}")
+    package_ids = sync_module.claim_due_package_ids(limit=limit or None)
     click.echo(f"Found {len(package_ids)} package(s) due for sync")
+    if workers > 0:
+        _run_syncs(package_ids, workers, superset)
+        return
+    if batch_size > 0:
+        batches = sync_runner.batches(package_ids, batch_size)
+        for number, batch in enumerate(batches, start=1):
+            click.echo(f" -> enqueuing sync batch {number}/{len(batches)} ({len(batch)} packages)")
+            tk.enqueue_job(
+                sync_runner.sync_batch,
+                args=[batch],
+                title=f"superset_sync_batch:{number}/{len(batches)}",
+            )
+        click.echo("Done")
+        return
     for pid in package_ids:
         click.echo(f" -> enqueuing sync for {pid}")
         tk.enqueue_job(
@@ -30,5 +68,75 @@ def run_due_syncs():
     click.echo("Done")
 
 
+def _run_syncs(package_ids, workers, superset=None):
+    def echo_result(result):
+        line = f" -> {result['package_id']}: {result['status']} ({result['duration'] or 0:.1f}s)"
+        if result.get('error'):
+            line += f" {result['error']}"
+        click.echo(line)
+
+    try:
+        _, summary = sync_runner.run_syncs(package_ids, workers=workers, on_result=echo_result, superset=superset)
+    except SupersetRequestException as e:
+        # Let the other nodes (or the next run) sync them
+        schedule.release_leases(package_ids)
+        raise click.ClickException(f"Unable to connect to Superset: {e}")
+    counts = ", ".join(
+        f"{summary[status]} {status}" for status in sync_module.STATUSES if summary.get(status)
+    )
+    click.echo(
+        f"Synced {summary['total']} package(s) in {summary['duration']}s "
+        f"({summary['per_minute'] or 0} per minute): {counts or 'nothing to do'}"
+    )
+
+
+@superset.command(
+    name="scheduler",
+    short_help="Run the periodic syncs as they become due (long-running)"
+)
+@click.option("--workers", type=int, default=4, show_default=True,
+              help="Datasets (charts) synced at the same time")
+@click.option("--poll-interval", type=int, default=60, show_default=True,
+              help="Seconds between reads of the sync settings changes")
+def scheduler(workers, poll_interval):
+    """ Sync the datasets at their next sync time, without a cron. Stop it with SIGTERM or Ctrl+C. """
+    daemon = SyncScheduler(workers=workers, poll_interval=poll_interval)
+
+    def stop(signum, frame):
+        click.echo("Stopping, waiting for the running syncs")
+        daemon.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    click.echo(f"Sync scheduler running with {workers} worker(s)")
+    daemon.run()
+
+
+@superset.command(
+    name="warm-thumbnails",
+    short_help="Pre-fetch the thumbnails of the Superset charts"
+)
+@click.option("--concurrency", type=int, default=None,
+              help="Max simultaneous requests to Superset (default: ckanext.superset.concurrency)")
+@click.option("--force", is_flag=True, help="Fetch the thumbnails already cached too")
+@click.option("--background", is_flag=True, help="Enqueue a background job instead of running now")
+def warm_thumbnails(concurrency, force, background):
+    """ Cache the thumbnails of new and changed charts, so the admin index does not wait for Superset. """
+    if background:
+        tk.enqueue_job(
+            thumbnail_jobs.warm_thumbnails,
+            kwargs={'max_concurrency': concurrency, 'force': force},
+            title="superset_warm_thumbnails",
+        )
+        click.echo("Enqueued")
+        return
+    stats = thumbnail_jobs.warm_thumbnails(max_concurrency=concurrency, force=force)
+    click.echo(
+        f"{stats['charts']} chart(s): {stats['hits']} already cached, {stats['fetched']} fetched, "
+        f"{stats['pending']} being computed by Superset, {stats['failed']} failed, "
+        f"{stats['no_thumbnail']} without thumbnail ({stats['duration']}s)"
+    )
+
+
 def get_commands():
     return [superset]
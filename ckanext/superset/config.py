@@ -3,7 +3,7 @@ Connect to the superset API (through a proxy server if required)
 """
 import logging
 
-from ckan.plugins.toolkit import config
+from ckan.plugins.toolkit import asint, config
 
 
 log = logging.getLogger(__name__)
@@ -27,3 +27,25 @@ def get_config():
     log.info(f'Configuration values: Superset: {cfg["superset_url"]}, Proxy: {cfg.get("proxy_url")}')
 
     return cfg
+
+
+# Max IDs in an `id in` list filter: Superset list requests are GETs and
+# long query strings go past the request line limits of the web servers
+MAX_ID_FILTER = 100
+
+# Default page size of Superset list requests, per resource type
+DEFAULT_PAGE_SIZES = {
+    'chart': 350,
+    'dataset': 100,
+}
+
+
+def get_page_size(resource):
+    """ Page size to use when listing a Superset resource type (chart, dataset) """
+    default = DEFAULT_PAGE_SIZES.get(resource, 100)
+    return max(asint(config.get(f"ckanext.superset.page_size.{resource}", default)), 1)
+
+
+def get_concurrency():
+    """ Max number of simultaneous requests to Superset from one process """
+    return max(asint(config.get("ckanext.superset.concurrency", 8)), 1)
@@ -0,0 +1,251 @@
+"""
+Asyncio counterpart of SupersetCKAN, to push many Superset requests through
+one process (catalog loads, batch syncs, thumbnail warming).
+
+The login is shared with the sync client (see data/session.py): the async
+client borrows the tokens and the session cookie and asks the sync client to
+renew them when Superset rejects them.
+
+Usage from sync code (CLI commands, background jobs):
+
+    charts = run_sync(load_all_charts())
+
+    async def load_all_charts():
+        async with AsyncSupersetCKAN(**get_config()) as sc:
+            return await sc.load_charts()
+"""
+import asyncio
+import json
+import logging
+import threading
+
+import httpx
+from httpx import Proxy
+
+from ckanext.superset.config import get_concurrency, get_page_size
+from ckanext.superset.data.chart import SupersetChart
+from ckanext.superset.data.columns import resolve_columns
+from ckanext.superset.data.dataset import SupersetDataset
+from ckanext.superset.data.main import SupersetCKAN, remaining_pages
+from ckanext.superset.data.registry import chart_registry, dataset_registry
+from ckanext.superset.exceptions import (
+    SupersetAuthException, SupersetPendingException, SupersetRequestException,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+def run_sync(coro):
+    """ Run a coroutine from sync code and return its result """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    # We are already inside an event loop: use a new one in other thread
+    result = {}
+
+    def runner():
+        try:
+            result['value'] = asyncio.run(coro)
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=runner)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+class AsyncSupersetCKAN:
+    """ An asyncio client for a Superset instance """
+
+    def __init__(self, max_concurrency=None, **kwargs):
+        # The sync client owns the (shared) login
+        self.sync = SupersetCKAN(**kwargs)
+        self.superset_url = self.sync.superset_url
+        self.max_concurrency = max_concurrency or get_concurrency()
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.client = None
+
+        self.charts_response = None
+        self.charts = chart_registry()
+
+        self.datasets_response = None
+        self.datasets = dataset_registry()
+
+        self.databases_response = None
+        self.databases = []
+
+    async def __aenter__(self):
+        await self.prepare_connection()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def prepare_connection(self):
+        """ Login (or reuse the shared login) and build the async client """
+        await asyncio.to_thread(self.sync.prepare_connection)
+        limits = httpx.Limits(max_connections=self.max_concurrency)
+        proxy = Proxy(self.sync.proxy_full_url) if self.sync.proxy_url else None
+        transport = httpx.AsyncHTTPTransport(proxy=proxy, limits=limits)
+        self.client = httpx.AsyncClient(transport=transport)
+        self.client.cookies.update(self.sync.session.cookies)
+        return self.client
+
+    async def reconnect(self, stale_token):
+        """ Superset rejected `stale_token`: let the sync client renew the login """
+        await asyncio.to_thread(self.sync.reconnect, stale_token)
+        self.client.cookies.update(self.sync.session.cookies)
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    @property
+    def access_token(self):
+        return self.sync.access_token
+
+    async def get(self, endpoint, timeout=30, format_='json', params=None):
+        """ Get data from the Superset API, see SupersetCKAN.get """
+        if not self.client:
+            await self.prepare_connection()
+
+        url = f'{self.superset_url}/api/v1/{endpoint}'
+        log.info(f"Superset async GET {url} :: {params}")
+        token = self.access_token
+        try:
+            headers = self.sync.get_headers(format_=format_)
+            api_response = await self.request("GET", url, headers=headers, params=params, timeout=timeout)
+        except SupersetAuthException:
+            # The token expired, renew it and retry once
+            await self.reconnect(token)
+            headers = self.sync.get_headers(format_=format_)
+            api_response = await self.request("GET", url, headers=headers, params=params, timeout=timeout)
+
+        if format_ == 'csv':
+            return api_response.content
+        elif format_ == 'json':
+            return api_response.json()
+        elif format_ == 'image':  # Thumbnail images
+            if api_response.status_code == 202:
+                # Superset is computing it in the background
+                raise SupersetPendingException(f"Superset is still computing {endpoint}")
+            return api_response.content
+
+    async def request(self, method, url, **kwargs):
+        """ Perform an HTTP request with the same error mapping as SupersetCKAN.request """
+        async with self.semaphore:
+            try:
+                response = await self.client.request(method, url, **kwargs)
+                if response.status_code == 302:
+                    return response
+                response.raise_for_status()
+                return response
+            except Exception as e:
+                self.sync.handle_request_exception(url, e)
+
+    async def get_all_pages(self, endpoint, q_data):
+        """ Get every page of a Superset list endpoint, see SupersetCKAN.get_all_pages """
+        q_data = dict(q_data, page=0)
+        first = await self.get(endpoint, params={'q': json.dumps(q_data)})
+        results = list(first.get("result", []))
+        page_size, pages = remaining_pages(first, q_data["page_size"])
+        q_data["page_size"] = page_size
+
+        async def get_page(page):
+            response = await self.get(endpoint, params={'q': json.dumps(dict(q_data, page=page))})
+            return response.get("result", [])
+
+        for page_results in await asyncio.gather(*(get_page(page) for page in pages)):
+            results.extend(page_results)
+        return first, results
+
+    async def load_datasets(self, force=False, columns=None):
+        """ Get and load all datasets, see SupersetCKAN.load_datasets """
+        if self.datasets and not force:
+            return self.datasets
+
+        q_data = {"page_size": get_page_size("dataset")}
+        columns = resolve_columns("dataset", columns)
+        if columns:
+            q_data["columns"] = columns
+        self.datasets_response, datasets = await self.get_all_pages("dataset/", q_data)
+        self.datasets = dataset_registry()
+        for dataset in datasets:
+            ds = SupersetDataset(superset_instance=self.sync)
+            ds.load(dataset)
+            self.datasets.add(ds)
+        return self.datasets
+
+    async def load_charts(self, force=False, columns=None):
+        """ Get and load all charts as SupersetChart objects, see SupersetCKAN.load_charts """
+        if self.charts and not force:
+            return self.charts
+
+        q_data = {"page_size": get_page_size("chart")}
+        columns = resolve_columns("chart", columns)
+        if columns:
+            q_data["columns"] = columns
+        self.charts_response, charts = await self.get_all_pages("chart/", q_data)
+        self.charts = chart_registry()
+        for chart in charts:
+            ds = SupersetChart(superset_instance=self.sync)
+            ds.load(chart)
+            self.charts.add(ds)
+
+        return self.charts
+
+    async def load_databases(self, force=False):
+        if self.databases and not force:
+            return self.databases
+
+        self.databases_response = await self.get("database/")
+        self.databases = sorted(
+            self.databases_response.get("result", []),
+            key=lambda x: x["id"]
+        )
+        return self.databases
+
+    async def get_chart(self, chart_id):
+        """ Get a chart by ID """
+        chart = self.charts.get(chart_id)
+        if chart:
+            return chart
+        data = await self.get(f"chart/{chart_id}")
+        chart = SupersetChart(superset_instance=self.sync)
+        chart.load(data.get("result", {}))
+        return self.charts.add(chart)
+
+    async def get_dataset(self, dataset_id):
+        """ Get a dataset by ID """
+        dataset = self.datasets.get(dataset_id)
+        if dataset:
+            return dataset
+        data = await self.get(f"dataset/{dataset_id}")
+        dataset = SupersetDataset(superset_instance=self.sync)
+        dataset.load(data.get("result", {}))
+        return self.datasets.add(dataset)
+
+    async def get_chart_csv(self, chart_id):
+        """ Get a chart data as CSV """
+        return await self.get(f'chart/{chart_id}/data/?format=csv', format_='csv')
+
+    async def get_chart_thumbnail(self, chart, raise_pending=False):
+        """ Get the thumbnail image of a chart (see SupersetChart.get_thumbnail) """
+        url = chart["thumbnail_url"]
+        if not url:
+            return None
+        try:
+            return await self.get(url.replace("/api/v1/", ""), format_="image")
+        except SupersetPendingException:
+            if raise_pending:
+                raise
+            return None
+        except SupersetRequestException:
+            return None
@@ -0,0 +1,242 @@
+"""
+Local cache of the Superset catalog (charts, datasets and databases).
+
+SupersetCKAN loaders read through this cache: while it is fresh (see
+ckanext.superset.catalog.ttl) the admin pages render from the CKAN database
+instead of waiting for Superset.
+The cache only answers for the same column selection it was filled with.
+
+When the cache expires, charts and datasets are refreshed incrementally:
+only the objects changed since the newest `changed_on_utc` we have (the high
+water mark) are requested and merged. Deleted objects are removed every
+ckanext.superset.catalog.reconcile_interval seconds with an id-only listing.
+
+The cache is read and written in a session of its own: it is used in the
+middle of web requests and actions, and must never commit or roll back
+their work (nor lose it when the cache tables are missing).
+"""
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+from ckan import model
+from ckan.plugins.toolkit import asbool, asint, config
+
+from ckanext.superset.model import SupersetCatalogItem, SupersetCatalogState
+
+
+log = logging.getLogger(__name__)
+
+CHANGED_ON = 'changed_on_utc'
+
+# Loaded objects stay usable after the session is closed
+_Session = sessionmaker(expire_on_commit=False)
+
+
+@contextmanager
+def _session():
+    """ A cache session, independent from model.Session.
+        Committed at the end of the block, rolled back on errors
+    """
+    session = _Session(bind=model.meta.engine)
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def get_ttl():
+    """ Seconds a cached catalog is valid, 0 disables the cache """
+    return asint(config.get('ckanext.superset.catalog.ttl', 600))
+
+
+def get_reconcile_interval():
+    """ Seconds between checks for objects deleted in Superset """
+    return asint(config.get('ckanext.superset.catalog.reconcile_interval', 3600))
+
+
+def parse_changed_on(row):
+    """ The `changed_on_utc` of a Superset row as a naive UTC datetime, or None """
+    value = row.get(CHANGED_ON)
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z'):
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return None
+
+
+def _is_fresh(state):
+    return state.fetched_at >= datetime.utcnow() - timedelta(seconds=get_ttl())
+
+
+def _rows(session, resource_type):
+    items = session.query(SupersetCatalogItem.data).filter(
+        SupersetCatalogItem.resource_type == resource_type
+    ).order_by(
+        SupersetCatalogItem.changed_on.desc().nullslast(),
+        SupersetCatalogItem.position,
+    ).all()
+    return [item.data for item in items]
+
+
+def get_state(resource_type, columns=None):
+    """ The cache state for a resource type, if it was filled with these columns """
+    if get_ttl() <= 0:
+        return None
+    try:
+        with _session() as session:
+            state = session.get(SupersetCatalogState, resource_type)
+    except SQLAlchemyError as e:
+        log.warning(f"Unable to read the Superset catalog cache: {e}")
+        return None
+    if state is None or state.columns != columns:
+        return None
+    return state
+
+
+def load(resource_type, columns=None):
+    """ Get the cached rows for a resource type.
+        Returns None if there is no fresh cache for these columns
+    """
+    state = get_state(resource_type, columns)
+    if state is None or not _is_fresh(state):
+        return None
+    try:
+        with _session() as session:
+            rows = _rows(session, resource_type)
+    except SQLAlchemyError as e:
+        log.warning(f"Unable to read the Superset catalog cache: {e}")
+        return None
+
+    log.info(f"Using the cached Superset {resource_type} catalog from {state.fetched_at}")
+    return rows
+
+
+def can_refresh_incrementally(state, columns=None):
+    """ We know the last change and the rows include `changed_on_utc` """
+    if not asbool(config.get('ckanext.superset.catalog.incremental', True)):
+        return False
+    if state is None or state.high_water_mark is None:
+        return False
+    return columns is None or CHANGED_ON in columns
+
+
+def reconcile_due(state):
+    """ Time to look for objects deleted in Superset """
+    if state.reconciled_at is None:
+        return True
+    interval = timedelta(seconds=get_reconcile_interval())
+    return state.reconciled_at < datetime.utcnow() - interval
+
+
+def _item(resource_type, row, position, now):
+    return SupersetCatalogItem(
+        resource_type=resource_type,
+        object_id=str(row.get('id')),
+        position=position,
+        data=row,
+        changed_on=parse_changed_on(row),
+        fetched_at=now,
+    )
+
+
+def _high_water_mark(rows, previous=None):
+    marks = [mark for mark in (parse_changed_on(row) for row in rows) if mark]
+    if previous:
+        marks.append(previous)
+    return max(marks) if marks else None
+
+
+def save(resource_type, rows, columns=None):
+    """ Replace the cached rows for a resource type """
+    if get_ttl() <= 0:
+        return
+    now = datetime.utcnow()
+    try:
+        with _session() as session:
+            session.query(SupersetCatalogItem).filter(
+                SupersetCatalogItem.resource_type == resource_type
+            ).delete(synchronize_session=False)
+            session.add_all([
+                _item(resource_type, row, position, now)
+                for position, row in enumerate(rows)
+            ])
+            session.merge(SupersetCatalogState(
+                resource_type=resource_type,
+                columns=columns,
+                count=len(rows),
+                fetched_at=now,
+                high_water_mark=_high_water_mark(rows),
+                # A full load is also a reconciliation
+                reconciled_at=now,
+            ))
+    except SQLAlchemyError as e:
+        log.warning(f"Unable to save the Superset catalog cache: {e}")
+
+
+def merge(resource_type, changed_rows, existing_ids=None):
+    """ Merge the rows changed since the last refresh into the cache.
+        If `existing_ids` is given, drop the cached objects not in it.
+        Returns all the cached rows, or None if the cache could not be updated
+    """
+    now = datetime.utcnow()
+    try:
+        with _session() as session:
+            state = session.get(SupersetCatalogState, resource_type)
+            for row in changed_rows:
+                session.merge(_item(resource_type, row, 0, now))
+            if existing_ids is not None:
+                existing_ids = [str(object_id) for object_id in existing_ids]
+                deleted = session.query(SupersetCatalogItem).filter(
+                    SupersetCatalogItem.resource_type == resource_type,
+                    SupersetCatalogItem.object_id.notin_(existing_ids),
+                ).delete(synchronize_session=False)
+                log.info(f"Dropped {deleted} {resource_type}(s) deleted in Superset from the cache")
+                state.reconciled_at = now
+            session.flush()
+            rows = _rows(session, resource_type)
+            state.count = len(rows)
+            state.fetched_at = now
+            state.high_water_mark = _high_water_mark(changed_rows, state.high_water_mark)
+    except SQLAlchemyError as e:
+        log.warning(f"Unable to update the Superset catalog cache: {e}")
+        return None
+
+    log.info(f"Merged {len(changed_rows)} changed {resource_type}(s) into the cache")
+    return rows
+
+
+def get_item(resource_type, object_id):
+    """ Get a single cached object (of any age), or None """
+    try:
+        with _session() as session:
+            item = session.get(SupersetCatalogItem, (resource_type, str(object_id)))
+    except SQLAlchemyError as e:
+        log.warning(f"Unable to read the Superset catalog cache: {e}")
+        return None
+    return item.data if item else None
+
+
+def clear(resource_type=None):
+    """ Drop the cache (for one resource type or all of them) """
+    try:
+        with _session() as session:
+            items = session.query(SupersetCatalogItem)
+            states = session.query(SupersetCatalogState)
+            if resource_type:
+                items = items.filter(SupersetCatalogItem.resource_type == resource_type)
+                states = states.filter(SupersetCatalogState.resource_type == resource_type)
+            items.delete(synchronize_session=False)
+            states.delete(synchronize_session=False)
+    except SQLAlchemyError as e:
+        log.warning(f"Unable to clear the Superset catalog cache: {e}")
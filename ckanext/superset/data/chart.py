@@ -1,6 +1,7 @@
 import logging
-from ckan.plugins import toolkit
-from ckanext.superset.exceptions import SupersetRequestException
+from ckanext.superset.data.links import get_package_by_chart_id
+from ckanext.superset.data.thumbnails import get_digest
+from ckanext.superset.exceptions import SupersetPendingException, SupersetRequestException
 
 
 log = logging.getLogger(__name__)
@@ -14,6 +15,8 @@ class SupersetChart:
         self.data = {}
         self.superset_instance = superset_instance
         self._ckan_dataset = None
+        # The CKAN dataset was already looked up (it may be None)
+        self._ckan_dataset_resolved = False
 
     def load(self, json_data):
         """ Load the dataset from a JSON object
@@ -34,21 +37,17 @@ class SupersetChart:
 
     @property
     def ckan_dataset(self):
-        """ Returns the CKAN dataset create from this Superset dataset """
-        if self._ckan_dataset:
-            return self._ckan_dataset
-        # Search a CKAN package with the extra superset_chart_id: self.id
-        ctx = {"ignore_auth": True}
-        search = {
-            'fq': f'superset_chart_id:{self.id}',
-            'include_private': True,
-            'include_drafts': True,
-        }
-        pkgs = toolkit.get_action("package_search")(ctx, data_dict=search)
-        if pkgs.get("count") > 0:
-            self._ckan_dataset = pkgs.get("results")[0]
-            return self._ckan_dataset
-        return None
+        """ Returns the CKAN dataset created from this Superset chart.
+            To resolve many charts use data.links.attach_ckan_datasets
+        """
+        if not self._ckan_dataset_resolved:
+            self.set_ckan_dataset(get_package_by_chart_id(self.id))
+        return self._ckan_dataset
+
+    def set_ckan_dataset(self, package):
+        """ Set the (already resolved) CKAN dataset of this chart, None if there is none """
+        self._ckan_dataset = package
+        self._ckan_dataset_resolved = True
 
     def get_chart_data(self):
         """ Get the dataset data """
@@ -68,11 +67,26 @@ class SupersetChart:
         """ Get the dataset as CSV """
         return self.get_chart_file("csv")
 
-    def get_thumbnail(self):
+    def download_file(self, format_, fileobj):
+        """ Stream the chart data in `format_` to a file object, without loading it in memory.
+            Returns the size and the SHA-256 of the content. See data/downloads.py
+        """
+        format_ = format_.lower()
+        url = f'chart/{self.id}/data/?format={format_}'
+        return self.superset_instance.download(url, fileobj, format_=format_)
+
+    @property
+    def thumbnail_digest(self):
+        """ The digest in the thumbnail URL, it changes when the chart changes """
+        return get_digest(self.data.get("thumbnail_url"))
+
+    def get_thumbnail(self, raise_pending=False):
         """
         The api give us the field thumbnail_url with values like: /api/v1/chart/32/thumbnail/ce90a87d38fa6a2d8fa20232c1cba6f3/
         This method returns the full URL for the thumbnail.
         Considering we can be behind a proxy, we can't simply use the URL.
+        If Superset is still computing it, returns None or raises
+        SupersetPendingException if `raise_pending`
         """
         url = self.data.get("thumbnail_url")
         if not url:
@@ -80,6 +94,10 @@ class SupersetChart:
         cleaned_url = url.replace("/api/v1/", "")
         try:
             image = self.superset_instance.get(cleaned_url, format_="image")
+        except SupersetPendingException:
+            if raise_pending:
+                raise
+            return None
         except SupersetRequestException:
             return None
 
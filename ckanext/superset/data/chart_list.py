@@ -0,0 +1,291 @@
+"""
+Paginated, sorted and filtered chart listings for the admin charts index.
+
+Only the requested page is read from Superset: the visualization type and
+name filters and the sort order are sent as Superset list filters.
+The "linked to CKAN" filter is resolved in the CKAN database. A few linked
+charts are sent as a filter on the chart IDs. Otherwise the IDs of the
+listing are read from Superset (a light `columns: [id]` scan, stopped once
+the page is filled) and the linked ones kept or dropped locally: the IDs
+sent in a request (`id in [...]` in the query string) stay under
+MAX_ID_FILTER, whatever the size of the catalog.
+
+The JSON listing (lazy loading of the index) pages with an opaque cursor:
+when sorting by ID it holds the last ID seen (keyset pagination, stable
+while charts are added), otherwise the next page number.
+"""
+import base64
+import json
+import logging
+
+from ckan.plugins.toolkit import asint, config
+
+from ckanext.superset.config import MAX_ID_FILTER, get_page_size
+from ckanext.superset.data.links import attach_ckan_datasets, get_linked_chart_ids
+from ckanext.superset.data.main import remaining_pages
+
+
+log = logging.getLogger(__name__)
+
+# Font Awesome icon for each Superset visualization type
+VIZ_ICONS = {
+    'table': 'fa-table',
+    'pivot_table_v2': 'fa-table',
+    'pie': 'fa-pie-chart',
+    'echarts_timeseries_bar': 'fa-bar-chart',
+    'echarts_timeseries_line': 'fa-line-chart',
+    'echarts_timeseries_scatter': 'fa-line-chart',
+    'echarts_timeseries_smooth': 'fa-line-chart',
+    'echarts_area': 'fa-area-chart',
+    'big_number_total': 'fa-hashtag',
+    'big_number': 'fa-hashtag',
+    'box_plot': 'fa-sliders',
+    'treemap_v2': 'fa-th-large',
+    'treemap': 'fa-th-large',
+    'dist_bar': 'fa-bar-chart',
+    'bar': 'fa-bar-chart',
+    'line': 'fa-line-chart',
+    'area': 'fa-area-chart',
+    'histogram': 'fa-bar-chart',
+    'bubble': 'fa-circle-o',
+    'word_cloud': 'fa-cloud',
+    'filter_box': 'fa-filter',
+    'markup': 'fa-code',
+    'separator': 'fa-minus',
+    'map': 'fa-map',
+    'world_map': 'fa-globe',
+    'heatmap': 'fa-th',
+    'sunburst': 'fa-sun-o',
+    'gauge_chart': 'fa-tachometer',
+}
+VIZ_TYPES = sorted(VIZ_ICONS)
+# The types selected when the index is opened without filters
+DEFAULT_VIZ_TYPES = ['table', 'pivot_table_v2']
+
+# Sort options: URL value -> Superset order column
+SORT_COLUMNS = {
+    'changed': 'changed_on_delta_humanized',
+    'id': 'id',
+    'name': 'slice_name',
+    'type': 'viz_type',
+}
+DEFAULT_SORT = 'changed'
+
+CKAN_ALL = 'all'
+CKAN_WITH = 'with'
+CKAN_WITHOUT = 'without'
+CKAN_FILTERS = (CKAN_ALL, CKAN_WITH, CKAN_WITHOUT)
+
+
+# Superset serves at most this many rows per page (FAB_API_MAX_PAGE_SIZE default)
+MAX_PAGE_SIZE = 100
+
+
+def get_index_page_size():
+    return clamp_page_size(asint(config.get('ckanext.superset.index.page_size', 50)))
+
+
+def clamp_page_size(page_size):
+    """ A page size Superset serves in full: between 1 and MAX_PAGE_SIZE """
+    return min(max(page_size, 1), MAX_PAGE_SIZE)
+
+
+def parse_args(args):
+    """ Read (and sanitize) the chart list options from the request arguments """
+    try:
+        page = max(int(args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    sort = args.get('sort', DEFAULT_SORT)
+    if sort not in SORT_COLUMNS:
+        sort = DEFAULT_SORT
+    order = 'asc' if args.get('order') == 'asc' else 'desc'
+    ckan = args.get('ckan', CKAN_ALL)
+    if ckan not in CKAN_FILTERS:
+        ckan = CKAN_ALL
+    # `filtered` is sent by the filters form: no types selected means all the types
+    if args.get('filtered'):
+        viz_types = [vt for vt in args.getlist('viz_type') if vt]
+    else:
+        viz_types = list(DEFAULT_VIZ_TYPES)
+    return {
+        'page': page,
+        'sort': sort,
+        'order': order,
+        'q': (args.get('q') or '').strip(),
+        'viz_type': viz_types,
+        'ckan': ckan,
+    }
+
+
+def build_filters(viz_types=None, q=None, chart_ids=None):
+    """ Superset list filters (rison `filters`) for the chart list """
+    filters = []
+    if viz_types:
+        filters.append({'col': 'viz_type', 'opr': 'in', 'value': list(viz_types)})
+    if q:
+        filters.append({'col': 'slice_name', 'opr': 'ct', 'value': q})
+    if chart_ids is not None:
+        filters.append({'col': 'id', 'opr': 'in', 'value': [int(i) for i in chart_ids]})
+    return filters
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _linked_chart_ids():
+    return sorted({int(chart_id) for chart_id in get_linked_chart_ids() if chart_id.isdigit()})
+
+
+def _scan_ids(sc, filters, order_column, order, keep, stop_after):
+    """ The IDs of the listing (in order) for which `keep(id)`, the first `stop_after` of them.
+        Returns them and the number of charts in the listing
+    """
+    ids = []
+    scan_size = get_page_size('chart')
+    page = 0
+    while True:
+        response, charts = sc.get_charts_page(
+            page=page, page_size=scan_size, filters=filters,
+            order_column=order_column, order_direction=order, columns=['id'],
+        )
+        charts = list(charts)
+        count = response.get('count', 0)
+        if page == 0:
+            # Superset caps the page size (see main.remaining_pages)
+            scan_size, _ = remaining_pages(response, scan_size)
+        ids.extend(chart.id for chart in charts if keep(chart.id))
+        page += 1
+        if len(ids) >= stop_after or not charts or page * scan_size >= count:
+            return ids[:stop_after], count
+
+
+def _count_ids(sc, filters, chart_ids):
+    """ How many of `chart_ids` match the filters (MAX_ID_FILTER IDs per request) """
+    count = 0
+    for chunk in _chunks(chart_ids, MAX_ID_FILTER):
+        response, _ = sc.get_charts_page(page_size=1, filters=filters + build_filters(chart_ids=chunk), columns=['id'])
+        count += response.get('count', 0)
+    return count
+
+
+def _get_charts(sc, chart_ids, columns):
+    """ The charts with these IDs, in the same order """
+    charts = {}
+    for chunk in _chunks(chart_ids, MAX_ID_FILTER):
+        _, page = sc.get_charts_page(page_size=len(chunk), filters=build_filters(chart_ids=chunk), columns=columns)
+        charts.update((chart.id, chart) for chart in page)
+    return [charts[chart_id] for chart_id in chart_ids if chart_id in charts]
+
+
+def _list_by_linked(sc, ckan, linked, filters, page, page_size, sort, order, columns):
+    """ A page of the charts linked (or not) to CKAN, for more linked charts
+        than fit in a filter. Returns the count and the charts
+    """
+    linked_set = set(linked)
+    with_ckan = ckan == CKAN_WITH
+    ids, total = _scan_ids(
+        sc, filters, SORT_COLUMNS[sort], order,
+        keep=lambda chart_id: (chart_id in linked_set) == with_ckan,
+        stop_after=page * page_size,
+    )
+    linked_count = _count_ids(sc, filters, linked)
+    count = linked_count if with_ckan else total - linked_count
+    return count, _get_charts(sc, ids[(page - 1) * page_size:], columns)
+
+
+def list_charts(sc, page=1, sort=DEFAULT_SORT, order='desc', q=None, viz_type=None,
+                ckan=CKAN_ALL, page_size=None, columns='index', extra_filters=None):
+    """ Get one page of charts from Superset, with their CKAN datasets resolved.
+        Returns the total number of matching charts and the charts in the page
+    """
+    page_size = page_size or get_index_page_size()
+    filters = build_filters(viz_type, q) + list(extra_filters or [])
+    linked = _linked_chart_ids() if ckan != CKAN_ALL else []
+    if ckan == CKAN_WITH and not linked:
+        # Nothing can match, do not ask Superset
+        return 0, []
+
+    if ckan == CKAN_ALL or not linked or (ckan == CKAN_WITH and len(linked) <= MAX_ID_FILTER):
+        if ckan == CKAN_WITH:
+            filters += build_filters(chart_ids=linked)
+        response, charts = sc.get_charts_page(
+            page=page - 1,
+            page_size=page_size,
+            filters=filters,
+            order_column=SORT_COLUMNS[sort],
+            order_direction=order,
+            columns=columns,
+        )
+        count = response.get('count', 0)
+    else:
+        count, charts = _list_by_linked(sc, ckan, linked, filters, page, page_size, sort, order, columns)
+    charts = list(charts)
+    attach_ckan_datasets(charts)
+    return count, charts
+
+
+def encode_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """ Read a cursor from encode_cursor, raises ValueError if it is not valid """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(data, dict):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return data
+
+
+def next_cursor(sort, page, charts, has_more):
+    """ The cursor for the charts after `charts` (the `page` of a listing) """
+    if not has_more or not charts:
+        return None
+    if sort == 'id':
+        return encode_cursor({'sort': sort, 'after': charts[-1].id})
+    return encode_cursor({'sort': sort, 'page': page + 1})
+
+
+def cursor_position(state, sort):
+    """ The page and the last ID seen (or None) of a decoded cursor.
+        Raises ValueError if the cursor is not valid for this sort order
+    """
+    if not state:
+        return 1, None
+    if state.get('sort') != sort:
+        raise ValueError("The cursor belongs to a listing with another sort order")
+    try:
+        if 'after' in state:
+            return 1, int(state['after'])
+        page = int(state['page'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+    if page < 1:
+        raise ValueError("Invalid cursor")
+    return page, None
+
+
+def list_charts_after(sc, cursor=None, limit=None, sort=DEFAULT_SORT, order='desc', columns='index', **params):
+    """ Get the charts after a cursor (the first ones without it).
+        Returns the number of matching charts (only without a cursor), the
+        charts and the cursor for the next ones (None at the end)
+    """
+    limit = clamp_page_size(limit or get_index_page_size())
+    state = decode_cursor(cursor) if cursor else {}
+    page, after = cursor_position(state, sort)
+    extra_filters = []
+    if after is not None:
+        operator = 'gt' if order == 'asc' else 'lt'
+        extra_filters.append({'col': 'id', 'opr': operator, 'value': after})
+
+    count, charts = list_charts(
+        sc, page=page, sort=sort, order=order, page_size=limit,
+        columns=columns, extra_filters=extra_filters, **params
+    )
+    # With keyset pagination `count` only includes the charts after the cursor
+    has_more = count > limit if extra_filters else page * limit < count
+    return (None if state else count), charts, next_cursor(sort, page, charts, has_more)
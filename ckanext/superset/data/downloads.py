@@ -0,0 +1,72 @@
+"""
+Chart exports streamed from Superset to temporary files.
+
+Chart CSV exports can be hundreds of MB: they are written to disk chunk by
+chunk (see SupersetCKAN.download) instead of being loaded in memory, and the
+temporary file is removed once it is uploaded to CKAN.
+"""
+import logging
+import os
+import tempfile
+
+from werkzeug.datastructures import FileStorage
+
+
+log = logging.getLogger(__name__)
+
+
+class ChartExport:
+    """ A chart export in a temporary file, removed when leaving the `with` block
+
+        with download_chart(chart) as export:
+            tk.get_action('resource_patch')(context, {'id': ..., 'upload': export.upload('data.csv')})
+    """
+
+    def __init__(self, chart_id, format_='csv', directory=None):
+        self.chart_id = chart_id
+        self.format = format_
+        fd, self.path = tempfile.mkstemp(prefix=f'superset-chart-{chart_id}-', suffix=f'.{format_}', dir=directory)
+        self.file = os.fdopen(fd, 'w+b')
+        self.size = 0
+        self.sha256 = None
+        self._readers = []
+
+    def upload(self, filename):
+        """ A FileStorage with the export, for the `upload` field of resource actions.
+            Each call reads the file from the start, one export can be uploaded
+            to several resources
+        """
+        self.file.flush()
+        reader = open(self.path, 'rb')
+        self._readers.append(reader)
+        return FileStorage(stream=reader, filename=filename)
+
+    def cleanup(self):
+        for reader in self._readers:
+            reader.close()
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.cleanup()
+
+
+def download_chart(chart, format_='csv', directory=None):
+    """ Stream the export of a SupersetChart to a temporary file.
+        Returns a ChartExport (use it as a context manager to remove the file).
+        Raises SupersetRequestException if the download fails
+    """
+    export = ChartExport(chart.id, format_=format_, directory=directory)
+    try:
+        export.size, export.sha256 = chart.download_file(format_, export.file)
+    except BaseException:
+        export.cleanup()
+        raise
+    log.info(f"Chart {chart.id} {format_} export: {export.size} bytes, sha256 {export.sha256}")
+    return export
@@ -0,0 +1,79 @@
+"""
+Links between Superset charts and the CKAN datasets created from them.
+
+A CKAN dataset is linked to a chart by its `superset_chart_id` extra.
+Resolving links here with one database query for many charts avoids a
+Solr `package_search` per chart (the admin index lists hundreds of them).
+"""
+import logging
+
+from ckan import model
+
+
+log = logging.getLogger(__name__)
+
+EXTRA_CHART_ID = 'superset_chart_id'
+
+
+def _package_summary(package):
+    return {
+        'id': package.id,
+        'name': package.name,
+        'title': package.title,
+        'owner_org': package.owner_org,
+        'private': package.private,
+        'state': package.state,
+    }
+
+
+def get_packages_by_chart_ids(chart_ids):
+    """ Map chart IDs (as strings) to the CKAN dataset linked to each one.
+        Charts without a (non deleted) CKAN dataset are not included.
+        If a chart is linked to several datasets, the oldest one wins.
+    """
+    chart_ids = list({str(chart_id) for chart_id in chart_ids if chart_id is not None})
+    if not chart_ids:
+        return {}
+
+    PE = model.PackageExtra
+    rows = model.Session.query(PE.value, model.Package).join(
+        model.Package, model.Package.id == PE.package_id
+    ).filter(
+        PE.key == EXTRA_CHART_ID,
+        PE.value.in_(chart_ids),
+        PE.state == 'active',
+        model.Package.state != 'deleted',
+    ).order_by(model.Package.metadata_created).all()
+
+    packages = {}
+    for chart_id, package in rows:
+        packages.setdefault(chart_id, _package_summary(package))
+    return packages
+
+
+def get_linked_chart_ids():
+    """ IDs (as strings) of all the charts with a (non deleted) CKAN dataset """
+    PE = model.PackageExtra
+    rows = model.Session.query(PE.value).join(
+        model.Package, model.Package.id == PE.package_id
+    ).filter(
+        PE.key == EXTRA_CHART_ID,
+        PE.state == 'active',
+        model.Package.state != 'deleted',
+    ).distinct().all()
+    return [row[0] for row in rows]
+
+
+def get_package_by_chart_id(chart_id):
+    """ The CKAN dataset linked to a chart, or None """
+    return get_packages_by_chart_ids([chart_id]).get(str(chart_id))
+
+
+def attach_ckan_datasets(charts):
+    """ Resolve the CKAN dataset of many SupersetChart objects at once """
+    charts = list(charts)
+    packages = get_packages_by_chart_ids(chart.id for chart in charts)
+    for chart in charts:
+        chart.set_ckan_dataset(packages.get(str(chart.id)))
+    log.debug(f"Resolved {len(packages)} CKAN dataset(s) for {len(charts)} chart(s)")
+    return packages
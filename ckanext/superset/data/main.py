@@ -1,19 +1,47 @@
 """
 Connect to the superset API (through a proxy server if required)
 """
+import hashlib
 import json
 import logging
+import math
 import urllib.parse
 import httpx
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from ckanext.superset.config import MAX_ID_FILTER, get_concurrency, get_page_size
+from ckanext.superset.data import catalog
 from ckanext.superset.data.chart import SupersetChart
+from ckanext.superset.data.columns import resolve_columns
 from httpx import Proxy
 from ckanext.superset.data.dataset import SupersetDataset
-from ckanext.superset.exceptions import SupersetRequestException
+from ckanext.superset.data.registry import chart_registry, dataset_registry
+from ckanext.superset.data.session import get_session
+from ckanext.superset.exceptions import (
+    SupersetAuthException, SupersetPendingException, SupersetRequestException,
+)
 
 
 log = logging.getLogger(__name__)
 
+# Bytes read at once when streaming a download
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def remaining_pages(first_response, page_size):
+    """ Pages still to fetch after the first one of a Superset list response.
+        Superset caps the page size (FAB_API_MAX_PAGE_SIZE), if the first page is
+        shorter than requested and there is more to read, the real page size
+        is the length of the first page.
+        Returns the page size to use and the list of page numbers
+    """
+    count = first_response.get("count") or 0
+    first_len = len(first_response.get("result") or [])
+    if not first_len or count <= first_len:
+        return page_size, []
+    page_size = min(page_size, first_len)
+    return page_size, list(range(1, math.ceil(count / page_size)))
+
 
 class SupersetCKAN:
     """ A class to connect to a Superset instance """
@@ -40,69 +68,196 @@ class SupersetCKAN:
             self.proxy_pass = urllib.parse.quote(proxy_pass)
         else:
             self.proxy_pass = None
+        # Shared login state for these settings (see data/session.py)
+        self.session = None
         # Preserve a session for the client (httpx.Client)
         self.client = None
-        # In case we need to login
-        self.access_token = None
 
         self.charts_response = None
-        self.charts = []  # {ID: data}
+        self.charts = chart_registry()  # {ID: SupersetChart}
+        # Columns requested when loading the charts (None = all)
+        self.charts_columns = None
 
         self.datasets_response = None
-        self.datasets = []  # {ID: data}
+        self.datasets = dataset_registry()  # {ID: SupersetDataset}
+        self.datasets_columns = None
 
         self.databases_response = None
         self.databases = []  # {ID: data}
 
-    def load_datasets(self, force=False):
-        """ Get and load all datasets """
-        log.info("Loading datasets")
-        if self.datasets and not force:
-            return
-
-        q_data = {"page_size": 20, "page": 0}
-        self.datasets = []
+    def get_all_pages(self, endpoint, q_data):
+        """ Get every page of a Superset list endpoint.
+            Reads `count` from the first page and fetches the remaining pages
+            concurrently (see ckanext.superset.concurrency).
+            Returns the first response and all the results, in order
+        """
+        q_data = dict(q_data, page=0)
+        first = self.get(endpoint, params={'q': json.dumps(q_data)})
+        results = list(first.get("result", []))
+        page_size, pages = remaining_pages(first, q_data["page_size"])
+        if not pages:
+            return first, results
+
+        q_data["page_size"] = page_size
+
+        def get_page(page):
+            response = self.get(endpoint, params={'q': json.dumps(dict(q_data, page=page))})
+            return response.get("result", [])
+
+        log.info(f"Getting {len(pages)} more pages from {endpoint}")
+        with ThreadPoolExecutor(max_workers=min(get_concurrency(), len(pages))) as pool:
+            for page_results in pool.map(get_page, pages):
+                results.extend(page_results)
+        return first, results
+
+    def load_catalog(self, resource_type, columns=None, force=False):
+        """ Get all the rows of a Superset list endpoint (chart, dataset),
+            reading through the local catalog cache (see data/catalog.py).
+            Returns the list response (first page) and all the rows
+        """
+        if not force:
+            rows = catalog.load(resource_type, columns)
+            if rows is None:
+                state = catalog.get_state(resource_type, columns)
+                if catalog.can_refresh_incrementally(state, columns):
+                    rows = self.refresh_catalog(resource_type, state, columns)
+            if rows is not None:
+                return {"count": len(rows), "result": rows}, rows
+
+        q_data = {"page_size": get_page_size(resource_type)}
+        if columns:
+            q_data["columns"] = columns
+        response, rows = self.get_all_pages(f"{resource_type}/", q_data)
+        catalog.save(resource_type, rows, columns)
+        return response, rows
+
+    def refresh_catalog(self, resource_type, state, columns=None):
+        """ Update the cached catalog with the objects changed since the last refresh """
+        log.info(f"Refreshing the {resource_type} catalog since {state.high_water_mark}")
+        changed = self.get_changed_since(resource_type, state.high_water_mark, columns)
+        existing_ids = self.get_all_ids(resource_type) if catalog.reconcile_due(state) else None
+        return catalog.merge(resource_type, changed, existing_ids)
+
+    def get_changed_since(self, resource_type, since, columns=None):
+        """ Get the objects changed since a (naive UTC) datetime.
+            Superset lists them newest first, we stop reading at the first older one
+        """
+        q_data = {
+            "page_size": get_page_size(resource_type),
+            "page": 0,
+            # Superset orders this column by changed_on
+            "order_column": "changed_on_delta_humanized",
+            "order_direction": "desc",
+        }
+        if columns:
+            q_data["columns"] = columns
+        changed = []
         while True:
-            params = {'q': json.dumps(q_data)}
-            self.datasets_response = self.get("dataset/", params=params)
-
-            if not self.datasets_response or not self.datasets_response.get("result", {}):
-                break
-
-            datasets = self.datasets_response.get("result", [])
-            self.datasets.extend(datasets)
-
-            # if we have less than page_size, we are done
-            if len(datasets) < q_data["page_size"]:
-                break
+            response = self.get(f"{resource_type}/", params={'q': json.dumps(q_data)})
+            rows = response.get("result", [])
+            for row in rows:
+                changed_on = catalog.parse_changed_on(row)
+                if changed_on and changed_on < since:
+                    return changed
+                changed.append(row)
+            if not rows or (q_data["page"] + 1) * len(rows) >= response.get("count", 0):
+                return changed
             q_data["page"] += 1
 
+    def get_charts_page(self, page=0, page_size=None, filters=None, order_column=None,
+                        order_direction='asc', columns=None):
+        """ Get a single page (0 based) of the charts list, without the catalog cache.
+            `filters` are Superset list filters ({col, opr, value})
+            Returns the list response and the SupersetChart objects in the page
+        """
+        q_data = {"page": page, "page_size": page_size or get_page_size("chart")}
+        columns = resolve_columns("chart", columns)
+        if columns:
+            q_data["columns"] = columns
+        if filters:
+            q_data["filters"] = filters
+        if order_column:
+            q_data["order_column"] = order_column
+            q_data["order_direction"] = order_direction
+        response = self.get("chart/", params={'q': json.dumps(q_data)})
+        charts = chart_registry()
+        for chart in response.get("result", []):
+            ds = SupersetChart(superset_instance=self)
+            ds.load(chart)
+            charts.add(ds)
+        return response, charts
+
+    def prefetch_charts(self, chart_ids, columns='sync'):
+        """ Load some charts with one filtered listing, so get_chart finds
+            them without a request per chart.
+            Returns the charts found (missing ones are not visible in Superset)
+        """
+        chart_ids = sorted({int(chart_id) for chart_id in chart_ids if str(chart_id).isdigit()})
+        charts = chart_registry()
+        if not chart_ids:
+            return charts
+        columns = resolve_columns("chart", columns)
+        rows = []
+        # A few IDs per request, they go in the query string
+        for start in range(0, len(chart_ids), MAX_ID_FILTER):
+            chunk = chart_ids[start:start + MAX_ID_FILTER]
+            q_data = {
+                "page_size": min(len(chunk), get_page_size("chart")),
+                "filters": [{"col": "id", "opr": "in", "value": chunk}],
+            }
+            if columns:
+                q_data["columns"] = columns
+            rows.extend(self.get_all_pages("chart/", q_data)[1])
+        for row in rows:
+            chart = SupersetChart(superset_instance=self)
+            chart.load(row)
+            charts.add(chart)
+        self.charts.extend(charts)
+        log.info(f"Prefetched {len(charts)} of {len(chart_ids)} charts")
+        return charts
+
+    def get_all_ids(self, resource_type):
+        """ Cheap listing with just the IDs of all the objects """
+        q_data = {"page_size": get_page_size(resource_type), "columns": ["id"]}
+        _, rows = self.get_all_pages(f"{resource_type}/", q_data)
+        return [row["id"] for row in rows]
+
+    def load_datasets(self, force=False, columns=None):
+        """ Get and load all datasets
+            `columns` limits the fields requested, a list or a preset name
+            (see data/columns.py). None for all the fields.
+        """
+        log.info("Loading datasets")
+        columns = resolve_columns("dataset", columns)
+        if self.datasets and not force and columns == self.datasets_columns:
+            return
+
+        self.datasets_response, datasets = self.load_catalog("dataset", columns, force=force)
+        self.datasets_columns = columns
+        self.datasets = dataset_registry()
+        for dataset in datasets:
+            ds = SupersetDataset(superset_instance=self)
+            ds.load(dataset)
+            self.datasets.add(ds)
         return self.datasets
 
-    def load_charts(self, force=False):
+    def load_charts(self, force=False, columns=None):
         """ Get and load all datasets
             Ver ckanext/superset/data/samples/chaerts.json
+            `columns` limits the fields requested, a list or a preset name
+            (see data/columns.py). None for all the fields.
         """
-        if self.charts and not force:
+        columns = resolve_columns("chart", columns)
+        if self.charts and not force and columns == self.charts_columns:
             return
 
-        q_data = {"page_size": 350, "page": 0}
-        while True:
-            params = {'q': json.dumps(q_data)}
-            self.charts_response = self.get("chart/", params=params)
-
-            if not self.charts_response or not self.charts_response.get("result", {}):
-                break
-
-            charts = self.charts_response.get("result", {})
-            for chart in charts:
-                ds = SupersetChart(superset_instance=self)
-                ds.load(chart)
-                self.charts.append(ds)
-            # if we have less than page_size, we are done
-            if len(charts) < q_data["page_size"]:
-                break
-            q_data["page"] += 1
+        self.charts_response, charts = self.load_catalog("chart", columns, force=force)
+        self.charts_columns = columns
+        self.charts = chart_registry()
+        for chart in charts:
+            ds = SupersetChart(superset_instance=self)
+            ds.load(chart)
+            self.charts.add(ds)
 
         return self.charts
 
@@ -110,49 +265,99 @@ class SupersetCKAN:
         if self.databases and not force:
             return self.databases
 
-        self.databases_response = self.get("database/")
-        self.databases = sorted(
-            self.databases_response.get("result", []),
-            key=lambda x: x["id"]
-        )
+        databases = None if force else catalog.load("database")
+        if databases is None:
+            self.databases_response = self.get("database/")
+            databases = self.databases_response.get("result", [])
+            catalog.save("database", databases)
+        else:
+            self.databases_response = {"count": len(databases), "result": databases}
+        self.databases = sorted(databases, key=lambda x: x["id"])
 
         return self.databases
 
     def get_dataset(self, dataset_id):
         """ Get a dataset by ID """
-        for dataset in self.datasets:
-            if dataset.id == dataset_id:
-                return dataset
+        dataset = self.datasets.get(dataset_id)
+        if dataset:
+            return dataset
         # Get from the API
         dataset = SupersetDataset(superset_instance=self)
         dataset.get_from_superset(dataset_id)
-        self.datasets.append(dataset)
-        return dataset
+        return self.datasets.add(dataset)
 
     def get_chart(self, chart_id):
         """ Get a chart by ID """
-        for chart in self.charts:
-            if chart.id == chart_id:
-                return chart
+        chart = self.charts.get(chart_id)
+        if chart:
+            return chart
         # Get from the API
         chart = SupersetChart(superset_instance=self)
         chart.get_from_superset(chart_id)
-        self.charts.append(chart)
-        return chart
+        return self.charts.add(chart)
 
     def get_databases(self):
         """ Get a list_database """
         # Get from the API
-        self.load_databases(self)
+        self.load_databases()
         return self.databases
 
-    def get_datasets(self):
+    def get_datasets(self, columns=None):
         """ Get a list_dataset """
         # Get from the API
-        self.load_datasets(self)
+        self.load_datasets(columns=columns)
         return self.datasets
 
+    @property
+    def session_key(self):
+        """ Connection settings identifying the shared session to use """
+        return (
+            self.superset_url, self.superset_user, self.superset_pass,
+            self.superset_provider, self.superset_refresh,
+            self.proxy_url, self.proxy_port, self.proxy_user, self.proxy_pass,
+        )
+
     def prepare_connection(self):
+        """ Attach to the shared session for our settings, login if nobody did it yet """
+        session = get_session(self.session_key)
+        with session.lock:
+            self.session = session
+            if not session.connected:
+                self.connect()
+                session.client = self.client
+            elif session.needs_refresh():
+                self.client = session.client
+                self.renew_login()
+            self.client = session.client
+        return self.client
+
+    def reconnect(self, stale_token=None):
+        """ Superset rejected `stale_token`: refresh it or login again """
+        session = self.session or get_session(self.session_key)
+        with session.lock:
+            if session.connected and session.access_token != stale_token:
+                # Another thread already renewed it
+                self.session = session
+                self.client = session.client
+                return self.client
+            if session.connected:
+                self.session = session
+                self.client = session.client
+                self.renew_login()
+                return self.client
+        self.client = None
+        return self.prepare_connection()
+
+    def renew_login(self):
+        """ Get a new access token with the refresh token, login again if that fails """
+        if self.refresh_access_token():
+            return
+        self.session.invalidate(self.client, stored=True)
+        self.client = None
+        self.connect()
+        self.session.client = self.client
+
+    def connect(self):
         """ Define the client and login if required """
         log.info(f"Connecting to {self.superset_url}")
         if self.proxy_url:
@@ -164,62 +369,109 @@ class SupersetCKAN:
 
         # If we have a user, then we need to login
         if self.superset_user:
-            # prepare a user session
-            # For some reason we need the API token AND the session cookie
-            log.info(f"Logging Superset in as {self.superset_user}")
-            # Get an access token for the API (works for data but not for CSV)
-            login_url = f"{self.superset_url}/api/v1/security/login"
-            login_response, error = self.request("POST", login_url, json=self.login_payload)
-            if not login_response:
-                raise SupersetRequestException(error)
-            data = login_response.json()
-            if "access_token" not in data:
-                error = f"Error getting access token from Superset: {data}"
-                log.critical(error)
-                raise SupersetRequestException(error)
-
-            self.access_token = data["access_token"]
-
-            # Get a session for the user (works for CSV)
-            # POST to /login/ form with the username and password
-            login_url = f"{self.superset_url}/login/"
-            # Get the CSRF token from the login page
-            # <input id="csrf_token" name="csrf_token" type="hidden" value="IjI1----">
-            login_response, error = self.request("GET", login_url)
-            if not login_response:
-                raise SupersetRequestException(error)
-
-            csrf_token = login_response.text.split('csrf_token" type="hidden" value="')[1].split('"')[0]
-            data = {
-                "username": self.superset_user,
-                "password": self.superset_pass,
-                "csrf_token": csrf_token
-            }
-            login_response, error = self.request("POST", login_url, data=data)
-            if not login_response:
-                raise SupersetRequestException(error)
-            # Get expect a 302 redirect to /
-            if login_response.status_code != 302:
-                error = f"Unexpected status code: {login_response.status_code} from Superset login"
-                log.critical(error)
-                login_response.raise_for_status()
-            # Save cookies from the login response
-            self.client.cookies.update(login_response.cookies)
+            self.authenticate()
 
         return self.client
 
+    def authenticate(self):
+        """ Reuse the login stored by other process or login to Superset """
+        if self.session.restore():
+            self.client.cookies.update(self.session.cookies)
+            if not self.session.needs_refresh() or self.refresh_access_token():
+                return
+        self.login()
+
+    def login(self):
+        """ Full login, save the tokens and the session cookie """
+        # prepare a user session
+        # For some reason we need the API token AND the session cookie
+        log.info(f"Logging Superset in as {self.superset_user}")
+        # Get an access token for the API (works for data but not for CSV)
+        login_url = f"{self.superset_url}/api/v1/security/login"
+        login_response, error = self.request("POST", login_url, json=self.login_payload)
+        if not login_response:
+            raise SupersetRequestException(error)
+        data = login_response.json()
+        if "access_token" not in data:
+            error = f"Error getting access token from Superset: {data}"
+            log.critical(error)
+            raise SupersetRequestException(error)
+
+        self.session.update_tokens(data["access_token"], data.get("refresh_token"))
+
+        # Get a session for the user (works for CSV)
+        # POST to /login/ form with the username and password
+        login_url = f"{self.superset_url}/login/"
+        # Get the CSRF token from the login page
+        # <input id="csrf_token" name="csrf_token" type="hidden" value="IjI1----">
+        login_response, error = self.request("GET", login_url)
+        if not login_response:
+            raise SupersetRequestException(error)
+
+        csrf_token = login_response.text.split('csrf_token" type="hidden" value="')[1].split('"')[0]
+        data = {
+            "username": self.superset_user,
+            "password": self.superset_pass,
+            "csrf_token": csrf_token
+        }
+        login_response, error = self.request("POST", login_url, data=data)
+        if not login_response:
+            raise SupersetRequestException(error)
+        # Get expect a 302 redirect to /
+        if login_response.status_code != 302:
+            error = f"Unexpected status code: {login_response.status_code} from Superset login"
+            log.critical(error)
+            login_response.raise_for_status()
+        # Save cookies from the login response
+        self.client.cookies.update(login_response.cookies)
+        self.session.cookies = {cookie.name: cookie.value for cookie in self.client.cookies.jar}
+        self.session.save()
+
+    def refresh_access_token(self):
+        """ Get a new access token using the refresh token.
+            Returns False if we need a full login
+        """
+        if not self.session.refresh_token:
+            return False
+        log.info("Refreshing the Superset access token")
+        url = f"{self.superset_url}/api/v1/security/refresh"
+        headers = {"Authorization": f"Bearer {self.session.refresh_token}"}
+        try:
+            response, error = self.request("POST", url, headers=headers)
+        except SupersetRequestException as e:
+            log.warning(f"Unable to refresh the Superset access token: {e}")
+            return False
+        data = response.json() if response else {}
+        if "access_token" not in data:
+            log.warning(f"Unable to refresh the Superset access token: {error or data}")
+            return False
+        self.session.update_tokens(data["access_token"])
+        self.session.save()
+        return True
+
+    @property
+    def access_token(self):
+        """ The current API token of the shared session """
+        return self.session.access_token if self.session else None
+
     def get(self, endpoint, timeout=30, format_='json', params=None):
         """ Get data from the Superset API
             parameter data is user as GET parameters. It must be a dictionary
         """
-        if not self.client:
+        if not self.client or self.session.needs_refresh():
             self.prepare_connection()
 
-        headers = self.get_headers(format_=format_)
-
         url = f'{self.superset_url}/api/v1/{endpoint}'
         log.info(f"Superset GET {url} :: {params}")
-        api_response, error = self.request("GET", url, headers=headers, params=params, timeout=timeout)
+        token = self.access_token
+        try:
+            headers = self.get_headers(format_=format_)
+            api_response, error = self.request("GET", url, headers=headers, params=params, timeout=timeout)
+        except SupersetAuthException:
+            # The token expired, renew it and retry once
+            self.reconnect(stale_token=token)
+            headers = self.get_headers(format_=format_)
+            api_response, error = self.request("GET", url, headers=headers, params=params, timeout=timeout)
         if not api_response:
             raise SupersetRequestException(error)
 
@@ -228,11 +480,15 @@ class SupersetCKAN:
         elif format_ == 'json':
             return api_response.json()
         elif format_ == 'image':  # Thumbnail images
+            if api_response.status_code == 202:
+                # Superset is computing it in the background
+                raise SupersetPendingException(f"Superset is still computing {endpoint}")
             return api_response.content
 
     def request(self, method, url, **kwargs):
         """ Perform an HTTP request safely with detailed error handling
-            Returns the response and None if successful, otherwise None and an error message
+            Returns the response and None if successful, otherwise raises
+            SupersetRequestException (SupersetAuthException for a 401)
         """
         try:
             if method == "GET":
@@ -247,20 +503,62 @@ class SupersetCKAN:
 
             response.raise_for_status()
             return response, None
-        except httpx.HTTPStatusError as e:
-            error = f"HTTP error {e.response.status_code} while accessing Superset."
-            self.handle_error(url, e, error)
-        except httpx.ConnectError as e:
+        except Exception as e:
+            self.handle_request_exception(url, e)
+
+    def download(self, endpoint, fileobj, timeout=300, format_='csv', params=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """ Stream a file from the Superset API into `fileobj`, one chunk at a time,
+            so big exports are never fully loaded in memory.
+            Returns the size in bytes and the SHA-256 hex digest of the content
+        """
+        if not self.client or self.session.needs_refresh():
+            self.prepare_connection()
+
+        url = f'{self.superset_url}/api/v1/{endpoint}'
+        log.info(f"Superset download {url} :: {params}")
+        token = self.access_token
+        start = fileobj.tell()
+        try:
+            return self._download(url, fileobj, timeout, format_, params, chunk_size)
+        except SupersetAuthException:
+            # The token expired, renew it and retry once from the start
+            self.reconnect(stale_token=token)
+            fileobj.seek(start)
+            fileobj.truncate()
+            return self._download(url, fileobj, timeout, format_, params, chunk_size)
+
+    def _download(self, url, fileobj, timeout, format_, params, chunk_size):
+        headers = self.get_headers(format_=format_)
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with self.client.stream("GET", url, headers=headers, params=params, timeout=timeout) as response:
+                response.raise_for_status()
+                # iter_bytes decodes the gzip / br content encoding
+                for chunk in response.iter_bytes(chunk_size):
+                    fileobj.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+        except Exception as e:
+            self.handle_request_exception(url, e)
+        fileobj.flush()
+        log.info(f"Downloaded {size} bytes from {url}")
+        return size, sha256.hexdigest()
+
+    def handle_request_exception(self, url, exception):
+        """ Raise the right exception for a failed request to Superset """
+        if isinstance(exception, httpx.HTTPStatusError):
+            if exception.response.status_code == 401:
+                log.warning(f"Superset rejected our credentials for {url}")
+                raise SupersetAuthException("Superset session expired or invalid.") from exception
+            error = f"HTTP error {exception.response.status_code} while accessing Superset."
+        elif isinstance(exception, httpx.ConnectError):
             error = "Failed to connect to Superset."
-            self.handle_error(url, e, error)
-        except httpx.TimeoutException as e:
+        elif isinstance(exception, httpx.TimeoutException):
             error = "Request to Superset timed out."
-            self.handle_error(url, e, error)
-        except Exception as e:
+        else:
             error = "An unexpected error occurred while communicating with Superset."
-            self.handle_error(url, e, error)
-
-        return None, error
+        self.handle_error(url, exception, error)
 
     def handle_error(self, url, exception, public_message):
         """ Log detailed error information and raise an exception """
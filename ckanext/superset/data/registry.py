@@ -0,0 +1,115 @@
+"""
+Registries of Superset objects (charts, datasets) keyed by ID, with
+secondary indexes, so lookups do not scan the whole catalog.
+"""
+from collections import defaultdict
+
+
+class SupersetRegistry:
+    """ Superset objects by ID (in insertion order) plus secondary indexes.
+
+    `indexes` maps an index name to a function returning the value (or list
+    of values) an object is indexed by.
+    IDs are compared as strings: Superset returns integers, URLs give strings.
+    """
+
+    def __init__(self, indexes=None):
+        self.indexes = indexes or {}
+        self._by_id = {}
+        self._index_data = {name: defaultdict(dict) for name in self.indexes}
+
+    @staticmethod
+    def key(object_id):
+        return str(object_id)
+
+    def _index_values(self, name, obj):
+        value = self.indexes[name](obj)
+        if value is None:
+            return []
+        if isinstance(value, (list, tuple, set)):
+            return [self.key(v) for v in value if v is not None]
+        return [self.key(value)]
+
+    def _unindex(self, key, obj):
+        for name in self.indexes:
+            for value in self._index_values(name, obj):
+                self._index_data[name][value].pop(key, None)
+
+    def add(self, obj):
+        """ Add an object, or replace it keeping its position """
+        key = self.key(obj.id)
+        previous = self._by_id.get(key)
+        if previous is not None:
+            self._unindex(key, previous)
+        self._by_id[key] = obj
+        for name in self.indexes:
+            for value in self._index_values(name, obj):
+                self._index_data[name][value][key] = obj
+        return obj
+
+    def extend(self, objs):
+        for obj in objs:
+            self.add(obj)
+
+    def remove(self, object_id):
+        key = self.key(object_id)
+        obj = self._by_id.pop(key, None)
+        if obj is not None:
+            self._unindex(key, obj)
+        return obj
+
+    def get(self, object_id, default=None):
+        return self._by_id.get(self.key(object_id), default)
+
+    def by(self, index, value):
+        """ Objects with `value` in the `index` secondary index """
+        return list(self._index_data[index].get(self.key(value), {}).values())
+
+    def values_of(self, index):
+        """ All the values of a secondary index """
+        return [value for value, objs in self._index_data[index].items() if objs]
+
+    def ids(self):
+        return list(self._by_id)
+
+    def clear(self):
+        self._by_id.clear()
+        for data in self._index_data.values():
+            data.clear()
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, object_id):
+        return self.key(object_id) in self._by_id
+
+
+def _dashboard_ids(chart):
+    return [dashboard.get('id') for dashboard in chart['dashboards'] or []]
+
+
+def _database_id(dataset):
+    database = dataset['database']
+    return database.get('id') if isinstance(database, dict) else None
+
+
+CHART_INDEXES = {
+    'viz_type': lambda chart: chart['viz_type'],
+    'datasource_id': lambda chart: chart['datasource_id'],
+    'dashboard_id': _dashboard_ids,
+}
+
+DATASET_INDEXES = {
+    'database_id': _database_id,
+}
+
+
+def chart_registry():
+    return SupersetRegistry(CHART_INDEXES)
+
+
+def dataset_registry():
+    return SupersetRegistry(DATASET_INDEXES)
@@ -0,0 +1,347 @@
+"""
+Sync schedule table (superset_sync_schedule).
+
+The sync extras of each dataset (see data/sync.py) are copied to one row of
+an indexed table, so finding the datasets due for a sync is an index range
+scan instead of three subqueries over the whole PackageExtra table.
+The extras are still the source of truth: the row is rewritten from them
+every time update_sync_settings or a sync changes them.
+
+Several nodes can run the due syncs (run-due-syncs or the scheduler daemon):
+each one claims the due rows with a lease (claim_due, SELECT ... FOR UPDATE
+SKIP LOCKED) so a package is synced by one node only. The lease is released
+when the sync result is saved, or expires if the node dies.
+
+Next sync times are spread (see spread_next_sync) so datasets configured or
+synced together do not hit Superset at the same minute every day:
+- each package gets a fixed, deterministic time of day (a hash of its ID),
+  inside the preferred time windows (ckanext.superset.sync.windows)
+- a time slot with ckanext.superset.sync.max_per_slot syncs already
+  scheduled is full, the sync moves to the next free slot
+"""
+import hashlib
+import logging
+import os
+import re
+import socket
+from datetime import datetime, time, timedelta, timezone
+
+from sqlalchemy import or_
+from sqlalchemy.exc import SQLAlchemyError
+from ckan import model
+from ckan.plugins.toolkit import asbool, asint, config
+
+from ckanext.superset.model import SupersetSyncSchedule
+
+
+log = logging.getLogger(__name__)
+
+
+def to_naive_utc(value):
+    """ A datetime (or an ISO-8601 string) as a naive UTC datetime, or None """
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if value is None:
+        return None
+    if value.tzinfo:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def save_schedule(package_dict, duration=None, release=False):
+    """ Copy the sync extras of a package to its schedule row.
+        `release` frees its lease (the sync is done).
+        Returns the row, or None if the schedule table is not available
+    """
+    # Local import: data/sync.py uses this module
+    from ckanext.superset.data import sync
+
+    def extra(key):
+        return sync.get_extra(package_dict, key)
+
+    try:
+        row = model.Session.get(SupersetSyncSchedule, package_dict['id'])
+        if row is None:
+            row = SupersetSyncSchedule(package_id=package_dict['id'])
+            model.Session.add(row)
+        row.chart_id = extra(sync.EXTRA_CHART_ID)
+        row.frequency = extra(sync.EXTRA_FREQUENCY)
+        row.enabled = extra(sync.EXTRA_ENABLED) == 'true'
+        row.next_sync = to_naive_utc(extra(sync.EXTRA_NEXT_SYNC))
+        row.last_sync = to_naive_utc(extra(sync.EXTRA_LAST_SYNC))
+        row.last_status = extra(sync.EXTRA_LAST_STATUS)
+        if duration is not None:
+            row.last_duration = duration
+        if release:
+            row.leased_by = None
+            row.lease_expires = None
+        row.modified = datetime.utcnow()
+        model.Session.commit()
+    except SQLAlchemyError as e:
+        model.Session.rollback()
+        log.warning(f"Unable to save the Superset sync schedule of {package_dict['id']} "
+                    f"(run `ckan db upgrade -p superset`): {e}")
+        return None
+    return row
+
+
+def find_due(now=None, package_ids=None):
+    """ IDs of the active packages whose next sync time has arrived,
+        only among `package_ids` if given.
+        Raises SQLAlchemyError if the schedule table is not available
+    """
+    now = to_naive_utc(now or datetime.now(timezone.utc))
+    S = SupersetSyncSchedule
+    query = model.Session.query(S.package_id).join(
+        model.Package, model.Package.id == S.package_id
+    ).filter(
+        S.enabled.is_(True),
+        S.next_sync <= now,
+        S.chart_id.isnot(None),
+        model.Package.state == 'active',
+    )
+    if package_ids is not None:
+        query = query.filter(S.package_id.in_(list(package_ids)))
+    rows = query.order_by(S.next_sync).all()
+    return [r[0] for r in rows]
+
+
+def get_lease_seconds():
+    """ How long a node can take to sync a claimed package before others can claim it """
+    return asint(config.get('ckanext.superset.sync.lease_seconds', 60 * 60))
+
+
+def lease_owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim_due(now=None, package_ids=None, limit=None):
+    """ Lease the due packages (see find_due) not leased by another node.
+        The rows are locked with FOR UPDATE SKIP LOCKED: nodes claiming at the
+        same time get different packages. Expired leases (a node that died
+        while syncing) are claimed again.
+        Returns the claimed package IDs.
+        Raises SQLAlchemyError if the schedule table is not available
+    """
+    now = to_naive_utc(now or datetime.now(timezone.utc))
+    S = SupersetSyncSchedule
+    query = model.Session.query(S).join(
+        model.Package, model.Package.id == S.package_id
+    ).filter(
+        S.enabled.is_(True),
+        S.next_sync <= now,
+        S.chart_id.isnot(None),
+        model.Package.state == 'active',
+        or_(S.lease_expires.is_(None), S.lease_expires <= now),
+    )
+    if package_ids is not None:
+        query = query.filter(S.package_id.in_(list(package_ids)))
+    query = query.order_by(S.next_sync)
+    if limit:
+        query = query.limit(limit)
+    try:
+        # Lock only the schedule rows, not the packages
+        rows = query.with_for_update(skip_locked=True, of=S).all()
+        owner = lease_owner()
+        expires = now + timedelta(seconds=get_lease_seconds())
+        for row in rows:
+            row.leased_by = owner
+            row.lease_expires = expires
+        package_ids = [row.package_id for row in rows]
+        model.Session.commit()
+    except SQLAlchemyError:
+        model.Session.rollback()
+        raise
+    if package_ids:
+        log.info(f"Claimed {len(package_ids)} due sync(s) until {expires} as {owner}")
+    return package_ids
+
+
+def release_leases(package_ids, mine=True):
+    """ Free the leases this node holds on packages it will not sync after all
+        (e.g. Superset is down), so any node can claim them again.
+        `mine=False` frees them whoever claimed them (e.g. a background job
+        ending the sync of packages claimed by the command that enqueued it)
+    """
+    package_ids = list(package_ids)
+    if not package_ids:
+        return
+    S = SupersetSyncSchedule
+    query = model.Session.query(S).filter(S.package_id.in_(package_ids))
+    if mine:
+        query = query.filter(S.leased_by == lease_owner())
+    try:
+        query.update({S.leased_by: None, S.lease_expires: None}, synchronize_session=False)
+        model.Session.commit()
+    except SQLAlchemyError as e:
+        model.Session.rollback()
+        log.warning(f"Unable to release the sync leases of {package_ids}: {e}")
+        return
+    log.info(f"Released the sync leases of {len(package_ids)} package(s)")
+
+
+def get_changes(modified_since=None):
+    """ Schedule rows (all of them, or those modified since a naive UTC datetime)
+        as (package_id, chart_id, enabled, next_sync, modified, package state)
+        named tuples, for the scheduler daemon.
+        Raises SQLAlchemyError if the schedule table is not available
+    """
+    S = SupersetSyncSchedule
+    query = model.Session.query(
+        S.package_id, S.chart_id, S.enabled, S.next_sync, S.modified, model.Package.state,
+    ).join(model.Package, model.Package.id == S.package_id)
+    if modified_since is not None:
+        # >=: rows saved in the same instant as the last one seen are read again
+        query = query.filter(S.modified >= modified_since)
+    return query.all()
+
+
+def get_chart_ids(package_ids):
+    """ Map package IDs to their chart ID, from the schedule table """
+    package_ids = list(package_ids)
+    if not package_ids:
+        return {}
+    S = SupersetSyncSchedule
+    rows = model.Session.query(S.package_id, S.chart_id).filter(
+        S.package_id.in_(package_ids),
+        S.chart_id.isnot(None),
+    ).all()
+    return dict(rows)
+
+
+DAY_SECONDS = 24 * 60 * 60
+WINDOW_RE = re.compile(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$')
+
+
+def spread_enabled():
+    return asbool(config.get('ckanext.superset.sync.spread', True))
+
+
+def get_slot_size():
+    """ Length of a time slot in seconds """
+    return max(asint(config.get('ckanext.superset.sync.slot_size', 15)), 1) * 60
+
+
+def get_max_per_slot():
+    """ Max syncs scheduled in a time slot, 0 for no limit """
+    return asint(config.get('ckanext.superset.sync.max_per_slot', 0))
+
+
+def parse_windows(value):
+    """ Parse "HH:MM-HH:MM HH:MM-HH:MM" (UTC, a window can cross midnight)
+        into sorted (start, end) seconds of the day. The whole day if empty.
+        Raises ValueError for invalid windows
+    """
+    windows = []
+    for window in (value or '').replace(',', ' ').split():
+        match = WINDOW_RE.match(window)
+        if not match:
+            raise ValueError(f"Invalid sync window: {window}")
+        h1, m1, h2, m2 = (int(part) for part in match.groups())
+        if h1 > 24 or h2 > 24 or m1 > 59 or m2 > 59:
+            raise ValueError(f"Invalid sync window: {window}")
+        start, end = (h1 * 60 + m1) * 60, (h2 * 60 + m2) * 60
+        if start < end:
+            windows.append((start, end))
+        elif start > end:
+            # Crosses midnight
+            windows.extend([(start, DAY_SECONDS), (0, end)])
+    return sorted(windows) or [(0, DAY_SECONDS)]
+
+
+def get_windows():
+    try:
+        return parse_windows(config.get('ckanext.superset.sync.windows'))
+    except ValueError as e:
+        log.error(f"{e}, syncs can be scheduled at any time")
+        return [(0, DAY_SECONDS)]
+
+
+def package_time_of_day(package_id, windows=None):
+    """ The (deterministic) second of the day to sync a package, inside the windows """
+    windows = windows or get_windows()
+    total = sum(end - start for start, end in windows)
+    offset = int(hashlib.sha256(str(package_id).encode('utf-8')).hexdigest(), 16) % total
+    for start, end in windows:
+        if offset < end - start:
+            return start + offset
+        offset -= end - start
+    return windows[0][0]
+
+
+def _at(day, seconds):
+    return datetime.combine(day, time(0), tzinfo=timezone.utc) + timedelta(seconds=seconds)
+
+
+def _in_windows(when, windows):
+    seconds = when.hour * 3600 + when.minute * 60 + when.second
+    return any(start <= seconds < end for start, end in windows)
+
+
+def _next_window_start(when, windows):
+    """ The first window start after `when` """
+    for day in (when.date(), when.date() + timedelta(days=1)):
+        for start, _ in windows:
+            candidate = _at(day, start)
+            if candidate > when:
+                return candidate
+    return when
+
+
+def count_scheduled(start, end, exclude_package_id=None):
+    """ Number of enabled syncs scheduled in [start, end) """
+    S = SupersetSyncSchedule
+    query = model.Session.query(S.package_id).filter(
+        S.enabled.is_(True),
+        S.next_sync >= to_naive_utc(start),
+        S.next_sync < to_naive_utc(end),
+    )
+    if exclude_package_id:
+        query = query.filter(S.package_id != exclude_package_id)
+    return query.count()
+
+
+def _first_free_slot(package_id, when, windows):
+    """ Move `when` to the first time slot with room for one more sync """
+    max_per_slot = get_max_per_slot()
+    if max_per_slot <= 0:
+        return when
+    slot_size = get_slot_size()
+    candidate = when
+    # Look one day ahead at most
+    for _ in range(DAY_SECONDS // slot_size + 1):
+        epoch = int(candidate.timestamp())
+        slot_start = datetime.fromtimestamp(epoch - epoch % slot_size, timezone.utc)
+        if count_scheduled(slot_start, slot_start + timedelta(seconds=slot_size), package_id) < max_per_slot:
+            return candidate
+        candidate = slot_start + timedelta(seconds=slot_size)
+        if not _in_windows(candidate, windows):
+            candidate = _next_window_start(candidate, windows)
+    log.warning(f"Every sync slot is full, scheduling {package_id} at {when}")
+    return when
+
+
+def spread_next_sync(package_id, base, delta):
+    """ The time near `base` (the next sync without spreading) to sync a package:
+        its own time of day, inside the windows, in a slot with room.
+        `delta` is the sync interval, the result is at most half of it (and
+        at most 12 hours) away from `base`, before the slot limit applies
+    """
+    windows = get_windows()
+    base = base.astimezone(timezone.utc)
+    tolerance = min(delta / 2, timedelta(hours=12))
+    seconds = package_time_of_day(package_id, windows)
+    candidates = [_at(base.date() + timedelta(days=days), seconds) for days in (-1, 0, 1)]
+    # The package time of day closest to base, inside the tolerance
+    when = min(candidates, key=lambda candidate: abs(candidate - base))
+    if abs(when - base) > tolerance:
+        when = base
+    try:
+        return _first_free_slot(package_id, when, windows)
+    except SQLAlchemyError as e:
+        model.Session.rollback()
+        log.warning(f"Unable to check the sync slots (run `ckan db upgrade -p superset`): {e}")
+        return when
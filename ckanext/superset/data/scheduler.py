@@ -0,0 +1,208 @@
+"""
+Long-running sync scheduler (`ckan superset scheduler`).
+
+Instead of a cron running `ckan superset run-due-syncs` (a due query every
+time), the daemon loads the schedule table once into a heap ordered by next
+sync time, sleeps until the first item is due and syncs it with a pool of
+threads (see sync_runner.run_group).
+Changes (new settings, synced datasets) are read incrementally: only the
+schedule rows modified since the last poll, every `poll_interval` seconds.
+The whole schedule is reloaded every `reload_interval` seconds, to catch
+deleted datasets.
+Several schedulers (one per node) can run at once: due packages are leased
+before they are synced (schedule.claim_due), a package leased by another
+node is dropped from the queue until its row changes.
+
+Heap items are never updated in place: a changed package gets a new item and
+the old one is ignored when popped (its time is not the package's anymore).
+`modified` is stamped by the process saving the row, before its commit: a
+row can become visible after a later one was polled (a slow commit, the clock
+of another node). So the polls read again the rows modified in the last
+`overlap` seconds before the last one seen: rows already applied (same
+next_sync and modified) are skipped, so a package popped but not claimed is
+not queued again until its row changes.
+"""
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from ckan import model
+
+from ckanext.superset.data import schedule, sync_runner
+from ckanext.superset.exceptions import SupersetRequestException
+
+
+log = logging.getLogger(__name__)
+
+
+class SyncScheduler:
+    """ Run the periodic syncs as they become due
+
+        scheduler = SyncScheduler(workers=4)
+        scheduler.run()  # until scheduler.stop()
+    """
+
+    def __init__(self, workers=4, poll_interval=60, reload_interval=60 * 60, force=False, on_result=None,
+                 overlap=60):
+        self.workers = max(workers, 1)
+        self.poll_interval = poll_interval
+        self.reload_interval = reload_interval
+        # Seconds read again before the last modified row on each poll
+        self.overlap = overlap
+        self.force = force
+        # Called (in a worker thread) with the result of each sync
+        self.on_result = on_result
+        # (next_sync, package_id), naive UTC
+        self.heap = []
+        # package_id: next_sync of its valid heap item
+        self.next_syncs = {}
+        self.chart_ids = {}
+        # package_id: (next_sync, modified) of the last row applied
+        self.seen = {}
+        # Packages being synced, not dispatched again meanwhile
+        self.running = set()
+        self.lock = threading.Lock()
+        self.last_modified = None
+        self.last_reload = None
+        self.stopping = threading.Event()
+
+    def _set(self, row):
+        """ Add, move or remove a package from the queue from its schedule row """
+        if self.seen.get(row.package_id) == (row.next_sync, row.modified):
+            # Unchanged since we read it
+            return
+        self.seen[row.package_id] = (row.next_sync, row.modified)
+        if self.last_modified is None or row.modified > self.last_modified:
+            self.last_modified = row.modified
+        if row.enabled and row.next_sync and row.chart_id and row.state == 'active':
+            self.chart_ids[row.package_id] = row.chart_id
+            if self.next_syncs.get(row.package_id) != row.next_sync:
+                self.next_syncs[row.package_id] = row.next_sync
+                heapq.heappush(self.heap, (row.next_sync, row.package_id))
+        else:
+            self.next_syncs.pop(row.package_id, None)
+            self.chart_ids.pop(row.package_id, None)
+
+    def load(self):
+        """ Read the whole schedule """
+        self.heap = []
+        self.next_syncs = {}
+        self.chart_ids = {}
+        self.seen = {}
+        self.last_modified = None
+        for row in schedule.get_changes():
+            self._set(row)
+        self.last_reload = time.monotonic()
+        log.info(f"Sync scheduler loaded {len(self.next_syncs)} scheduled dataset(s)")
+
+    def refresh(self):
+        """ Read the schedule rows changed since the last poll (or all of them, now and then) """
+        if self.last_reload is None or time.monotonic() - self.last_reload >= self.reload_interval:
+            self.load()
+            return
+        since = self.last_modified - timedelta(seconds=self.overlap) if self.last_modified else None
+        for row in schedule.get_changes(modified_since=since):
+            self._set(row)
+
+    def pop_due(self, now=None):
+        """ IDs of the packages due at `now`, removed from the queue """
+        now = schedule.to_naive_utc(now or datetime.now(timezone.utc))
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            next_sync, package_id = heapq.heappop(self.heap)
+            if self.next_syncs.get(package_id) != next_sync:
+                # Stale item, the package was moved or removed
+                continue
+            del self.next_syncs[package_id]
+            with self.lock:
+                if package_id in self.running:
+                    continue
+            due.append(package_id)
+        return due
+
+    def seconds_to_next(self, now=None):
+        """ Seconds until the first item in the queue is due (at most poll_interval) """
+        if not self.heap:
+            return self.poll_interval
+        now = schedule.to_naive_utc(now or datetime.now(timezone.utc))
+        return min(max((self.heap[0][0] - now).total_seconds(), 0), self.poll_interval)
+
+    def dispatch(self, pool, package_ids, now=None):
+        """ Sync the due packages in the pool, one task per chart. Returns the futures """
+        # The queue may be a poll behind, check with the database.
+        # Lease them: other nodes running a scheduler skip them
+        package_ids = schedule.claim_due(now, package_ids=package_ids) if package_ids else []
+        if not package_ids:
+            return []
+        chart_ids = {package_id: self.chart_ids.get(package_id) for package_id in package_ids}
+        try:
+            superset = sync_runner.get_superset(set(filter(None, chart_ids.values())))
+        except SupersetRequestException:
+            # Do not keep them leased while Superset is down, try again on the next poll
+            schedule.release_leases(package_ids)
+            self._retry_later(package_ids, now)
+            raise
+        app = current_app._get_current_object()
+        futures = []
+        for group in sync_runner.group_by_chart(package_ids, chart_ids):
+            with self.lock:
+                self.running.update(group)
+            future = pool.submit(sync_runner.run_group, app, group, superset, self.force)
+            future.add_done_callback(lambda future, group=group: self._done(group, future))
+            futures.append(future)
+        log.info(f"Dispatched {len(package_ids)} due sync(s) in {len(futures)} task(s)")
+        return futures
+
+    def _retry_later(self, package_ids, now=None):
+        """ Queue popped packages again, one poll later """
+        now = schedule.to_naive_utc(now or datetime.now(timezone.utc))
+        retry_at = now + timedelta(seconds=self.poll_interval)
+        for package_id in package_ids:
+            self.next_syncs[package_id] = retry_at
+            heapq.heappush(self.heap, (retry_at, package_id))
+
+    def _done(self, group, future):
+        with self.lock:
+            self.running.difference_update(group)
+        if future.exception() is not None:
+            log.error(f"Unable to sync {group}: {future.exception()}")
+            return
+        for result in future.result():
+            log.info(f"Synced {result['package_id']}: {result['status']} ({result['duration'] or 0:.1f}s)")
+            if self.on_result:
+                self.on_result(result)
+
+    def tick(self, pool, now=None):
+        """ One round: read the changes and dispatch the due syncs. Returns the futures """
+        try:
+            self.refresh()
+            return self.dispatch(pool, self.pop_due(now), now)
+        except SQLAlchemyError as e:
+            model.Session.rollback()
+            log.error(f"Unable to read the Superset sync schedule (run `ckan db upgrade -p superset`): {e}")
+            return []
+        except SupersetRequestException as e:
+            # e.g. Superset is down: the leases were released, the syncs are
+            # dispatched again on the next poll
+            log.error(f"Unable to connect to Superset to run the due syncs: {e}")
+            return []
+        finally:
+            # Do not keep a transaction open while sleeping, the next poll must see new rows
+            model.Session.remove()
+
+    def run(self):
+        """ Run until stop() is called, then wait for the running syncs """
+        log.info(f"Sync scheduler started with {self.workers} worker(s)")
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='superset-scheduler') as pool:
+            while not self.stopping.is_set():
+                self.tick(pool)
+                self.stopping.wait(self.seconds_to_next())
+        log.info("Sync scheduler stopped")
+
+    def stop(self):
+        self.stopping.set()
@@ -0,0 +1,197 @@
+"""
+Process-wide pool of authenticated Superset connections.
+
+Creating a SupersetCKAN is cheap, logging in to Superset is not (three
+requests). Every SupersetCKAN built with the same connection settings shares
+one SupersetSession: a keep-alive httpx.Client plus the login state (API
+access and refresh tokens and the session cookie).
+
+The login state is also saved in the CKAN Redis so other web and background
+workers reuse it instead of logging in on their own.
+A session is rebuilt when the settings change or when Superset rejects it.
+"""
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from ckan.plugins.toolkit import asbool, config
+
+
+log = logging.getLogger(__name__)
+
+# Refresh the access token this many seconds before it expires
+EXPIRY_MARGIN = 60
+# How long to keep a stored login when the tokens do not tell us
+DEFAULT_STORE_TTL = 24 * 60 * 60
+
+
+def token_expiry(token):
+    """ Return the `exp` claim (seconds since epoch) of a JWT, or None """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class SessionStore:
+    """ Keep the login state in the CKAN Redis, shared by all processes """
+
+    prefix = 'ckanext-superset:session:'
+
+    def __init__(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        self.redis_key = f'{self.prefix}{digest}'
+
+    @staticmethod
+    def enabled():
+        return asbool(config.get('ckanext.superset.session.shared', True))
+
+    @staticmethod
+    def _redis():
+        from ckan.lib.redis import connect_to_redis
+        return connect_to_redis()
+
+    def load(self):
+        if not self.enabled():
+            return None
+        try:
+            data = self._redis().get(self.redis_key)
+        except Exception as e:
+            log.warning(f"Unable to read the stored Superset session: {e}")
+            return None
+        return json.loads(data) if data else None
+
+    def save(self, data, ttl):
+        if not self.enabled():
+            return
+        try:
+            self._redis().set(self.redis_key, json.dumps(data), ex=max(int(ttl), 1))
+        except Exception as e:
+            log.warning(f"Unable to store the Superset session: {e}")
+
+    def delete(self):
+        if not self.enabled():
+            return
+        try:
+            self._redis().delete(self.redis_key)
+        except Exception as e:
+            log.warning(f"Unable to delete the stored Superset session: {e}")
+
+    @classmethod
+    def clear_all(cls):
+        """ Delete every stored Superset session """
+        redis = cls._redis()
+        for key in redis.scan_iter(f'{cls.prefix}*'):
+            redis.delete(key)
+
+
+class SupersetSession:
+    """ A shared httpx client and its login state """
+
+    def __init__(self, key):
+        self.key = key
+        # Held while logging in so concurrent threads wait for a single login
+        self.lock = threading.RLock()
+        self.client = None
+        self.access_token = None
+        self.refresh_token = None
+        self.expires_at = None
+        self.cookies = {}
+        self.store = SessionStore(key)
+
+    @property
+    def connected(self):
+        return self.client is not None
+
+    def needs_refresh(self):
+        """ The access token is expired (or about to) """
+        if not self.access_token or not self.expires_at:
+            return False
+        return time.time() >= self.expires_at - EXPIRY_MARGIN
+
+    def update_tokens(self, access_token, refresh_token=None):
+        self.access_token = access_token
+        self.expires_at = token_expiry(access_token)
+        if refresh_token:
+            self.refresh_token = refresh_token
+
+    def restore(self):
+        """ Load the login state saved by another process. Returns True if found """
+        data = self.store.load()
+        if not data or not data.get('access_token'):
+            return False
+        log.info("Reusing the stored Superset session")
+        self.update_tokens(data['access_token'], data.get('refresh_token'))
+        self.cookies = data.get('cookies') or {}
+        return True
+
+    def save(self):
+        """ Share the login state with other processes """
+        data = {
+            'access_token': self.access_token,
+            'refresh_token': self.refresh_token,
+            'cookies': self.cookies,
+        }
+        # Keep it while the refresh token is usable
+        expiry = token_expiry(self.refresh_token) or self.expires_at
+        ttl = expiry - time.time() if expiry else DEFAULT_STORE_TTL
+        self.store.save(data, ttl)
+
+    def invalidate(self, client=None, stored=False):
+        """ Forget the login state so the next user logs in again.
+            If `client` is given, only invalidate if it is still the current
+            one: another thread may have already reconnected.
+            The old client is not closed, other threads may still be using it.
+        """
+        with self.lock:
+            if client is not None and client is not self.client:
+                return
+            log.info("Invalidating shared Superset session")
+            self.client = None
+            self.access_token = None
+            self.refresh_token = None
+            self.expires_at = None
+            self.cookies = {}
+            if stored:
+                self.store.delete()
+
+    def close(self):
+        with self.lock:
+            client = self.client
+            self.invalidate()
+        if client is not None:
+            client.close()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(key):
+    """ Get (or create) the shared session for some connection settings """
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            # First use, or the settings changed: drop the outdated sessions
+            for stale in _sessions.values():
+                stale.invalidate()
+            _sessions.clear()
+            session = SupersetSession(key)
+            _sessions[key] = session
+    return session
+
+
+def clear_sessions(stored=False):
+    """ Close and forget all the shared sessions (and the stored ones) """
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+    if stored and SessionStore.enabled():
+        SessionStore.clear_all()
@@ -6,22 +6,30 @@ Sync state lives in package extras:
 - superset_sync_frequency    'daily' | 'weekly' | 'monthly'
 - superset_sync_enabled      'true' | 'false'
 - superset_last_sync         ISO-8601 UTC datetime of the last attempt
-- superset_last_sync_status  'ok' | 'error'
+- superset_last_sync_status  'ok' | 'unchanged' | 'error'
 - superset_last_sync_error   short text (truncated)
+- superset_last_sync_hash    SHA-256 of the last uploaded data, a sync
+                             downloading the same data skips the upload
 - superset_next_sync         ISO-8601 UTC datetime when the next run is due
 
 All defaults are absent: a dataset that has never been configured carries no
 sync extras and is invisible to the scheduler.
+
+The extras are copied to the indexed superset_sync_schedule table (see
+data/schedule.py), the scheduler reads that table.
 """
 import logging
-import tempfile
+import time
 from datetime import datetime, timedelta, timezone
 
-from werkzeug.datastructures import FileStorage
+from sqlalchemy.exc import SQLAlchemyError
 from ckan import model
 from ckan.plugins import plugin_loaded, toolkit as tk
 
 from ckanext.superset.config import get_config
+from ckanext.superset.data import schedule
+from ckanext.superset.data.downloads import download_chart
+from ckanext.superset.data.links import EXTRA_CHART_ID
 from ckanext.superset.data.main import SupersetCKAN
 from ckanext.superset.exceptions import SupersetRequestException
 
@@ -36,13 +44,19 @@ FREQUENCY_NONE = 'none'
 
 VALID_FREQUENCIES = (FREQUENCY_DAILY, FREQUENCY_WEEKLY, FREQUENCY_MONTHLY, FREQUENCY_NONE)
 
-EXTRA_CHART_ID = 'superset_chart_id'
 EXTRA_FREQUENCY = 'superset_sync_frequency'
 EXTRA_ENABLED = 'superset_sync_enabled'
 EXTRA_LAST_SYNC = 'superset_last_sync'
 EXTRA_LAST_STATUS = 'superset_last_sync_status'
 EXTRA_LAST_ERROR = 'superset_last_sync_error'
 EXTRA_NEXT_SYNC = 'superset_next_sync'
+EXTRA_LAST_HASH = 'superset_last_sync_hash'
+
+STATUS_OK = 'ok'
+# Superset returned the same data as the last sync, nothing was uploaded
+STATUS_UNCHANGED = 'unchanged'
+STATUS_ERROR = 'error'
+STATUSES = (STATUS_OK, STATUS_UNCHANGED, STATUS_ERROR)
 
 ACTIVITY_TYPE_SYNC_FAILED = 'superset sync failed'
 
@@ -53,12 +67,18 @@ _FREQUENCY_DELTAS = {
 }
 
 
-def calculate_next_sync(frequency, from_dt=None):
-    """ Return the datetime of the next run for a given frequency, or None. """
+def calculate_next_sync(frequency, from_dt=None, package_id=None):
+    """ Return the datetime of the next run for a given frequency, or None.
+
+    With a `package_id` the time is spread (see schedule.spread_next_sync):
+    the package time of day, inside the sync windows and the slot limit.
+    """
     delta = _FREQUENCY_DELTAS.get(frequency)
     if delta is None:
         return None
     base = from_dt or datetime.now(timezone.utc)
+    if package_id and schedule.spread_enabled():
+        return schedule.spread_next_sync(package_id, base + delta, delta)
     return base + delta
 
 
@@ -87,8 +107,8 @@ def merge_extras(package_dict, updates):
 def update_sync_settings(package_id, frequency, enabled, context):
     """ Persist user-chosen sync settings on a package.
 
-    Recomputes `superset_next_sync` so the scheduler picks it up (or stops
-    picking it up) immediately.
+    Recomputes `superset_next_sync` (and the schedule row, see data/schedule.py)
+    so the scheduler picks it up (or stops picking it up) immediately.
     """
     if frequency not in VALID_FREQUENCIES:
         raise tk.ValidationError({'frequency': [f'Invalid frequency: {frequency}']})
@@ -96,7 +116,7 @@ def update_sync_settings(package_id, frequency, enabled, context):
     package = tk.get_action('package_show')(context, {'id': package_id})
 
     if enabled and frequency != FREQUENCY_NONE:
-        next_sync = calculate_next_sync(frequency)
+        next_sync = calculate_next_sync(frequency, package_id=package['id'])
     else:
         next_sync = None
 
@@ -107,69 +127,164 @@ def update_sync_settings(package_id, frequency, enabled, context):
     }
 
     new_extras = merge_extras(package, updates)
-    tk.get_action('package_patch')(
+    updated = tk.get_action('package_patch')(
         context, {'id': package_id, 'extras': new_extras}
     )
+    schedule.save_schedule(updated)
     return {'frequency': frequency, 'enabled': enabled, 'next_sync': next_sync}
 
 
-def sync_dataset(package_id, context=None):
+def _site_context():
+    site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+    return {'ignore_auth': True, 'user': site_user['name']}
+
+
+def sync_dataset(package_id, context=None, force=False, superset=None):
     """ Pull the latest CSV from Superset and replace the dataset's resource.
 
+    `superset` is a SupersetCKAN client to reuse (a new one by default).
+
+    If the CSV is identical to the one uploaded by the last sync the resource
+    is not touched (no storage write, reindex or DataPusher / XLoader job)
+    and the outcome is 'unchanged', unless `force`.
+
     Records the outcome on the package extras and recomputes `next_sync` based
     on the package's current frequency setting.
     """
-    if context is None:
-        site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
-        ctx = {'ignore_auth': True, 'user': site_user['name']}
-    else:
-        ctx = context
+    ctx = _site_context() if context is None else context
     package = tk.get_action('package_show')(ctx, {'id': package_id})
+    return _sync_chart_packages(get_extra(package, EXTRA_CHART_ID), [package], ctx, force, superset)[0]
+
 
-    chart_id = get_extra(package, EXTRA_CHART_ID)
-    if not chart_id:
-        return _record_result(package, status='error', error='No superset_chart_id extra')
+def sync_packages(package_ids, force=False, superset=None):
+    """ Sync many packages, downloading the data of each chart only once.
 
+    Packages linked to the same chart (e.g. copies in several organizations)
+    get the same download. Each outcome is recorded as by sync_dataset.
+    Returns the result of each package
+    """
+    ctx = _site_context()
+    results = []
+    by_chart = {}
+    for package_id in package_ids:
+        try:
+            package = tk.get_action('package_show')(ctx, {'id': package_id})
+        except tk.ObjectNotFound:
+            # Nothing to record on the package, but do not keep it leased
+            schedule.release_leases([package_id], mine=False)
+            results.append(make_result(package_id, STATUS_ERROR, 'Dataset not found'))
+            continue
+        by_chart.setdefault(get_extra(package, EXTRA_CHART_ID), []).append(package)
+
+    for chart_id, packages in by_chart.items():
+        if chart_id and len(packages) > 1:
+            log.info(f"Syncing {len(packages)} packages from a single download of chart {chart_id}")
+        results.extend(_sync_chart_packages(chart_id, packages, ctx, force, superset))
+    return results
+
+
+def _get_sync_resource(package):
+    """ The resource a sync replaces, and an error if the package can not be synced """
+    if not get_extra(package, EXTRA_CHART_ID):
+        return None, 'No superset_chart_id extra'
     resources = package.get('resources', []) or []
     if not resources:
-        return _record_result(package, status='error', error='Dataset has no resources')
+        return None, 'Dataset has no resources'
     if len(resources) > 1:
-        return _record_result(package, status='error', error='Dataset has more than one resource')
-    resource = resources[0]
+        return None, 'Dataset has more than one resource'
+    return resources[0], None
+
 
+def _download(chart_id, superset=None):
+    """ Stream the chart CSV to a temporary file. Returns the ChartExport and an error """
     try:
-        cfg = get_config()
-        sc = SupersetCKAN(**cfg)
+        sc = superset or SupersetCKAN(**get_config())
         chart = sc.get_chart(chart_id)
-        csv_data = chart.get_chart_csv()
+        return download_chart(chart, 'csv'), None
     except SupersetRequestException as e:
         log.error(f"Superset error syncing chart {chart_id}: {e}")
-        return _record_result(package, status='error', error=str(e))
+        return None, str(e)
     except Exception as e:
         log.exception(f"Unexpected error syncing chart {chart_id}")
-        return _record_result(package, status='error', error=str(e))
+        return None, str(e)
 
-    f = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
-    f.write(csv_data)
-    f.close()
-    upload_file = FileStorage(filename=resource.get('name'), stream=open(f.name, 'rb'))
+
+def _upload(package, resource, export, ctx, started, force=False):
+    """ Replace the resource with the export (unless it has the same data)
+    and record the result.
+    The file goes through resource_patch, so the IResourceController hooks
+    (DataPusher / XLoader, validation) run as for any resource update.
+    Returns the result
+    """
+    def duration():
+        return time.monotonic() - started
+
+    if not force and export.sha256 == get_extra(package, EXTRA_LAST_HASH):
+        log.info(f"Chart {export.chart_id} data unchanged, skipping the upload to {resource['id']}")
+        return _record_result(package, STATUS_UNCHANGED, None, data_hash=export.sha256, duration=duration())
     try:
         tk.get_action('resource_patch')(
-            ctx, {'id': resource['id'], 'upload': upload_file}
+            dict(ctx), {'id': resource['id'], 'upload': export.upload(resource.get('name'))}
         )
     except Exception as e:
         log.exception(f"resource_patch failed for {resource['id']}")
-        return _record_result(package, status='error', error=str(e))
+        model.Session.rollback()
+        return _record_result(package, STATUS_ERROR, str(e), duration=duration())
+    return _record_result(package, STATUS_OK, None, data_hash=export.sha256, duration=duration(), context=ctx)
 
-    return _record_result(package, status='ok', error=None)
 
+def _sync_chart_packages(chart_id, packages, ctx, force=False, superset=None):
+    """ Download the chart data once and upload it to the resource of every package.
+    Returns the result of each package
+    """
+    started = time.monotonic()
+    results = []
+    targets = []
+    for package in packages:
+        resource, error = _get_sync_resource(package)
+        if error:
+            results.append(_record_result(package, STATUS_ERROR, error, duration=time.monotonic() - started))
+        else:
+            targets.append((package, resource))
+    if not targets:
+        return results
+
+    export, error = _download(chart_id, superset)
+    download_time = time.monotonic() - started
+    if error:
+        for package, _ in targets:
+            results.append(_record_result(package, STATUS_ERROR, error, duration=download_time))
+        return results
+
+    # The temporary file is removed once uploaded
+    with export:
+        for package, resource in targets:
+            # Each package counts the shared download and its own upload
+            upload_started = time.monotonic() - download_time
+            results.append(_upload(package, resource, export, ctx, upload_started, force))
+    return results
+
+
+def make_result(package_id, status, error=None, next_sync=None, duration=None):
+    """ The outcome of the sync of a package """
+    return {
+        'package_id': package_id,
+        'status': status,
+        'error': error,
+        'next_sync': next_sync,
+        'duration': duration,
+    }
 
-def _record_result(package_dict, status, error):
-    """ Persist the outcome of a sync attempt to the package extras. """
+
+def _record_result(package_dict, status, error, data_hash=None, duration=None, context=None):
+    """ Persist the outcome of a sync attempt to the package extras and its schedule row.
+    `data_hash` is the hash of the data now in the resource (kept as is if None).
+    `context` is the context of the package update (the site user by default).
+    """
     now = datetime.now(timezone.utc)
     frequency = get_extra(package_dict, EXTRA_FREQUENCY)
     enabled = get_extra(package_dict, EXTRA_ENABLED) == 'true'
-    next_sync = calculate_next_sync(frequency, from_dt=now) if enabled else None
+    next_sync = calculate_next_sync(frequency, from_dt=now, package_id=package_dict['id']) if enabled else None
 
     updates = {
         EXTRA_LAST_SYNC: now.isoformat(),
@@ -177,24 +292,26 @@ def _record_result(package_dict, status, error):
         EXTRA_LAST_ERROR: error[:500] if error else None,
         EXTRA_NEXT_SYNC: next_sync.isoformat() if next_sync else None,
     }
-    new_extras = merge_extras(package_dict, updates)
-    site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
-    tk.get_action('package_patch')(
-        {'ignore_auth': True, 'user': site_user['name']},
-        {'id': package_dict['id'], 'extras': new_extras},
+    if data_hash:
+        updates[EXTRA_LAST_HASH] = data_hash
+    updated = tk.get_action('package_patch')(
+        dict(context or _site_context()),
+        {'id': package_dict['id'], 'extras': merge_extras(package_dict, updates)},
     )
+    # The sync is over, another node can claim the package again
+    schedule.save_schedule(updated, duration=duration, release=True)
 
-    if status == 'error':
+    if status == STATUS_ERROR:
         _create_failure_activity(package_dict, error)
 
-    return {'status': status, 'error': error, 'next_sync': next_sync}
+    return make_result(package_dict['id'], status, error, next_sync, duration)
 
 
 def _create_failure_activity(package_dict, error):
     """ Emit a CKAN activity stream entry recording a sync failure.
 
     Successes are not recorded here: CKAN already emits a 'changed package'
-    activity for every successful resource_patch. Failures, in contrast, do
+    activity for every successful sync upload. Failures, in contrast, do
     not produce any activity by default — this is where they become visible.
 
     The activity is attributed to the dataset's creator (not the site user)
@@ -243,6 +360,34 @@ def _create_failure_activity(package_dict, error):
 def find_due_package_ids(now=None):
     """ Return IDs of active packages whose next sync time has arrived.
 
+    Reads the indexed schedule table (see data/schedule.py), or the package
+    extras if the table does not exist yet (migrations not run).
+    """
+    try:
+        return schedule.find_due(now)
+    except SQLAlchemyError as e:
+        model.Session.rollback()
+        log.warning(f"Unable to read the Superset sync schedule (run `ckan db upgrade -p superset`): {e}")
+        return _find_due_package_ids_from_extras(now)
+
+
+def claim_due_package_ids(now=None, limit=None):
+    """ Return IDs of the due packages, leased to this node (see schedule.claim_due).
+
+    Several nodes can run the due syncs at the same time, each package is
+    returned to one of them. Without the schedule table (migrations not run)
+    it falls back to find_due_package_ids, without leases.
+    """
+    try:
+        return schedule.claim_due(now, limit=limit)
+    except SQLAlchemyError as e:
+        log.warning(f"Unable to claim the due syncs (run `ckan db upgrade -p superset`): {e}")
+        return _find_due_package_ids_from_extras(now)[:limit]
+
+
+def _find_due_package_ids_from_extras(now=None):
+    """ Return IDs of active packages whose next sync time has arrived.
+
     Pre-conditions enforced via PackageExtra rows:
     - superset_chart_id present
     - superset_sync_enabled == 'true'
@@ -0,0 +1,154 @@
+"""
+Run many periodic syncs with one Superset client.
+
+`ckan superset run-due-syncs` can sync the due datasets:
+- with a pool of threads in the command process (`--workers N`), or
+- in background jobs of `--batch-size N` datasets each.
+Either way the syncs share one authenticated SupersetCKAN client, instead of
+one background job (and one Superset login) per dataset, and the metadata
+of all their charts is read with one filtered listing (prefetch_charts).
+Datasets linked to the same chart share one download (sync.sync_packages).
+Each thread runs with its own Flask app context and database session.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from ckan import model
+
+from ckanext.superset.config import get_config
+from ckanext.superset.data.main import SupersetCKAN
+from ckanext.superset.data import schedule, sync
+from ckanext.superset.exceptions import SupersetRequestException
+
+
+log = logging.getLogger(__name__)
+
+
+def get_chart_ids(package_ids):
+    """ Map package IDs to their chart ID (from the schedule table, empty if unavailable) """
+    try:
+        return schedule.get_chart_ids(package_ids)
+    except SQLAlchemyError as e:
+        model.Session.rollback()
+        log.warning(f"Unable to read the chart IDs from the sync schedule: {e}")
+        return {}
+
+
+def group_by_chart(package_ids, chart_ids=None):
+    """ Lists of package IDs linked to the same chart """
+    chart_ids = get_chart_ids(package_ids) if chart_ids is None else chart_ids
+    groups = {}
+    for package_id in package_ids:
+        # Packages with an unknown chart are synced by themselves
+        groups.setdefault(chart_ids.get(package_id) or package_id, []).append(package_id)
+    return list(groups.values())
+
+
+def login():
+    """ A logged in SupersetCKAN client.
+        Raises SupersetRequestException if Superset is not available
+    """
+    superset = SupersetCKAN(**get_config())
+    superset.prepare_connection()
+    return superset
+
+
+def get_superset(chart_ids, superset=None):
+    """ A logged in SupersetCKAN client (`superset` or a new one) with the charts already loaded """
+    # Login once, before the threads use the client
+    if superset is None:
+        superset = login()
+    else:
+        superset.prepare_connection()
+    try:
+        superset.prefetch_charts(chart_ids)
+    except SupersetRequestException as e:
+        # Each sync gets its chart (and reports the error) by itself
+        log.warning(f"Unable to prefetch the charts to sync: {e}")
+    return superset
+
+
+def sync_group(package_ids, superset, force=False):
+    """ Sync packages linked to the same chart (one download), never raises.
+        Returns the result of each package
+    """
+    try:
+        return sync.sync_packages(package_ids, force=force, superset=superset)
+    except Exception as e:
+        log.exception(f"Unable to sync {package_ids}")
+        model.Session.rollback()
+        return [sync.make_result(package_id, sync.STATUS_ERROR, str(e)) for package_id in package_ids]
+
+
+def run_group(app, package_ids, superset, force=False):
+    """ sync_group in a worker thread, with its own app context and database session """
+    with app.test_request_context():
+        try:
+            return sync_group(package_ids, superset, force=force)
+        finally:
+            # Scoped sessions are per thread, do not leave connections open
+            model.Session.remove()
+
+
+def run_syncs(package_ids, workers=4, force=False, on_result=None, superset=None):
+    """ Sync packages with `workers` threads, one chart (and its packages) per task.
+        `on_result` is called (in the calling thread) with the result of each
+        package as soon as it is done.
+        `superset` is a logged in client to use (see login).
+        Returns the results (dicts with package_id, status, error and
+        duration) and a summary of the run.
+        Raises SupersetRequestException if Superset is not available
+    """
+    app = current_app._get_current_object()
+    chart_ids = get_chart_ids(package_ids)
+    superset = get_superset(chart_ids.values(), superset)
+    started = time.monotonic()
+    results = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='superset-sync') as pool:
+        futures = [
+            pool.submit(run_group, app, group, superset, force)
+            for group in group_by_chart(package_ids, chart_ids)
+        ]
+        for future in as_completed(futures):
+            for result in future.result():
+                results.append(result)
+                if on_result:
+                    on_result(result)
+
+    return results, summarize(results, time.monotonic() - started)
+
+
+def sync_batch(package_ids, force=False):
+    """ Sync a batch of packages (background job), downloading each chart once.
+        Returns the results and the summary, like run_syncs
+    """
+    started = time.monotonic()
+    superset = get_superset(get_chart_ids(package_ids).values())
+    results = sync_group(package_ids, superset, force=force)
+    summary = summarize(results, time.monotonic() - started)
+    log.info(f"Synced a batch of {len(package_ids)} package(s): {summary}")
+    return results, summary
+
+
+def batches(package_ids, size, chart_ids=None):
+    """ Split the package IDs in lists of about `size`.
+        Packages linked to the same chart go to the same batch (one download)
+    """
+    result = []
+    for group in group_by_chart(list(package_ids), chart_ids):
+        if not result or len(result[-1]) + len(group) > size:
+            result.append([])
+        result[-1].extend(group)
+    return result
+
+
+def summarize(results, duration):
+    """ Counts by status and throughput of a run """
+    summary = {'total': len(results), 'duration': round(duration, 2)}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    summary['per_minute'] = round(len(results) * 60 / duration, 1) if duration else None
+    return summary
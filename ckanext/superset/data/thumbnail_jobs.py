@@ -0,0 +1,191 @@
+"""
+Background fetch of chart thumbnails.
+
+warm_thumbnails pre-fetches the thumbnails of the whole catalog (after a
+deploy, or periodically) so the admin index finds them in the cache.
+
+Superset answers 202 while it takes the chart screenshot. The image view then
+serves a placeholder and enqueues fetch_thumbnail, which waits for Superset in
+a background worker and stores the image in the thumbnails cache.
+The state of each fetch is kept in the CKAN Redis so only one job per
+thumbnail is enqueued and the page can ask when it is ready.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+from ckan.plugins import toolkit as tk
+
+from ckanext.superset.config import get_config
+from ckanext.superset.data.async_main import AsyncSupersetCKAN, run_sync
+from ckanext.superset.data.chart import SupersetChart
+from ckanext.superset.data.main import SupersetCKAN
+from ckanext.superset.data.thumbnails import get_cache
+from ckanext.superset.exceptions import SupersetPendingException, SupersetRequestException
+
+
+log = logging.getLogger(__name__)
+
+STATUS_READY = 'ready'
+STATUS_PENDING = 'pending'
+STATUS_ERROR = 'error'
+STATUS_MISSING = 'missing'
+
+STATUS_PREFIX = 'ckanext-superset:thumbnail:'
+# How long a fetch state is kept
+STATUS_TTL = 10 * 60
+# Seconds to wait between attempts while Superset computes the thumbnail
+RETRY_DELAYS = (2, 4, 8, 15, 30, 60)
+# Statistics of the last warm_thumbnails run, in the cache directory
+WARM_STATS_FILE = 'warm-stats.json'
+
+
+def _redis():
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def _status_key(chart_id, digest):
+    return f'{STATUS_PREFIX}{chart_id}-{digest}'
+
+
+def set_status(chart_id, digest, status):
+    _redis().set(_status_key(chart_id, digest), status, ex=STATUS_TTL)
+
+
+def get_status(chart_id, digest, cache=None):
+    """ ready (cached), pending (being fetched), error or missing """
+    cache = cache or get_cache()
+    if cache.get(chart_id, digest):
+        return STATUS_READY
+    status = _redis().get(_status_key(chart_id, digest))
+    if isinstance(status, bytes):
+        status = status.decode('utf-8')
+    return status or STATUS_MISSING
+
+
+def enqueue_fetch(chart_id, digest):
+    """ Enqueue a fetch_thumbnail job, unless there is one already.
+        Returns True if a job was enqueued
+    """
+    # SET NX: only the first request for this thumbnail enqueues the job
+    if not _redis().set(_status_key(chart_id, digest), STATUS_PENDING, nx=True, ex=STATUS_TTL):
+        return False
+    tk.enqueue_job(
+        fetch_thumbnail,
+        args=[chart_id, digest],
+        title=f"superset_thumbnail:{chart_id}",
+    )
+    return True
+
+
+def fetch_thumbnail(chart_id, digest, delays=RETRY_DELAYS):
+    """ Wait for Superset to compute a chart thumbnail and cache it (background job).
+        Returns the final status
+    """
+    sc = SupersetCKAN(**get_config())
+    chart = SupersetChart(superset_instance=sc)
+    try:
+        chart.get_from_superset(chart_id)
+    except SupersetRequestException as e:
+        log.error(f"Unable to get chart {chart_id} to fetch its thumbnail: {e}")
+        set_status(chart_id, digest, STATUS_ERROR)
+        return STATUS_ERROR
+
+    if chart.thumbnail_digest != digest:
+        log.info(f"Chart {chart_id} thumbnail digest changed, fetching {chart.thumbnail_digest}")
+
+    for delay in (0,) + tuple(delays):
+        time.sleep(delay)
+        try:
+            thumbnail = chart.get_thumbnail(raise_pending=True)
+        except SupersetPendingException:
+            log.debug(f"Thumbnail of chart {chart_id} not ready yet")
+            continue
+        if not thumbnail:
+            break
+        get_cache().put(chart_id, chart.thumbnail_digest, thumbnail)
+        set_status(chart_id, digest, STATUS_READY)
+        log.info(f"Thumbnail of chart {chart_id} cached")
+        return STATUS_READY
+
+    log.warning(f"Unable to get the thumbnail of chart {chart_id}")
+    set_status(chart_id, digest, STATUS_ERROR)
+    return STATUS_ERROR
+
+
+async def _fetch_thumbnails(charts, cache, max_concurrency=None):
+    """ Fetch and cache the thumbnails of some charts, at most `max_concurrency` at once.
+        Returns the fetch status of each chart
+    """
+    async with AsyncSupersetCKAN(max_concurrency=max_concurrency, **get_config()) as sc:
+
+        async def fetch(chart):
+            digest = chart.thumbnail_digest
+            try:
+                image = await sc.get_chart_thumbnail(chart, raise_pending=True)
+            except SupersetPendingException:
+                # Do not wait here, a fetch_thumbnail job will
+                await asyncio.to_thread(enqueue_fetch, chart.id, digest)
+                return 'pending'
+            if not image:
+                return 'failed'
+            await asyncio.to_thread(cache.put, chart.id, digest, image, False)
+            return 'fetched'
+
+        return await asyncio.gather(*(fetch(chart) for chart in charts))
+
+
+def warm_thumbnails(max_concurrency=None, force=False):
+    """ Pre-fetch the thumbnails of all the charts (CLI command and background job).
+        Only the thumbnails whose digest is not cached (new or changed charts)
+        are requested, unless `force`.
+        Returns (and saves) statistics of the run
+    """
+    started = time.monotonic()
+    cache = get_cache()
+    sc = SupersetCKAN(**get_config())
+    # Same columns as the admin index, to reuse its catalog cache
+    charts = sc.load_charts(columns='index')
+
+    stats = {'charts': len(charts), 'hits': 0, 'fetched': 0, 'pending': 0, 'failed': 0, 'no_thumbnail': 0}
+    missing = []
+    for chart in charts:
+        if not chart.thumbnail_digest:
+            stats['no_thumbnail'] += 1
+        elif not force and cache.has(chart.id, chart.thumbnail_digest):
+            stats['hits'] += 1
+        else:
+            missing.append(chart)
+
+    log.info(f"Warming {len(missing)} of {len(charts)} chart thumbnails")
+    if missing:
+        for status in run_sync(_fetch_thumbnails(missing, cache, max_concurrency)):
+            stats[status] += 1
+        cache.evict()
+
+    stats['duration'] = round(time.monotonic() - started, 2)
+    stats['finished'] = datetime.now(timezone.utc).isoformat()
+    save_warm_stats(stats, cache)
+    log.info(f"Thumbnails warmed: {stats}")
+    return stats
+
+
+def save_warm_stats(stats, cache=None):
+    cache = cache or get_cache()
+    os.makedirs(cache.directory, exist_ok=True)
+    with open(os.path.join(cache.directory, WARM_STATS_FILE), 'w') as f:
+        json.dump(stats, f)
+
+
+def get_warm_stats(cache=None):
+    """ Statistics of the last warm_thumbnails run, or None """
+    cache = cache or get_cache()
+    try:
+        with open(os.path.join(cache.directory, WARM_STATS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,284 @@
+"""
+On-disk cache of Superset chart thumbnails.
+
+Superset's `thumbnail_url` embeds a digest of the chart
+(/api/v1/chart/32/thumbnail/<digest>/) that changes when the chart changes,
+so a cached file named after the chart ID and the digest never goes stale:
+it is replaced when a new digest shows up. The cache is capped in size and
+the least recently used files are evicted first.
+The threads of a process share one ThumbnailCache (get_cache), with its lock
+and an estimate of the cache size: the directory is only scanned to evict
+when that estimate goes over the cap.
+
+Smaller variants (resized, WebP or JPEG) of a thumbnail are generated once
+with Pillow, when first requested, and cached next to the original as
+<chart id>-<digest>-w<width>.<ext>.
+"""
+import glob
+import logging
+import os
+import re
+import tempfile
+import threading
+from io import BytesIO
+
+from ckan.plugins.toolkit import asint, config
+
+from ckanext.superset.data import catalog
+
+
+log = logging.getLogger(__name__)
+
+DIGEST_RE = re.compile(r'/thumbnail/([0-9A-Za-z_-]+)/?$')
+VALID_DIGEST_RE = re.compile(r'^[0-9A-Za-z_-]+$')
+
+# Widths of the variants we generate (a whitelist, so the cache stays bounded)
+VARIANT_WIDTHS = (80, 160, 320)
+# Variant formats: URL value -> (Pillow format, mimetype, file extension)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'image/webp', '.webp'),
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+    'png': ('PNG', 'image/png', '.png'),
+}
+VARIANT_QUALITY = 80
+CACHE_SUFFIXES = tuple({ext for _, _, ext in VARIANT_FORMATS.values()})
+# Eviction trims the cache to this share of its size, so it does not run on every write
+EVICT_TO = 0.9
+
+# directory: ThumbnailCache shared by the threads of the process
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_digest(thumbnail_url):
+    """ The digest in a Superset `thumbnail_url`, or None """
+    match = DIGEST_RE.search(thumbnail_url or '')
+    return match.group(1) if match else None
+
+
+def get_cached_digest(chart_id):
+    """ The thumbnail digest of a chart in the catalog cache (see data/catalog.py), or None """
+    row = catalog.get_item('chart', chart_id)
+    return get_digest(row.get('thumbnail_url')) if row else None
+
+
+def get_cache_dir():
+    cache_dir = config.get('ckanext.superset.thumbnails.cache_dir')
+    if cache_dir:
+        return cache_dir
+    storage_path = config.get('ckan.storage_path') or tempfile.gettempdir()
+    return os.path.join(storage_path, 'superset', 'thumbnails')
+
+
+def get_cache_size():
+    """ Max size of the cache in bytes """
+    return asint(config.get('ckanext.superset.thumbnails.cache_size', 200)) * 1024 * 1024
+
+
+def variants_available():
+    """ Pillow (optional, the `images` extra) is required to generate variants """
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def make_variant(content, width, fmt):
+    """ Resize a PNG thumbnail to `width` (keeping the aspect ratio) and re-encode it """
+    from PIL import Image
+
+    pil_format = VARIANT_FORMATS[fmt][0]
+    with Image.open(BytesIO(content)) as image:
+        image.load()
+        if image.width > width:
+            height = max(round(image.height * width / image.width), 1)
+            image = image.resize((width, height), Image.LANCZOS)
+        if pil_format == 'JPEG' and image.mode != 'RGB':
+            # No transparency in JPEG: flatten on white
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            rgba = image.convert('RGBA')
+            background.paste(rgba, mask=rgba.getchannel('A'))
+            image = background
+        output = BytesIO()
+        options = {'optimize': True} if pil_format == 'PNG' else {'quality': VARIANT_QUALITY}
+        image.save(output, format=pil_format, **options)
+    return output.getvalue()
+
+
+def get_cache():
+    """ The cache of the configured directory, shared by the threads of the process """
+    directory = get_cache_dir()
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = ThumbnailCache(directory)
+        return _caches[directory]
+
+
+def uncached_chart_ids(charts, cache=None):
+    """ IDs of the charts whose current thumbnail is not cached yet """
+    cache = cache or get_cache()
+    return {
+        chart.id for chart in charts
+        if chart.thumbnail_digest and not cache.has(chart.id, chart.thumbnail_digest)
+    }
+
+
+class ThumbnailCache:
+    """ Chart thumbnails on disk, keyed by chart ID and digest.
+        Use get_cache() instead of a new instance, to share the lock and the size
+    """
+
+    suffix = '.png'
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or get_cache_dir()
+        self.max_bytes = get_cache_size() if max_bytes is None else max_bytes
+        self.lock = threading.Lock()
+        # Estimated size of the files in bytes, None until the first scan.
+        # Files written by other processes are only counted by the next evict()
+        self.size = None
+
+    def path(self, chart_id, digest):
+        if not VALID_DIGEST_RE.match(str(digest)):
+            raise ValueError(f"Invalid thumbnail digest: {digest}")
+        return os.path.join(self.directory, f'{int(chart_id)}-{digest}{self.suffix}')
+
+    def variant_path(self, chart_id, digest, width, fmt):
+        if int(width) not in VARIANT_WIDTHS or fmt not in VARIANT_FORMATS:
+            raise ValueError(f"Unsupported thumbnail variant: {width} {fmt}")
+        ext = VARIANT_FORMATS[fmt][2]
+        return os.path.join(self.directory, f'{int(chart_id)}-{digest}-w{int(width)}{ext}')
+
+    def get(self, chart_id, digest):
+        """ Path to the cached thumbnail, or None """
+        path = self.path(chart_id, digest)
+        try:
+            # Mark it as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def has(self, chart_id, digest):
+        """ The thumbnail is cached (does not count as a use) """
+        return os.path.exists(self.path(chart_id, digest))
+
+    def _write(self, path, content):
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial image
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def put(self, chart_id, digest, content, evict=True):
+        """ Store a thumbnail (and drop the older ones of the chart and their variants).
+            Returns its path
+            Use evict=False when storing many and call evict() at the end
+        """
+        path = self.path(chart_id, digest)
+        self._write(path, content)
+
+        removed = 0
+        current = f'{int(chart_id)}-{digest}'
+        for old_path in glob.glob(os.path.join(glob.escape(self.directory), f'{int(chart_id)}-*')):
+            name = os.path.basename(old_path)
+            if not name.endswith(CACHE_SUFFIXES):
+                continue
+            stem = os.path.splitext(name)[0]
+            if stem != current and not stem.startswith(f'{current}-w'):
+                removed += self._remove(old_path)
+        self._track(len(content) - removed, evict)
+        return path
+
+    def get_variant(self, chart_id, digest, width, fmt, evict=True):
+        """ Path to a resized / re-encoded variant of a cached thumbnail,
+            generated on the first request. None if the original is not cached
+            or Pillow is not installed
+        """
+        path = self.variant_path(chart_id, digest, width, fmt)
+        try:
+            os.utime(path)
+            return path
+        except OSError:
+            pass
+        original = self.get(chart_id, digest)
+        if not original or not variants_available():
+            return None
+        try:
+            # It may be evicted (or replaced) since get()
+            with open(original, 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        try:
+            variant = make_variant(content, int(width), fmt)
+        except (OSError, ValueError) as e:
+            log.warning(f"Unable to generate the {width} {fmt} thumbnail of chart {chart_id}: {e}")
+            return None
+        self._write(path, variant)
+        log.debug(f"Thumbnail variant {os.path.basename(path)}: {len(content)} -> {len(variant)} bytes")
+        self._track(len(variant), evict)
+        return path
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(CACHE_SUFFIXES):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    @staticmethod
+    def _remove(path):
+        """ Remove a file. Returns its size (0 if it was not there) """
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except OSError:
+            return 0
+        return size
+
+    def _track(self, added, evict=True):
+        """ Count the bytes added to the cache and evict once it goes over its size """
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._entries())
+            else:
+                self.size += added
+            over = self.size > self.max_bytes
+        if over and evict:
+            self.evict()
+
+    def evict(self):
+        """ Remove the least recently used thumbnails until the cache fits
+            (with some room left, see EVICT_TO)
+        """
+        with self.lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            evicted = 0
+            if total > self.max_bytes:
+                for _, size, path in entries:
+                    if total <= self.max_bytes * EVICT_TO:
+                        break
+                    self._remove(path)
+                    total -= size
+                    evicted += 1
+            self.size = total
+        if evicted:
+            log.info(f"Evicted {evicted} thumbnail(s) from the cache")
+        return evicted
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        with self.lock:
+            for _, _, path in self._entries():
+                self._remove(path)
+            self.size = 0
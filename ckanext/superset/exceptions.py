@@ -1,2 +1,14 @@
 class SupersetRequestException(Exception):
     pass
+
+
+class SupersetAuthException(SupersetRequestException):
+    """ Superset rejected our credentials (HTTP 401) """
+    pass
+
+
+class SupersetPendingException(SupersetRequestException):
+    """ Superset accepted the request but the result is not ready yet (HTTP 202),
+        e.g. a thumbnail still being computed
+    """
+    pass
@@ -0,0 +1,88 @@
+"""Add the Superset sync schedule table
+
+Revision ID: 3f7d2a9c6e14
+Revises: 8c4e2b7a1d90
+Create Date: 2026-10-18 14:21:05.672410
+
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f7d2a9c6e14'
+down_revision = '8c4e2b7a1d90'
+branch_labels = None
+depends_on = None
+
+SYNC_EXTRAS = (
+    'superset_chart_id',
+    'superset_sync_frequency',
+    'superset_sync_enabled',
+    'superset_next_sync',
+    'superset_last_sync',
+    'superset_last_sync_status',
+)
+
+
+def _parse(value):
+    """ An ISO-8601 extra as a naive UTC datetime """
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def upgrade():
+    schedule = op.create_table(
+        'superset_sync_schedule',
+        sa.Column(
+            'package_id', sa.UnicodeText, sa.ForeignKey('package.id', ondelete='CASCADE'), primary_key=True
+        ),
+        sa.Column('chart_id', sa.UnicodeText, nullable=True),
+        sa.Column('frequency', sa.UnicodeText, nullable=True),
+        sa.Column('enabled', sa.Boolean, nullable=False, server_default=sa.false()),
+        sa.Column('next_sync', sa.DateTime, nullable=True),
+        sa.Column('last_sync', sa.DateTime, nullable=True),
+        sa.Column('last_status', sa.UnicodeText, nullable=True),
+        sa.Column('last_duration', sa.Float, nullable=True),
+        sa.Column('modified', sa.DateTime, nullable=False),
+    )
+    op.create_index('idx_superset_sync_schedule_due', 'superset_sync_schedule', ['enabled', 'next_sync'])
+    op.create_index('ix_superset_sync_schedule_chart_id', 'superset_sync_schedule', ['chart_id'])
+
+    # Backfill from the sync extras of the datasets linked to a chart
+    rows = op.get_bind().execute(sa.text(
+        "SELECT pe.package_id, pe.key, pe.value FROM package_extra pe "
+        "JOIN package p ON p.id = pe.package_id "
+        "WHERE pe.state = 'active' AND p.state != 'deleted' AND pe.key IN :keys"
+    ).bindparams(sa.bindparam('keys', expanding=True)), {'keys': list(SYNC_EXTRAS)})
+    extras = {}
+    for package_id, key, value in rows:
+        extras.setdefault(package_id, {})[key] = value
+
+    now = datetime.utcnow()
+    op.bulk_insert(schedule, [
+        {
+            'package_id': package_id,
+            'chart_id': values['superset_chart_id'],
+            'frequency': values.get('superset_sync_frequency'),
+            'enabled': values.get('superset_sync_enabled') == 'true',
+            'next_sync': _parse(values.get('superset_next_sync')),
+            'last_sync': _parse(values.get('superset_last_sync')),
+            'last_status': values.get('superset_last_sync_status'),
+            'modified': now,
+        }
+        for package_id, values in extras.items() if values.get('superset_chart_id')
+    ])
+
+
+def downgrade():
+    op.drop_index('ix_superset_sync_schedule_chart_id', 'superset_sync_schedule')
+    op.drop_index('idx_superset_sync_schedule_due', 'superset_sync_schedule')
+    op.drop_table('superset_sync_schedule')
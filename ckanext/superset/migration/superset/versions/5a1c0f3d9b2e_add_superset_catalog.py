@@ -0,0 +1,39 @@
+"""Add the Superset catalog cache tables
+
+Revision ID: 5a1c0f3d9b2e
+Revises:
+Create Date: 2026-10-18 09:12:40.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1c0f3d9b2e'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'superset_catalog',
+        sa.Column('resource_type', sa.UnicodeText, primary_key=True),
+        sa.Column('object_id', sa.UnicodeText, primary_key=True),
+        sa.Column('position', sa.Integer, nullable=False),
+        sa.Column('data', sa.JSON, nullable=False),
+        sa.Column('fetched_at', sa.DateTime, nullable=False),
+    )
+    op.create_table(
+        'superset_catalog_state',
+        sa.Column('resource_type', sa.UnicodeText, primary_key=True),
+        sa.Column('columns', sa.JSON, nullable=True),
+        sa.Column('count', sa.Integer, nullable=False),
+        sa.Column('fetched_at', sa.DateTime, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('superset_catalog_state')
+    op.drop_table('superset_catalog')
@@ -0,0 +1,28 @@
+"""Track the last change seen in the Superset catalog cache
+
+Revision ID: 8c4e2b7a1d90
+Revises: 5a1c0f3d9b2e
+Create Date: 2026-10-18 10:02:13.541877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e2b7a1d90'
+down_revision = '5a1c0f3d9b2e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('superset_catalog', sa.Column('changed_on', sa.DateTime, nullable=True))
+    op.add_column('superset_catalog_state', sa.Column('high_water_mark', sa.DateTime, nullable=True))
+    op.add_column('superset_catalog_state', sa.Column('reconciled_at', sa.DateTime, nullable=True))
+
+
+def downgrade():
+    op.drop_column('superset_catalog_state', 'reconciled_at')
+    op.drop_column('superset_catalog_state', 'high_water_mark')
+    op.drop_column('superset_catalog', 'changed_on')
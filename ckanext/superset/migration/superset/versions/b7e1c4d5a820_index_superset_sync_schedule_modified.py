@@ -0,0 +1,24 @@
+"""Index the modified column of the Superset sync schedule
+
+Revision ID: b7e1c4d5a820
+Revises: 3f7d2a9c6e14
+Create Date: 2026-10-18 16:02:44.118503
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e1c4d5a820'
+down_revision = '3f7d2a9c6e14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The scheduler daemon reads the rows changed since its last poll
+    op.create_index('ix_superset_sync_schedule_modified', 'superset_sync_schedule', ['modified'])
+
+
+def downgrade():
+    op.drop_index('ix_superset_sync_schedule_modified', 'superset_sync_schedule')
@@ -0,0 +1,26 @@
+"""Add the lease columns to the Superset sync schedule
+
+Revision ID: d41f8a6b2c37
+Revises: b7e1c4d5a820
+Create Date: 2026-10-18 17:40:12.530981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41f8a6b2c37'
+down_revision = 'b7e1c4d5a820'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('superset_sync_schedule', sa.Column('leased_by', sa.UnicodeText, nullable=True))
+    op.add_column('superset_sync_schedule', sa.Column('lease_expires', sa.DateTime, nullable=True))
+
+
+def downgrade():
+    op.drop_column('superset_sync_schedule', 'lease_expires')
+    op.drop_column('superset_sync_schedule', 'leased_by')
@@ -0,0 +1,60 @@
+"""
+Database tables of ckanext-superset.
+Created by the extension migrations: ckan db upgrade -p superset
+"""
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, JSON, UnicodeText
+from ckan.plugins import toolkit as tk
+
+
+class SupersetCatalogItem(tk.BaseModel):
+    """ A cached Superset object (chart, dataset or database) as returned by its list endpoint """
+    __tablename__ = 'superset_catalog'
+
+    resource_type = Column(UnicodeText, primary_key=True)
+    object_id = Column(UnicodeText, primary_key=True)
+    # Position in the Superset listing, to keep its order
+    position = Column(Integer, nullable=False)
+    data = Column(JSON, nullable=False)
+    # Superset `changed_on_utc` of the object, if requested
+    changed_on = Column(DateTime, nullable=True)
+    fetched_at = Column(DateTime, nullable=False)
+
+
+class SupersetCatalogState(tk.BaseModel):
+    """ When (and how) each resource type was last cached """
+    __tablename__ = 'superset_catalog_state'
+
+    resource_type = Column(UnicodeText, primary_key=True)
+    # Columns requested to Superset, None for all of them
+    columns = Column(JSON, nullable=True)
+    count = Column(Integer, nullable=False)
+    fetched_at = Column(DateTime, nullable=False)
+    # Newest `changed_on_utc` in the cache, incremental refreshes ask for newer objects
+    high_water_mark = Column(DateTime, nullable=True)
+    # Last time we checked for objects deleted in Superset
+    reconciled_at = Column(DateTime, nullable=True)
+
+
+class SupersetSyncSchedule(tk.BaseModel):
+    """ Periodic sync state of a CKAN dataset created from a Superset chart.
+        A copy of its sync extras (see data/sync.py) indexed for the scheduler
+    """
+    __tablename__ = 'superset_sync_schedule'
+    __table_args__ = (
+        Index('idx_superset_sync_schedule_due', 'enabled', 'next_sync'),
+    )
+
+    package_id = Column(UnicodeText, ForeignKey('package.id', ondelete='CASCADE'), primary_key=True)
+    chart_id = Column(UnicodeText, nullable=True, index=True)
+    frequency = Column(UnicodeText, nullable=True)
+    enabled = Column(Boolean, nullable=False, default=False)
+    # Naive UTC datetimes
+    next_sync = Column(DateTime, nullable=True)
+    last_sync = Column(DateTime, nullable=True)
+    last_status = Column(UnicodeText, nullable=True)
+    # Seconds the last sync took
+    last_duration = Column(Float, nullable=True)
+    modified = Column(DateTime, nullable=False, index=True)
+    # The node (host:pid) syncing the package, until lease_expires (naive UTC)
+    leased_by = Column(UnicodeText, nullable=True)
+    lease_expires = Column(DateTime, nullable=True)
@@ -5,6 +5,8 @@ from ckan.config.declaration import Declaration, Key
 from ckan.plugins import toolkit
 from ckanext.superset.blueprints.superset import superset_bp
 from ckanext.superset.blueprints.images import superset_images_bp
+from ckanext.superset.actions import superset_chart as superset_chart_actions
+from ckanext.superset.auth import superset_chart as superset_chart_auth
 from ckanext.superset.actions import superset_dataset as superset_dataset_actions
 from ckanext.superset.auth import superset_dataset as superset_dataset_auth
 from ckanext.superset.actions import superset_database as superset_database_actions
@@ -62,6 +64,21 @@ class SupersetPlugin(plugins.SingletonPlugin):
         declaration.declare(group.instance._descend("pass"), "test_pass")
         declaration.declare(group.instance.provider, "db")
         declaration.declare_bool(group.instance.refresh, True)
+        declaration.declare_bool(group.session.shared, True)
+        declaration.declare_int(group.concurrency, 8)
+        declaration.declare_int(group.page_size.chart, 350)
+        declaration.declare_int(group.page_size.dataset, 100)
+        declaration.declare_int(group.catalog.ttl, 600)
+        declaration.declare_bool(group.catalog.incremental, True)
+        declaration.declare_int(group.catalog.reconcile_interval, 3600)
+        declaration.declare_int(group.index.page_size, 50)
+        declaration.declare(group.thumbnails.cache_dir, "")
+        declaration.declare_int(group.thumbnails.cache_size, 200)
+        declaration.declare_bool(group.sync.spread, True)
+        declaration.declare(group.sync.windows, "")
+        declaration.declare_int(group.sync.slot_size, 15)
+        declaration.declare_int(group.sync.max_per_slot, 0)
+        declaration.declare_int(group.sync.lease_seconds, 3600)
         declaration.declare(group.proxy.url, "")
         declaration.declare_int(group.proxy.port, 3128)
         declaration.declare(group.proxy.user, "")
@@ -72,6 +89,7 @@ class SupersetPlugin(plugins.SingletonPlugin):
 
     def get_actions(self):
         return {
+            "superset_chart_list": superset_chart_actions.superset_chart_list,
             "superset_dataset_list": superset_dataset_actions.superset_dataset_list,
             "superset_database_list": superset_database_actions.superset_database_list
         }
@@ -80,6 +98,7 @@ class SupersetPlugin(plugins.SingletonPlugin):
 
     def get_auth_functions(self):
         return {
+            "superset_chart_list": superset_chart_auth.superset_chart_list,
             "superset_dataset_list": superset_dataset_auth.superset_dataset_list,
             "superset_database_list": superset_database_auth.superset_database_list
         }
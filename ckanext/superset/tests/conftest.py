@@ -18,3 +18,5 @@ def clean_db(reset_db, migrate_db_for):
     # ("No 'script_location' key found in configuration").
     if plugin_loaded("activity") and toolkit.check_ckan_version(min_version="2.11"):
         migrate_db_for("activity")
+    # ckanext-superset own tables
+    migrate_db_for("superset")
@@ -1,6 +1,7 @@
 import httpx
 import pytest
 
+from ckanext.superset.data.session import clear_sessions
 from ckanext.superset.tests.helpers import mock_transport
 
 
@@ -13,9 +14,22 @@ def app_httpx_mocked(app, monkeypatch):
     durante las pruebas.
     """
 
+    # Olvida las sesiones compartidas (y guardadas) creadas con otros clientes
+    clear_sessions(stored=True)
     # Reemplaza el cliente httpx para que use el transporte de mock
     mock_client = httpx.Client(transport=httpx.MockTransport(mock_transport))
     monkeypatch.setattr(httpx, "Client", lambda *args, **kwargs: mock_client)
 
     # Devuelve la aplicación con el mock aplicado
     return app
+
+
+@pytest.fixture
+def async_httpx_mocked(app_httpx_mocked, monkeypatch):
+    """ Like `app_httpx_mocked`, also for the httpx.AsyncClient used by AsyncSupersetCKAN """
+    async_client = httpx.AsyncClient
+    monkeypatch.setattr(
+        httpx, "AsyncClient",
+        lambda *args, **kwargs: async_client(transport=httpx.MockTransport(mock_transport))
+    )
+    return app_httpx_mocked
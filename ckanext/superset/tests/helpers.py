@@ -40,17 +40,72 @@ def get_api__v1__chart(request: httpx.Request, params=None) -> httpx.Response:
     if not response:
         return httpx.Response(404, json={"error": "Not found"})
     data = json.loads(response)
-    return httpx.Response(200, json=data)
+    return httpx.Response(200, json=paginate(request, data["result"], data))
+
+
+def get_query(request: httpx.Request) -> dict:
+    """ The `q` parameter of a Superset list request """
+    q = request.url.params.get('q')
+    return json.loads(q) if q else {}
+
+
+def _matches(row, filter_) -> bool:
+    """ Apply a Superset list filter ({col, opr, value}) to a row """
+    value = row.get(filter_['col'])
+    if filter_['opr'] == 'in':
+        return value in filter_['value']
+    if filter_['opr'] == 'ct':
+        return filter_['value'].lower() in (value or '').lower()
+    if filter_['opr'] == 'eq':
+        return value == filter_['value']
+    if filter_['opr'] == 'gt':
+        return value > filter_['value']
+    if filter_['opr'] == 'lt':
+        return value < filter_['value']
+    raise ValueError(f"Unsupported filter operator: {filter_['opr']}")
+
+
+def paginate(request: httpx.Request, rows, data=None, max_page_size=None) -> dict:
+    """ Build a Superset list response with the requested page of `rows`.
+        `max_page_size` caps the page size, like Superset's FAB_API_MAX_PAGE_SIZE
+    """
+    q = get_query(request)
+    for filter_ in q.get('filters', []):
+        rows = [row for row in rows if _matches(row, filter_)]
+    order_column = q.get('order_column')
+    if order_column in ('id', 'slice_name', 'viz_type'):
+        rows = sorted(rows, key=lambda row: row.get(order_column), reverse=q.get('order_direction') == 'desc')
+    page = q.get('page', 0)
+    page_size = q.get('page_size', 25)
+    if max_page_size:
+        page_size = min(page_size, max_page_size)
+    data = dict(data or {})
+    data['count'] = len(rows)
+    data['result'] = rows[page * page_size:(page + 1) * page_size]
+    columns = q.get('columns')
+    if columns:
+        # Related columns like `dashboards.id` return the `dashboards` field
+        keep = {column.split('.')[0] for column in columns}
+        data['result'] = [{k: v for k, v in row.items() if k in keep} for row in data['result']]
+    return data
 
 
 def post_api__v1__security__login(request: httpx.Request, params=None) -> httpx.Response:
     """ Mock the login endpoint """
     data = {
         'access_token': 'test_token',
+        'refresh_token': 'test_refresh_token',
     }
     return httpx.Response(200, json=data)
 
 
+def post_api__v1__security__refresh(request: httpx.Request, params=None) -> httpx.Response:
+    """ Mock the token refresh endpoint """
+    if request.headers.get('Authorization') != 'Bearer test_refresh_token':
+        return httpx.Response(401, json={'msg': 'Invalid refresh token'})
+    return httpx.Response(200, json={'access_token': 'test_token_refreshed'})
+
+
 def get_login(request: httpx.Request, params=None) -> httpx.Response:
     """ This is an HTML response with the CSRF token """
     response = (
@@ -88,6 +143,18 @@ def get_api__v1__chart__32(request: httpx.Request, params=None) -> httpx.Respons
     return httpx.Response(200, json=data)
 
 
+# The smallest valid PNG (1x1 transparent pixel)
+THUMBNAIL_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082'
+)
+
+
+def get_api__v1__chart__32__thumbnail__ce90a87d38fa6a2d8fa20232c1cba6f3(request: httpx.Request, params=None):
+    """ Mock the thumbnail of the chart 32 """
+    return httpx.Response(200, content=THUMBNAIL_PNG, headers={'Content-Type': 'image/png'})
+
+
 def get_api__v1__chart__32__data(request: httpx.Request, params=None) -> httpx.Response:
     """Mock para el endpoint de descarga de datos CSV."""
     csv_content = "year,cantidad_mundos\n2021,50\n2022,70\n2023,90"
@@ -0,0 +1,46 @@
+"""
+Tests for the asyncio Superset client.
+"""
+import httpx
+import pytest
+
+from ckanext.superset.config import get_config
+from ckanext.superset.data.async_main import AsyncSupersetCKAN, run_sync
+from ckanext.superset.exceptions import SupersetRequestException
+from ckanext.superset.tests import helpers
+
+
+async def _get_chart(chart_id):
+    async with AsyncSupersetCKAN(**get_config()) as sc:
+        return await sc.get_chart(chart_id)
+
+
+@pytest.mark.usefixtures('with_plugins')
+class TestAsyncSupersetCKAN:
+
+    def test_get_chart(self, async_httpx_mocked):
+        chart = run_sync(_get_chart(32))
+        assert chart.id == 32
+
+    def test_load_charts(self, async_httpx_mocked):
+        async def load():
+            async with AsyncSupersetCKAN(**get_config()) as sc:
+                return await sc.load_charts()
+
+        charts = run_sync(load())
+        assert len(charts) == 20
+
+    def test_chart_csv(self, async_httpx_mocked):
+        async def csv():
+            async with AsyncSupersetCKAN(**get_config()) as sc:
+                return await sc.get_chart_csv(32)
+
+        assert run_sync(csv()).startswith(b'year,cantidad_mundos')
+
+    def test_errors_are_mapped(self, async_httpx_mocked, monkeypatch):
+        monkeypatch.setattr(
+            helpers, 'get_api__v1__chart__32',
+            lambda request, params=None: httpx.Response(500, json={'error': 'boom'})
+        )
+        with pytest.raises(SupersetRequestException):
+            run_sync(_get_chart(32))
@@ -0,0 +1,285 @@
+"""
+Tests for the paginated and filtered admin charts index.
+"""
+import html
+import re
+
+import httpx
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from ckan.lib.helpers import url_for
+from ckan.tests import factories as ckan_factories
+
+from ckanext.superset.config import get_config
+from ckanext.superset.data import chart_list
+from ckanext.superset.data.main import SupersetCKAN
+from ckanext.superset.tests import factories, helpers
+
+
+class TestParseArgs:
+
+    def test_defaults(self):
+        params = chart_list.parse_args(MultiDict())
+
+        assert params['page'] == 1
+        assert params['sort'] == 'changed'
+        assert params['order'] == 'desc'
+        assert params['ckan'] == 'all'
+        assert params['viz_type'] == chart_list.DEFAULT_VIZ_TYPES
+
+    def test_filtered_form_without_types_means_all(self):
+        params = chart_list.parse_args(MultiDict({'filtered': '1'}))
+
+        assert params['viz_type'] == []
+
+    def test_invalid_values(self):
+        params = chart_list.parse_args(MultiDict({'page': 'x', 'sort': 'nope', 'ckan': 'maybe'}))
+
+        assert params['page'] == 1
+        assert params['sort'] == 'changed'
+        assert params['ckan'] == 'all'
+
+    def test_build_filters(self):
+        filters = chart_list.build_filters(['pie'], 'sales', ['3', 4])
+
+        assert filters == [
+            {'col': 'viz_type', 'opr': 'in', 'value': ['pie']},
+            {'col': 'slice_name', 'opr': 'ct', 'value': 'sales'},
+            {'col': 'id', 'opr': 'in', 'value': [3, 4]},
+        ]
+
+
+@pytest.fixture
+def capped_catalog(monkeypatch):
+    """ A Superset instance with 250 charts that serves at most 100 per page (its default) """
+    rows = [{'id': i, 'slice_name': f'Chart {i}', 'viz_type': 'table'} for i in range(1, 251)]
+
+    def get_charts(request, params=None):
+        return httpx.Response(200, json=helpers.paginate(request, rows, max_page_size=100))
+
+    monkeypatch.setattr(helpers, 'get_api__v1__chart', get_charts)
+    return rows
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+class TestListCharts:
+
+    def test_filters_are_sent_to_superset(self, app_httpx_mocked, monkeypatch):
+        requests = []
+        get_charts = helpers.get_api__v1__chart
+
+        def spy(request, params=None):
+            requests.append(request)
+            return get_charts(request, params)
+
+        monkeypatch.setattr(helpers, 'get_api__v1__chart', spy)
+        sc = SupersetCKAN(**get_config())
+        count, charts = chart_list.list_charts(sc, viz_type=['table'], q='urgencia', sort='id', order='asc', page_size=2)
+
+        q = helpers.get_query(requests[0])
+        assert q['page'] == 0 and q['page_size'] == 2
+        assert q['order_column'] == 'id'
+        assert count == 2
+        assert [chart.id for chart in charts] == [177, 204]
+
+    def test_second_page(self, app_httpx_mocked):
+        sc = SupersetCKAN(**get_config())
+        count, charts = chart_list.list_charts(sc, viz_type=['table'], sort='id', order='asc', page=2, page_size=2)
+
+        assert count == 5
+        assert [chart.id for chart in charts] == [201, 204]
+
+    def test_linked_to_ckan(self, app_httpx_mocked):
+        user = ckan_factories.Sysadmin()
+        factories.SupersetDataset(user=user, chart_id='212')
+        sc = SupersetCKAN(**get_config())
+        count, charts = chart_list.list_charts(sc, viz_type=[], ckan='with')
+
+        assert count == 1
+        assert charts[0].id == 212
+        assert charts[0].ckan_dataset['name']
+
+    def test_not_linked_to_ckan(self, app_httpx_mocked):
+        user = ckan_factories.Sysadmin()
+        factories.SupersetDataset(user=user, chart_id='212')
+        sc = SupersetCKAN(**get_config())
+        count, charts = chart_list.list_charts(sc, viz_type=['table'], ckan='without')
+
+        assert count == 4
+        assert 212 not in [chart.id for chart in charts]
+        assert all(chart.ckan_dataset is None for chart in charts)
+
+    @pytest.mark.ckan_config('ckanext.superset.page_size.chart', '4')
+    def test_many_linked_charts_are_not_sent_at_once(self, app_httpx_mocked, monkeypatch):
+        user = ckan_factories.Sysadmin()
+        for chart_id in ('125', '165', '184'):
+            factories.SupersetDataset(user=user, chart_id=chart_id)
+        monkeypatch.setattr(chart_list, 'MAX_ID_FILTER', 2)
+        id_filters = []
+        get_charts = helpers.get_api__v1__chart
+
+        def spy(request, params=None):
+            for filter_ in helpers.get_query(request).get('filters', []):
+                if filter_['col'] == 'id' and filter_['opr'] == 'in':
+                    id_filters.append(filter_['value'])
+            return get_charts(request, params)
+
+        monkeypatch.setattr(helpers, 'get_api__v1__chart', spy)
+        sc = SupersetCKAN(**get_config())
+        params = {'viz_type': [], 'sort': 'id', 'order': 'asc'}
+
+        count, charts = chart_list.list_charts(sc, ckan='without', page=2, page_size=3, **params)
+        assert count == 17
+        assert [chart.id for chart in charts] == [190, 191, 201]
+
+        count, charts = chart_list.list_charts(sc, ckan='with', page=2, page_size=2, **params)
+        assert count == 3
+        assert [chart.id for chart in charts] == [184]
+        assert charts[0].ckan_dataset['name']
+
+        assert id_filters
+        assert max(len(ids) for ids in id_filters) <= 2
+
+    def test_not_linked_past_the_superset_page_size(self, app_httpx_mocked, capped_catalog):
+        user = ckan_factories.Sysadmin()
+        for chart_id in ('1', '5'):
+            factories.SupersetDataset(user=user, chart_id=chart_id)
+        sc = SupersetCKAN(**get_config())
+        unlinked = [row['id'] for row in capped_catalog if row['id'] not in (1, 5)]
+
+        count, charts = chart_list.list_charts(
+            sc, ckan='without', viz_type=[], sort='id', order='asc', page=3, page_size=50
+        )
+
+        assert count == 248
+        assert [chart.id for chart in charts] == unlinked[100:150]
+
+    def test_nothing_linked(self, app_httpx_mocked):
+        sc = SupersetCKAN(**get_config())
+
+        assert chart_list.list_charts(sc, ckan='with') == (0, [])
+
+    def test_index_view_paginates(self, app_httpx_mocked):
+        sysadmin = ckan_factories.SysadminWithToken()
+        url = url_for('superset_blueprint.index', filtered=1, sort='id', order='asc')
+        response = app_httpx_mocked.get(url, headers={'Authorization': sysadmin['token']})
+
+        assert response.status_code == 200
+        assert 'Superset charts (20)' in response.body
+
+    @pytest.mark.ckan_config('ckanext.superset.index.page_size', '5')
+    def test_lazy_loaded_charts_keep_the_filters(self, app_httpx_mocked):
+        sysadmin = ckan_factories.SysadminWithToken()
+        headers = {'Authorization': sysadmin['token']}
+        # All the chart types, not just the default ones
+        url = url_for('superset_blueprint.index', filtered=1, sort='id', order='asc')
+        response = app_httpx_mocked.get(url, headers=headers)
+        assert 'Superset charts (20)' in response.body
+
+        next_url = html.unescape(re.search(r'data-next-url="([^"]*)"', response.body).group(1))
+        data = app_httpx_mocked.get(next_url, headers=headers).json
+
+        assert data['count'] == 20
+        assert [chart['id'] for chart in data['result']] == [184, 190, 191, 201, 203]
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+class TestChartsCursor:
+
+    def test_cursor_round_trip(self):
+        assert chart_list.decode_cursor(chart_list.encode_cursor({'page': 2})) == {'page': 2}
+
+    def test_invalid_cursor(self):
+        with pytest.raises(ValueError):
+            chart_list.decode_cursor('not a cursor')
+
+    def _read_all(self, sort, limit):
+        sc = SupersetCKAN(**get_config())
+        ids, cursor, requests = [], None, 0
+        while True:
+            _, charts, cursor = chart_list.list_charts_after(
+                sc, cursor=cursor, limit=limit, sort=sort, order='asc', viz_type=[]
+            )
+            ids.extend(chart.id for chart in charts)
+            requests += 1
+            if not cursor:
+                return ids, requests
+
+    def test_keyset_when_sorting_by_id(self, app_httpx_mocked):
+        ids, requests = self._read_all('id', 6)
+
+        assert len(ids) == 20
+        assert ids == sorted(ids)
+        assert requests == 4
+
+    def test_pages_for_other_sorts(self, app_httpx_mocked):
+        ids, requests = self._read_all('name', 6)
+
+        assert sorted(ids) == sorted(set(ids))
+        assert len(ids) == 20
+        assert requests == 4
+
+    def test_cursor_of_other_sort(self, app_httpx_mocked):
+        sc = SupersetCKAN(**get_config())
+        cursor = chart_list.encode_cursor({'sort': 'id', 'after': 10})
+        with pytest.raises(ValueError):
+            chart_list.list_charts_after(sc, cursor=cursor, sort='name')
+
+    def test_json_endpoint(self, app_httpx_mocked):
+        sysadmin = ckan_factories.SysadminWithToken()
+        headers = {'Authorization': sysadmin['token']}
+        url = url_for('superset_blueprint.charts_json', filtered=1, sort='id', order='asc',
+                      limit=15, fields='slice_name', html=1)
+        data = app_httpx_mocked.get(url, headers=headers).json
+
+        assert data['count'] == 20
+        assert data['columns'] == ['id', 'slice_name']
+        assert len(data['result']) == 15
+        assert set(data['result'][0]) == {'id', 'slice_name', 'ckan_dataset'}
+        assert 'superset-index-tr' in data['html']
+
+        data = app_httpx_mocked.get(data['next_url'], headers=headers).json
+        assert len(data['result']) == 5
+        assert data['next_cursor'] is None
+
+    def test_json_limit_is_one_superset_page(self, app_httpx_mocked, capped_catalog):
+        sysadmin = ckan_factories.SysadminWithToken()
+        headers = {'Authorization': sysadmin['token']}
+        url = url_for('superset_blueprint.charts_json', filtered=1, sort='name', order='asc', limit=500, fields='id')
+        data = app_httpx_mocked.get(url, headers=headers).json
+        first = [chart['id'] for chart in data['result']]
+        data = app_httpx_mocked.get(data['next_url'], headers=headers).json
+        second = [chart['id'] for chart in data['result']]
+
+        assert len(first) == len(second) == 100
+        # Nothing skipped between the pages
+        expected = sorted(capped_catalog, key=lambda row: row['slice_name'])
+        assert first + second == [row['id'] for row in expected[:200]]
+
+    def test_json_negative_limit(self, app_httpx_mocked):
+        sysadmin = ckan_factories.SysadminWithToken()
+        url = url_for('superset_blueprint.charts_json', filtered=1, limit=-5)
+        data = app_httpx_mocked.get(url, headers={'Authorization': sysadmin['token']}).json
+
+        assert len(data['result']) == 1
+
+    @pytest.mark.parametrize('state', [
+        {'sort': 'name'},
+        {'sort': 'name', 'page': None},
+        {'sort': 'name', 'page': 0},
+        {'sort': 'id', 'after': [1]},
+    ])
+    def test_json_endpoint_crafted_cursor(self, app_httpx_mocked, state):
+        sysadmin = ckan_factories.SysadminWithToken()
+        url = url_for('superset_blueprint.charts_json', sort=state['sort'], cursor=chart_list.encode_cursor(state))
+        response = app_httpx_mocked.get(url, headers={'Authorization': sysadmin['token']}, status=400)
+
+        assert response.json['success'] is False
+
+    def test_json_endpoint_bad_cursor(self, app_httpx_mocked):
+        sysadmin = ckan_factories.SysadminWithToken()
+        url = url_for('superset_blueprint.charts_json', cursor='nope')
+        response = app_httpx_mocked.get(url, headers={'Authorization': sysadmin['token']}, status=400)
+
+        assert response.json['success'] is False
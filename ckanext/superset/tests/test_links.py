@@ -0,0 +1,53 @@
+"""
+Tests for the chart to CKAN dataset links.
+"""
+import pytest
+
+from ckan.tests import factories as ckan_factories
+from ckan.tests.helpers import call_action
+
+from ckanext.superset.data import links
+from ckanext.superset.data.chart import SupersetChart
+from ckanext.superset.tests import factories
+
+
+def _chart(chart_id):
+    chart = SupersetChart()
+    chart.load({'id': chart_id})
+    return chart
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+class TestChartLinks:
+
+    def test_bulk_resolution(self):
+        user = ckan_factories.Sysadmin()
+        pkg_1 = factories.SupersetDataset(user=user, chart_id='1')
+        pkg_2 = factories.SupersetDataset(user=user, chart_id='2')
+
+        packages = links.get_packages_by_chart_ids([1, '2', 3])
+
+        assert set(packages) == {'1', '2'}
+        assert packages['1']['name'] == pkg_1['name']
+        assert packages['2']['id'] == pkg_2['id']
+
+    def test_deleted_datasets_are_not_linked(self):
+        user = ckan_factories.Sysadmin()
+        pkg = factories.SupersetDataset(user=user, chart_id='5')
+        call_action('package_delete', {'user': user['name']}, id=pkg['id'])
+
+        assert links.get_package_by_chart_id(5) is None
+
+    def test_attach_resolves_every_chart(self):
+        user = ckan_factories.Sysadmin()
+        pkg = factories.SupersetDataset(user=user, chart_id='7')
+        charts = [_chart(7), _chart(8)]
+
+        links.attach_ckan_datasets(charts)
+
+        assert charts[0].ckan_dataset['id'] == pkg['id']
+        assert charts[1].ckan_dataset is None
+        assert charts[1]._ckan_dataset_resolved
+
+    def test_no_charts(self):
+        assert links.get_packages_by_chart_ids([]) == {}
@@ -0,0 +1,366 @@
+"""
+Tests for the Superset client (SupersetCKAN).
+"""
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests.helpers import call_action
+
+from ckanext.superset.config import get_config
+from ckanext.superset.data.columns import COLUMN_PRESETS, resolve_columns
+from ckanext.superset.data.downloads import download_chart
+from ckanext.superset.data.chart import SupersetChart
+from ckanext.superset.data.main import SupersetCKAN, remaining_pages
+from ckanext.superset.data.registry import chart_registry
+from ckanext.superset.exceptions import SupersetRequestException
+from ckanext.superset.model import SupersetCatalogState
+from ckanext.superset.tests import helpers
+
+
+class TestRemainingPages:
+
+    def test_single_page(self):
+        assert remaining_pages({'count': 20, 'result': [{}] * 20}, 100) == (100, [])
+
+    def test_more_pages(self):
+        assert remaining_pages({'count': 250, 'result': [{}] * 100}, 100) == (100, [1, 2])
+
+    def test_server_caps_page_size(self):
+        """ Superset returned less rows than requested but there are more """
+        assert remaining_pages({'count': 45, 'result': [{}] * 20}, 350) == (20, [1, 2])
+
+    def test_empty(self):
+        assert remaining_pages({'count': 0, 'result': []}, 100) == (100, [])
+
+
+def _chart(chart_id, viz_type='table', datasource_id=1, dashboards=None):
+    chart = SupersetChart()
+    chart.load({
+        'id': chart_id,
+        'viz_type': viz_type,
+        'datasource_id': datasource_id,
+        'dashboards': [{'id': d} for d in dashboards or []],
+    })
+    return chart
+
+
+class TestRegistry:
+
+    def test_get_by_str_or_int_id(self):
+        charts = chart_registry()
+        chart = charts.add(_chart(7))
+
+        assert charts.get(7) is chart
+        assert charts.get('7') is chart
+        assert '7' in charts and 7 in charts
+        assert charts.get(8) is None
+
+    def test_secondary_indexes(self):
+        charts = chart_registry()
+        charts.extend([
+            _chart(1, 'table', dashboards=[10]),
+            _chart(2, 'pie', dashboards=[10, 11]),
+            _chart(3, 'pie', datasource_id=2),
+        ])
+
+        assert [c.id for c in charts.by('viz_type', 'pie')] == [2, 3]
+        assert [c.id for c in charts.by('dashboard_id', 10)] == [1, 2]
+        assert [c.id for c in charts.by('datasource_id', 2)] == [3]
+        assert sorted(charts.values_of('viz_type')) == ['pie', 'table']
+
+    def test_replace_updates_indexes(self):
+        charts = chart_registry()
+        charts.add(_chart(1, 'table'))
+        charts.add(_chart(1, 'pie'))
+
+        assert len(charts) == 1
+        assert charts.by('viz_type', 'table') == []
+        assert [c.id for c in charts.by('viz_type', 'pie')] == [1]
+
+    def test_remove(self):
+        charts = chart_registry()
+        charts.extend([_chart(1), _chart(2)])
+        charts.remove('1')
+
+        assert charts.ids() == ['2']
+        assert [c.id for c in charts.by('viz_type', 'table')] == [2]
+
+
+@pytest.fixture
+def big_catalog(monkeypatch):
+    """ A Superset instance with 45 charts that serves at most 10 per page """
+    rows = [{'id': i, 'slice_name': f'Chart {i}', 'viz_type': 'table'} for i in range(1, 46)]
+    requests = []
+
+    def get_charts(request, params=None):
+        requests.append(request)
+        q = helpers.get_query(request)
+        size = min(q.get('page_size', 25), 10)
+        page = q.get('page', 0)
+        result = rows[page * size:(page + 1) * size]
+        return httpx.Response(200, json={'count': len(rows), 'result': result})
+
+    monkeypatch.setattr(helpers, 'get_api__v1__chart', get_charts)
+    return requests
+
+
+@pytest.mark.usefixtures('with_plugins')
+class TestLoaders:
+
+    def test_load_charts_reads_all_pages_in_order(self, app_httpx_mocked, big_catalog):
+        sc = SupersetCKAN(**get_config())
+        charts = sc.load_charts()
+
+        assert [chart.id for chart in charts] == list(range(1, 46))
+        assert len(big_catalog) == 5
+
+    def test_load_charts_force_reloads(self, app_httpx_mocked, big_catalog):
+        sc = SupersetCKAN(**get_config())
+        sc.load_charts()
+        charts = sc.load_charts(force=True)
+
+        assert len(charts) == 45
+
+    def test_get_chart_uses_loaded_charts(self, app_httpx_mocked, big_catalog):
+        sc = SupersetCKAN(**get_config())
+        sc.load_charts()
+
+        assert sc.get_chart('12').id == 12
+        assert len(big_catalog) == 5
+
+    def test_prefetch_many_charts_in_short_requests(self, app_httpx_mocked, monkeypatch):
+        rows = [{'id': i, 'slice_name': f'Chart {i}', 'viz_type': 'table'} for i in range(1, 251)]
+        id_filters = []
+
+        def get_charts(request, params=None):
+            for filter_ in helpers.get_query(request).get('filters', []):
+                id_filters.append(filter_['value'])
+            return httpx.Response(200, json=helpers.paginate(request, rows, max_page_size=100))
+
+        monkeypatch.setattr(helpers, 'get_api__v1__chart', get_charts)
+        sc = SupersetCKAN(**get_config())
+        charts = sc.prefetch_charts(range(1, 261))
+
+        assert sorted(chart.id for chart in charts) == list(range(1, 251))
+        assert max(len(ids) for ids in id_filters) <= 100
+        assert sc.get_chart('250').id == 250
+
+    @pytest.mark.ckan_config('ckanext.superset.page_size.chart', '5')
+    def test_configurable_page_size(self, app_httpx_mocked, big_catalog):
+        sc = SupersetCKAN(**get_config())
+        sc.load_charts()
+
+        assert len(big_catalog) == 9
+
+
+@pytest.mark.usefixtures('with_plugins')
+class TestColumnProjection:
+
+    def test_preset_is_sent_to_superset(self, app_httpx_mocked, big_catalog):
+        sc = SupersetCKAN(**get_config())
+        sc.load_charts(columns='index')
+
+        q = helpers.get_query(big_catalog[0])
+        assert q['columns'] == COLUMN_PRESETS['chart']['index']
+
+    def test_no_columns_by_default(self, app_httpx_mocked, big_catalog):
+        SupersetCKAN(**get_config()).load_charts()
+
+        assert 'columns' not in helpers.get_query(big_catalog[0])
+
+    def test_other_columns_reload(self, app_httpx_mocked, big_catalog):
+        sc = SupersetCKAN(**get_config())
+        sc.load_charts(columns=['id'])
+        sc.load_charts(columns=['id'])
+        assert len(big_catalog) == 5
+        sc.load_charts(columns='index')
+        assert len(big_catalog) == 10
+
+    def test_invalid_columns(self):
+        with pytest.raises(ValueError):
+            resolve_columns('chart', 'no pe')
+        with pytest.raises(ValueError):
+            resolve_columns('chart', ['id', 'slice_name;'])
+
+    def test_one_column_is_not_a_preset(self):
+        assert resolve_columns('chart', 'slice_name') == ['slice_name']
+        assert resolve_columns('chart', 'id, dashboards.id') == ['id', 'dashboards.id']
+        assert resolve_columns('chart', 'sync') == COLUMN_PRESETS['chart']['sync']
+
+    def test_chart_list_action(self, app_httpx_mocked):
+        result = call_action('superset_chart_list', columns='id,slice_name')
+
+        assert result['columns'] == ['id', 'slice_name']
+        assert result['count'] == 20
+        assert set(result['result'][0]) == {'id', 'slice_name'}
+
+    def test_chart_list_action_invalid_columns(self, app_httpx_mocked):
+        with pytest.raises(toolkit.ValidationError):
+            call_action('superset_chart_list', columns='no pe')
+
+
+@pytest.mark.ckan_config('ckanext.superset.catalog.ttl', '600')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+class TestCatalogCache:
+
+    def test_second_load_reads_the_cache(self, app_httpx_mocked, big_catalog):
+        SupersetCKAN(**get_config()).load_charts(columns='index')
+        charts = SupersetCKAN(**get_config()).load_charts(columns='index')
+
+        assert [chart.id for chart in charts] == list(range(1, 46))
+        assert len(big_catalog) == 5
+
+    def test_cache_does_not_end_the_caller_transaction(self, app_httpx_mocked, big_catalog):
+        # Pending work of the action using the Superset client
+        model.Session.add(model.Package(name='superset-pending-package'))
+        SupersetCKAN(**get_config()).load_charts(columns='index')
+        SupersetCKAN(**get_config()).load_charts(columns='index')
+        # Still pending: the cache did not commit it
+        assert model.Session.new
+        model.Session.rollback()
+
+        assert model.Package.by_name('superset-pending-package') is None
+        assert len(big_catalog) == 5
+
+    def test_other_columns_skip_the_cache(self, app_httpx_mocked, big_catalog):
+        SupersetCKAN(**get_config()).load_charts(columns='index')
+        SupersetCKAN(**get_config()).load_charts(columns=['id'])
+
+        assert len(big_catalog) == 10
+
+    def test_force_refreshes_the_cache(self, app_httpx_mocked, big_catalog):
+        SupersetCKAN(**get_config()).load_charts()
+        SupersetCKAN(**get_config()).load_charts(force=True)
+
+        assert len(big_catalog) == 10
+
+    @pytest.mark.ckan_config('ckanext.superset.catalog.ttl', '0')
+    def test_disabled_cache(self, app_httpx_mocked, big_catalog):
+        SupersetCKAN(**get_config()).load_charts()
+        SupersetCKAN(**get_config()).load_charts()
+
+        assert len(big_catalog) == 10
+
+
+@pytest.fixture
+def dated_catalog(monkeypatch):
+    """ 45 charts, the lower the ID the newer, Superset serves at most 10 per page """
+    base = datetime(2024, 11, 1, tzinfo=timezone.utc)
+    rows = {
+        i: {
+            'id': i,
+            'slice_name': f'Chart {i}',
+            'viz_type': 'table',
+            'changed_on_utc': (base - timedelta(hours=i)).strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
+        }
+        for i in range(1, 46)
+    }
+    requests = []
+
+    def get_charts(request, params=None):
+        requests.append(helpers.get_query(request))
+        q = helpers.get_query(request)
+        result = sorted(rows.values(), key=lambda row: row['changed_on_utc'], reverse=True)
+        size = min(q.get('page_size', 25), 10)
+        page = q.get('page', 0)
+        data = {'count': len(result), 'result': result[page * size:(page + 1) * size]}
+        if q.get('columns') == ['id']:
+            data['result'] = [{'id': row['id']} for row in data['result']]
+        return httpx.Response(200, json=data)
+
+    monkeypatch.setattr(helpers, 'get_api__v1__chart', get_charts)
+    return SimpleNamespace(rows=rows, requests=requests)
+
+
+def _expire_cache(resource_type, reconcile=False):
+    state = model.Session.get(SupersetCatalogState, resource_type)
+    state.fetched_at = datetime.utcnow() - timedelta(hours=2)
+    if reconcile:
+        state.reconciled_at = datetime.utcnow() - timedelta(days=2)
+    model.Session.commit()
+
+
+@pytest.mark.ckan_config('ckanext.superset.catalog.ttl', '600')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+class TestIncrementalCatalog:
+
+    def test_only_changed_charts_are_requested(self, app_httpx_mocked, dated_catalog):
+        SupersetCKAN(**get_config()).load_charts(columns='index')
+        _expire_cache('chart')
+        dated_catalog.rows[7]['slice_name'] = 'Updated'
+        dated_catalog.rows[7]['changed_on_utc'] = '2025-01-01T10:00:00.000000+0000'
+        del dated_catalog.requests[:]
+
+        charts = SupersetCKAN(**get_config()).load_charts(columns='index')
+
+        assert len(dated_catalog.requests) == 1
+        assert dated_catalog.requests[0]['order_direction'] == 'desc'
+        assert len(charts) == 45
+        assert charts[0].id == 7
+        assert charts[0]['slice_name'] == 'Updated'
+
+    def test_deleted_charts_are_dropped(self, app_httpx_mocked, dated_catalog):
+        SupersetCKAN(**get_config()).load_charts(columns='index')
+        _expire_cache('chart', reconcile=True)
+        del dated_catalog.rows[3]
+        del dated_catalog.requests[:]
+
+        charts = SupersetCKAN(**get_config()).load_charts(columns='index')
+
+        assert [q.get('columns') for q in dated_catalog.requests[1:]] == [['id']] * 5
+        assert len(charts) == 44
+        assert 3 not in [chart.id for chart in charts]
+
+    def test_columns_without_changed_on_reload_everything(self, app_httpx_mocked, dated_catalog):
+        SupersetCKAN(**get_config()).load_charts(columns=['id', 'slice_name'])
+        _expire_cache('chart')
+        del dated_catalog.requests[:]
+
+        SupersetCKAN(**get_config()).load_charts(columns=['id', 'slice_name'])
+
+        assert 'order_column' not in dated_catalog.requests[0]
+        assert len(dated_catalog.requests) == 5
+
+
+CSV = b"year,cantidad_mundos\n2021,50\n2022,70\n2023,90"
+
+
+@pytest.mark.usefixtures('with_plugins')
+class TestDownload:
+
+    def test_streamed_to_file(self, app_httpx_mocked):
+        sc = SupersetCKAN(**get_config())
+        f = BytesIO()
+        size, sha256 = sc.download('chart/32/data/?format=csv', f, chunk_size=8)
+
+        assert f.getvalue() == CSV
+        assert size == len(CSV)
+        assert sha256 == hashlib.sha256(CSV).hexdigest()
+
+    def test_temporary_file_is_removed(self, app_httpx_mocked, tmp_path):
+        chart = SupersetCKAN(**get_config()).get_chart(32)
+        with download_chart(chart, directory=str(tmp_path)) as export:
+            assert export.size == len(CSV)
+            assert export.upload('data.csv').read() == CSV
+            assert os.path.exists(export.path)
+
+        assert os.listdir(tmp_path) == []
+
+    def test_failed_download_is_removed(self, app_httpx_mocked, tmp_path, monkeypatch):
+        monkeypatch.setattr(
+            helpers, 'get_api__v1__chart__32__data',
+            lambda request, params=None: httpx.Response(500), raising=False
+        )
+        chart = SupersetCKAN(**get_config()).get_chart(32)
+        with pytest.raises(SupersetRequestException):
+            download_chart(chart, directory=str(tmp_path))
+
+        assert os.listdir(tmp_path) == []
@@ -0,0 +1,100 @@
+"""
+Tests for the shared Superset sessions.
+"""
+import httpx
+import pytest
+
+from ckanext.superset.config import get_config
+from ckanext.superset.data.main import SupersetCKAN
+from ckanext.superset.data.session import token_expiry
+from ckanext.superset.tests import helpers
+
+
+@pytest.fixture
+def login_calls(monkeypatch):
+    """ Count the API logins sent to the mocked Superset """
+    calls = []
+    original = helpers.post_api__v1__security__login
+
+    def counting_login(request, params=None):
+        calls.append(request)
+        return original(request, params=params)
+
+    monkeypatch.setattr(helpers, 'post_api__v1__security__login', counting_login)
+    return calls
+
+
+def _expire_once(monkeypatch):
+    """ Make the next chart/32 request fail with a 401 """
+    original = helpers.get_api__v1__chart__32
+    responses = [httpx.Response(401, json={'msg': 'Token has expired'})]
+
+    def expiring_chart(request, params=None):
+        if responses:
+            return responses.pop()
+        return original(request, params=params)
+
+    monkeypatch.setattr(helpers, 'get_api__v1__chart__32', expiring_chart)
+
+
+class TestTokenExpiry:
+
+    def test_reads_exp_claim(self):
+        # {"alg":"HS256"}.{"exp":1700000000}.signature
+        token = 'eyJhbGciOiJIUzI1NiJ9.eyJleHAiOjE3MDAwMDAwMDB9.c2ln'
+        assert token_expiry(token) == 1700000000
+
+    def test_not_a_jwt(self):
+        assert token_expiry('test_token') is None
+        assert token_expiry(None) is None
+
+
+@pytest.mark.usefixtures('with_plugins')
+class TestSharedSession:
+
+    def test_clients_share_one_login(self, app_httpx_mocked, login_calls):
+        first = SupersetCKAN(**get_config())
+        second = SupersetCKAN(**get_config())
+
+        first.get('chart/32')
+        second.get('chart/32')
+
+        assert len(login_calls) == 1
+        assert first.session is second.session
+        assert first.client is second.client
+
+    def test_expired_token_is_refreshed(self, app_httpx_mocked, login_calls, monkeypatch):
+        sc = SupersetCKAN(**get_config())
+        sc.get('chart/32')
+
+        _expire_once(monkeypatch)
+        data = sc.get('chart/32')
+
+        assert data['result']['id'] == 32
+        assert sc.access_token == 'test_token_refreshed'
+        assert len(login_calls) == 1
+
+    def test_rejected_refresh_logs_in_again(self, app_httpx_mocked, login_calls, monkeypatch):
+        sc = SupersetCKAN(**get_config())
+        sc.get('chart/32')
+
+        monkeypatch.setattr(
+            helpers, 'post_api__v1__security__refresh',
+            lambda request, params=None: httpx.Response(401, json={'msg': 'Token has expired'})
+        )
+        _expire_once(monkeypatch)
+        sc.get('chart/32')
+
+        assert len(login_calls) == 2
+
+    def test_other_process_reuses_stored_login(self, app_httpx_mocked, login_calls):
+        first = SupersetCKAN(**get_config())
+        first.get('chart/32')
+        # Simulate a new worker: nothing in memory, only the stored login
+        first.session.invalidate()
+
+        sc = SupersetCKAN(**get_config())
+        sc.get('chart/32')
+
+        assert len(login_calls) == 1
+        assert sc.access_token == 'test_token'
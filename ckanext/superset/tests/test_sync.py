@@ -1,17 +1,27 @@
 """
 Tests for the periodic Superset sync module.
 """
+import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from types import SimpleNamespace
 
+import httpx
 import pytest
 
+from ckan import model
 from ckan.lib.helpers import url_for
 from ckan.plugins import toolkit
 from ckan.tests import factories as ckan_factories
 
+from ckanext.superset.cli import superset as superset_cli
+from ckanext.superset.data import schedule
 from ckanext.superset.data import sync as sync_module
-from ckanext.superset.tests import factories
+from ckanext.superset.data import sync_runner
+from ckanext.superset.data.scheduler import SyncScheduler
+from ckanext.superset.exceptions import SupersetRequestException
+from ckanext.superset.model import SupersetSyncSchedule
+from ckanext.superset.tests import factories, helpers
 
 
 @pytest.fixture
@@ -46,6 +56,37 @@ class TestCalculateNextSync:
     def test_missing_returns_none(self):
         assert sync_module.calculate_next_sync(None) is None
 
+    def test_spread_is_deterministic_per_package(self):
+        base = datetime(2026, 4, 19, 12, 0, tzinfo=timezone.utc)
+        first = sync_module.calculate_next_sync('daily', from_dt=base, package_id='pkg-a')
+        assert first == sync_module.calculate_next_sync('daily', from_dt=base, package_id='pkg-a')
+        assert abs(first - (base + timedelta(days=1))) <= timedelta(hours=12)
+
+    def test_spread_does_not_drift(self):
+        base = datetime(2026, 4, 19, 12, 0, tzinfo=timezone.utc)
+        first = sync_module.calculate_next_sync('daily', from_dt=base, package_id='pkg-a')
+        # Synced a few minutes late, the next sync is still at the same time of day
+        second = sync_module.calculate_next_sync('daily', from_dt=first + timedelta(minutes=7), package_id='pkg-a')
+        assert second == first + timedelta(days=1)
+
+    @pytest.mark.ckan_config('ckanext.superset.sync.windows', '02:00-04:00')
+    def test_spread_inside_windows(self):
+        base = datetime(2026, 4, 19, 1, 0, tzinfo=timezone.utc)
+        for package_id in ('pkg-a', 'pkg-b', 'pkg-c', 'pkg-d'):
+            next_sync = sync_module.calculate_next_sync('daily', from_dt=base, package_id=package_id)
+            assert 2 <= next_sync.hour < 4
+
+    @pytest.mark.ckan_config('ckanext.superset.sync.spread', 'false')
+    def test_spread_disabled(self):
+        base = datetime(2026, 4, 19, 12, 0, tzinfo=timezone.utc)
+        assert sync_module.calculate_next_sync('daily', from_dt=base, package_id='pkg-a') == base + timedelta(days=1)
+
+    def test_parse_windows(self):
+        assert schedule.parse_windows('') == [(0, schedule.DAY_SECONDS)]
+        assert schedule.parse_windows('22:00-02:00') == [(0, 7200), (79200, schedule.DAY_SECONDS)]
+        with pytest.raises(ValueError):
+            schedule.parse_windows('late')
+
 
 class TestMergeExtras:
 
@@ -148,6 +189,369 @@ class TestSyncSettingsAndScheduler:
         assert sync_module.get_extra(refreshed, sync_module.EXTRA_LAST_SYNC) is not None
         assert sync_module.get_extra(refreshed, sync_module.EXTRA_NEXT_SYNC) is not None
 
+    def test_schedule_row_follows_the_settings(self, setup_data):
+        pkg = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+        sync_module.update_sync_settings(pkg['id'], 'weekly', True, self._ctx(setup_data))
+
+        row = model.Session.get(SupersetSyncSchedule, pkg['id'])
+        assert row.chart_id == '32'
+        assert row.frequency == 'weekly'
+        assert row.enabled is True
+        assert row.next_sync > datetime.utcnow() + timedelta(days=6)
+
+        sync_module.update_sync_settings(pkg['id'], 'weekly', False, self._ctx(setup_data))
+        model.Session.refresh(row)
+        assert row.enabled is False
+        assert row.next_sync is None
+
+    def test_find_due_reads_the_schedule_table(self, setup_data):
+        pkg = factories.SupersetDataset(user=setup_data.sysadmin)
+        sync_module.update_sync_settings(pkg['id'], 'daily', True, self._ctx(setup_data))
+        # The scheduler does not look at the extras anymore
+        model.Session.get(SupersetSyncSchedule, pkg['id']).next_sync = datetime.utcnow() - timedelta(minutes=1)
+        model.Session.commit()
+
+        assert sync_module.find_due_package_ids() == [pkg['id']]
+
+    def _make_due(self, setup_data, chart_id='32'):
+        pkg = factories.SupersetDataset(user=setup_data.sysadmin, chart_id=chart_id)
+        factories.SupersetResource(package_id=pkg['id'], user=setup_data.sysadmin)
+        sync_module.update_sync_settings(pkg['id'], 'daily', True, self._ctx(setup_data))
+        model.Session.get(SupersetSyncSchedule, pkg['id']).next_sync = datetime.utcnow() - timedelta(minutes=1)
+        model.Session.commit()
+        return pkg
+
+    def test_claimed_packages_are_not_claimed_again(self, setup_data):
+        pkg = self._make_due(setup_data)
+
+        assert sync_module.claim_due_package_ids() == [pkg['id']]
+        # e.g. another node
+        assert sync_module.claim_due_package_ids() == []
+        row = model.Session.get(SupersetSyncSchedule, pkg['id'])
+        assert row.leased_by == schedule.lease_owner()
+        assert row.lease_expires > datetime.utcnow()
+
+    def test_expired_leases_are_claimed_again(self, setup_data):
+        pkg = self._make_due(setup_data)
+        assert sync_module.claim_due_package_ids() == [pkg['id']]
+        # The node died while syncing
+        model.Session.get(SupersetSyncSchedule, pkg['id']).lease_expires = datetime.utcnow() - timedelta(seconds=1)
+        model.Session.commit()
+
+        assert sync_module.claim_due_package_ids() == [pkg['id']]
+
+    def test_claim_limit(self, setup_data):
+        first = self._make_due(setup_data)
+        second = self._make_due(setup_data)
+
+        claimed = sync_module.claim_due_package_ids(limit=1)
+        assert len(claimed) == 1
+        assert sync_module.claim_due_package_ids() == [p['id'] for p in (first, second) if p['id'] not in claimed]
+
+    def test_scheduler_drops_packages_leased_by_other_nodes(self, setup_data):
+        pkg = self._make_due(setup_data)
+        row = model.Session.get(SupersetSyncSchedule, pkg['id'])
+        row.leased_by = 'other-node:1'
+        row.lease_expires = datetime.utcnow() + timedelta(hours=1)
+        model.Session.commit()
+        scheduler = SyncScheduler()
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            assert scheduler.tick(pool) == []
+        # The row did not change, it is not queued again on the next polls
+        scheduler.refresh()
+        assert scheduler.pop_due() == []
+
+    def test_scheduler_retries_when_superset_is_down(self, setup_data, monkeypatch):
+        pkg = self._make_due(setup_data)
+
+        def login():
+            raise SupersetRequestException('Superset is down')
+
+        monkeypatch.setattr(sync_runner, 'login', login)
+        scheduler = SyncScheduler(poll_interval=60)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            assert scheduler.tick(pool) == []
+
+        # Not leased, and queued for the next poll
+        assert model.Session.get(SupersetSyncSchedule, pkg['id']).leased_by is None
+        assert scheduler.pop_due() == []
+        assert scheduler.pop_due(now=datetime.now(timezone.utc) + timedelta(minutes=2)) == [pkg['id']]
+
+    def test_release_leases(self, setup_data):
+        pkg = self._make_due(setup_data)
+        assert sync_module.claim_due_package_ids() == [pkg['id']]
+
+        schedule.release_leases([pkg['id']])
+
+        assert sync_module.claim_due_package_ids() == [pkg['id']]
+
+    def test_sync_of_a_missing_dataset_releases_the_lease(self, setup_data, monkeypatch):
+        pkg = self._make_due(setup_data)
+        # Claimed by the command that enqueued the job
+        row = model.Session.get(SupersetSyncSchedule, pkg['id'])
+        row.leased_by = 'other-node:1'
+        row.lease_expires = datetime.utcnow() + timedelta(hours=1)
+        model.Session.commit()
+        get_action = toolkit.get_action
+
+        def package_show(context, data_dict):
+            raise toolkit.ObjectNotFound()
+
+        monkeypatch.setattr(toolkit, 'get_action', lambda name: package_show if name == 'package_show' else get_action(name))
+        results = sync_module.sync_packages([pkg['id']])
+
+        assert results[0]['error'] == 'Dataset not found'
+        assert sync_module.claim_due_package_ids() == [pkg['id']]
+
+    def test_run_due_syncs_without_superset_does_not_lease(self, cli, setup_data, monkeypatch):
+        pkg = self._make_due(setup_data)
+
+        def login():
+            raise SupersetRequestException('Superset is down')
+
+        monkeypatch.setattr(sync_runner, 'login', login)
+        result = cli.invoke(superset_cli, ['run-due-syncs', '--workers', '2'])
+
+        assert result.exit_code != 0
+        assert 'Unable to connect to Superset' in result.output
+        assert sync_module.claim_due_package_ids() == [pkg['id']]
+
+    def test_sync_releases_the_lease(self, app_httpx_mocked, setup_data):
+        pkg = self._make_due(setup_data)
+        assert sync_module.claim_due_package_ids() == [pkg['id']]
+
+        sync_module.sync_dataset(pkg['id'])
+
+        row = model.Session.get(SupersetSyncSchedule, pkg['id'])
+        model.Session.refresh(row)
+        assert row.leased_by is None
+        assert row.lease_expires is None
+
+    @pytest.mark.ckan_config('ckanext.superset.sync.max_per_slot', '1')
+    def test_full_slot_moves_the_next_sync(self, setup_data):
+        pkg = factories.SupersetDataset(user=setup_data.sysadmin)
+        sync_module.update_sync_settings(pkg['id'], 'daily', True, self._ctx(setup_data))
+        base = datetime(2026, 4, 19, 12, 0, tzinfo=timezone.utc)
+        free = sync_module.calculate_next_sync('daily', from_dt=base, package_id='other')
+        # Take the slot of the other package
+        model.Session.get(SupersetSyncSchedule, pkg['id']).next_sync = schedule.to_naive_utc(free)
+        model.Session.commit()
+
+        moved = sync_module.calculate_next_sync('daily', from_dt=base, package_id='other')
+        slot = timedelta(seconds=schedule.get_slot_size())
+        assert free < moved <= free + slot
+        # A package does not count against itself
+        assert sync_module.calculate_next_sync('daily', from_dt=base, package_id=pkg['id']) is not None
+
+    def test_scheduler_reads_rows_committed_late(self, setup_data):
+        first = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+        second = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+        for pkg in (first, second):
+            sync_module.update_sync_settings(pkg['id'], 'daily', True, self._ctx(setup_data))
+        scheduler = SyncScheduler(overlap=60)
+        scheduler.refresh()
+
+        seen = model.Session.get(SupersetSyncSchedule, first['id'])
+        seen.modified = datetime.utcnow()
+        model.Session.commit()
+        scheduler.refresh()
+        # Saved before the row above, but committed after the poll
+        late = model.Session.get(SupersetSyncSchedule, second['id'])
+        late.next_sync = datetime.utcnow() - timedelta(minutes=1)
+        late.modified = seen.modified - timedelta(seconds=5)
+        model.Session.commit()
+        scheduler.refresh()
+
+        assert scheduler.pop_due() == [second['id']]
+
+    def test_scheduler_queue_follows_the_changes(self, setup_data):
+        pkg = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+        sync_module.update_sync_settings(pkg['id'], 'daily', True, self._ctx(setup_data))
+        scheduler = SyncScheduler()
+        scheduler.refresh()
+        assert scheduler.pop_due() == []
+        assert pkg['id'] in scheduler.next_syncs
+
+        row = model.Session.get(SupersetSyncSchedule, pkg['id'])
+        row.next_sync = datetime.utcnow() - timedelta(minutes=1)
+        row.modified = datetime.utcnow()
+        model.Session.commit()
+        scheduler.refresh()
+        assert scheduler.pop_due() == [pkg['id']]
+        # Popped items are not due twice
+        assert scheduler.pop_due() == []
+
+        sync_module.update_sync_settings(pkg['id'], 'daily', False, self._ctx(setup_data))
+        scheduler.refresh()
+        assert pkg['id'] not in scheduler.next_syncs
+
+    def test_scheduler_syncs_the_due_datasets(self, app_httpx_mocked, setup_data):
+        pkg = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+        factories.SupersetResource(package_id=pkg['id'], user=setup_data.sysadmin)
+        sync_module.update_sync_settings(pkg['id'], 'daily', True, self._ctx(setup_data))
+        model.Session.get(SupersetSyncSchedule, pkg['id']).next_sync = datetime.utcnow() - timedelta(minutes=1)
+        model.Session.commit()
+        done = []
+        scheduler = SyncScheduler(workers=2, on_result=done.append)
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = scheduler.tick(pool)
+            for future in futures:
+                future.result()
+
+        assert [r['package_id'] for r in done] == [pkg['id']]
+        assert done[0]['status'] == 'ok'
+        assert scheduler.running == set()
+        # The new next sync is read on the next poll
+        scheduler.refresh()
+        assert scheduler.next_syncs[pkg['id']] > datetime.utcnow()
+
+    def test_sync_result_is_saved_in_the_schedule(self, app_httpx_mocked, setup_data):
+        pkg = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+        factories.SupersetResource(package_id=pkg['id'], user=setup_data.sysadmin)
+        sync_module.update_sync_settings(pkg['id'], 'daily', True, self._ctx(setup_data))
+
+        sync_module.sync_dataset(pkg['id'])
+
+        row = model.Session.get(SupersetSyncSchedule, pkg['id'])
+        model.Session.refresh(row)
+        assert row.last_status == 'ok'
+        assert row.last_sync is not None
+        assert row.last_duration >= 0
+
+    def test_run_syncs_with_threads(self, app_httpx_mocked, setup_data):
+        package_ids = []
+        for _ in range(3):
+            pkg = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+            factories.SupersetResource(package_id=pkg['id'], user=setup_data.sysadmin)
+            package_ids.append(pkg['id'])
+        done = []
+
+        results, summary = sync_runner.run_syncs(package_ids, workers=2, on_result=done.append)
+
+        assert sorted(r['package_id'] for r in results) == sorted(package_ids)
+        assert len(done) == 3
+        assert summary['total'] == 3
+        assert summary['ok'] == 3
+        for package_id in package_ids:
+            refreshed = toolkit.get_action('package_show')({'ignore_auth': True}, {'id': package_id})
+            assert sync_module.get_extra(refreshed, sync_module.EXTRA_LAST_STATUS) == 'ok'
+
+    def test_sync_batch_lists_the_charts_once(self, app_httpx_mocked, setup_data, monkeypatch):
+        package_ids = []
+        for _ in range(2):
+            pkg = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+            factories.SupersetResource(package_id=pkg['id'], user=setup_data.sysadmin)
+            sync_module.update_sync_settings(pkg['id'], 'daily', True, self._ctx(setup_data))
+            package_ids.append(pkg['id'])
+        chart_32 = json.loads(helpers._get_from_samples('chart_32.json'))['result']
+        listings = []
+
+        def chart_list(request, params=None):
+            listings.append(helpers.get_query(request))
+            return httpx.Response(200, json=helpers.paginate(request, [chart_32]))
+
+        monkeypatch.setattr(helpers, 'get_api__v1__chart', chart_list)
+        # Each chart must not be requested by itself
+        monkeypatch.setattr(helpers, 'get_api__v1__chart__32', None)
+
+        results, summary = sync_runner.sync_batch(package_ids)
+
+        assert summary['ok'] == 2
+        assert len(listings) == 1
+        assert listings[0]['filters'] == [{'col': 'id', 'opr': 'in', 'value': [32]}]
+        assert 'thumbnail_url' in listings[0]['columns']
+
+    def test_batches(self):
+        assert sync_runner.batches(['a', 'b', 'c'], 2, chart_ids={}) == [['a', 'b'], ['c']]
+        assert sync_runner.batches([], 2, chart_ids={}) == []
+        # Packages of the same chart are not split
+        chart_ids = {'a': '1', 'b': '2', 'c': '1'}
+        assert sync_runner.batches(['a', 'b', 'c'], 2, chart_ids=chart_ids) == [['a', 'c'], ['b']]
+
+    def test_packages_of_the_same_chart_share_one_download(self, app_httpx_mocked, setup_data, monkeypatch):
+        package_ids = []
+        for _ in range(3):
+            pkg = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+            factories.SupersetResource(package_id=pkg['id'], user=setup_data.sysadmin)
+            package_ids.append(pkg['id'])
+        downloads = []
+        csv_data = helpers.get_api__v1__chart__32__data
+
+        def chart_data(request, params=None):
+            downloads.append(request.url)
+            return csv_data(request, params=params)
+
+        monkeypatch.setattr(helpers, 'get_api__v1__chart__32__data', chart_data)
+
+        results = sync_module.sync_packages(package_ids)
+
+        assert len(downloads) == 1
+        assert sorted(r['package_id'] for r in results) == sorted(package_ids)
+        assert {r['status'] for r in results} == {'ok'}
+        for package_id in package_ids:
+            refreshed = toolkit.get_action('package_show')({'ignore_auth': True}, {'id': package_id})
+            assert sync_module.get_extra(refreshed, sync_module.EXTRA_LAST_HASH)
+
+    def test_sync_dataset_unchanged_data_skips_upload(self, app_httpx_mocked, setup_data, monkeypatch):
+        pkg = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+        factories.SupersetResource(package_id=pkg['id'], user=setup_data.sysadmin)
+        sync_module.update_sync_settings(pkg['id'], 'daily', True, self._ctx(setup_data))
+        assert sync_module.sync_dataset(pkg['id'])['status'] == sync_module.STATUS_OK
+
+        uploads = []
+        get_action = toolkit.get_action
+
+        def spy_get_action(name):
+            action = get_action(name)
+            if name != 'resource_patch':
+                return action
+
+            def resource_patch(context, data):
+                uploads.append(data['id'])
+                return action(context, data)
+            return resource_patch
+
+        monkeypatch.setattr(toolkit, 'get_action', spy_get_action)
+        result = sync_module.sync_dataset(pkg['id'])
+
+        assert result['status'] == sync_module.STATUS_UNCHANGED
+        assert uploads == []
+        refreshed = get_action('package_show')({'ignore_auth': True}, {'id': pkg['id']})
+        assert sync_module.get_extra(refreshed, sync_module.EXTRA_LAST_STATUS) == 'unchanged'
+        assert len(sync_module.get_extra(refreshed, sync_module.EXTRA_LAST_HASH)) == 64
+
+        assert sync_module.sync_dataset(pkg['id'], force=True)['status'] == sync_module.STATUS_OK
+        assert len(uploads) == 1
+
+    def test_sync_upload_runs_the_resource_hooks(self, app_httpx_mocked, setup_data, monkeypatch):
+        """ New data goes through resource_patch (DataPusher / XLoader hooks),
+        the sync state of unchanged data is a single package update """
+        pkg = factories.SupersetDataset(user=setup_data.sysadmin, chart_id='32')
+        resource = factories.SupersetResource(package_id=pkg['id'], user=setup_data.sysadmin)
+        sync_module.update_sync_settings(pkg['id'], 'daily', True, self._ctx(setup_data))
+        writes = []
+        get_action = toolkit.get_action
+
+        def spy_get_action(name):
+            if name in ('package_update', 'package_patch', 'resource_update', 'resource_patch'):
+                writes.append(name)
+            return get_action(name)
+
+        monkeypatch.setattr(toolkit, 'get_action', spy_get_action)
+        assert sync_module.sync_dataset(pkg['id'])['status'] == sync_module.STATUS_OK
+
+        assert writes == ['resource_patch', 'package_patch']
+        refreshed = get_action('package_show')({'ignore_auth': True}, {'id': pkg['id']})
+        assert refreshed['resources'][0]['id'] == resource['id']
+        assert refreshed['resources'][0]['url_type'] == 'upload'
+        assert sync_module.get_extra(refreshed, sync_module.EXTRA_LAST_STATUS) == 'ok'
+
+        writes.clear()
+        assert sync_module.sync_dataset(pkg['id'])['status'] == sync_module.STATUS_UNCHANGED
+        assert writes == ['package_patch']
+
     @pytest.mark.ckan_config('ckan.plugins', 'activity superset')
     def test_sync_failure_creates_activity(self, setup_data):
         """ A sync failure must surface in the dataset's CKAN activity stream. """
@@ -0,0 +1,345 @@
+"""
+Tests for the chart thumbnails cache.
+"""
+import json
+import os
+from io import BytesIO
+
+import httpx
+import pytest
+
+from ckan.lib.helpers import url_for
+from ckan.plugins import toolkit
+from ckan.tests import factories as ckan_factories
+
+from ckanext.superset.data import thumbnail_jobs
+from ckanext.superset.data.thumbnails import ThumbnailCache, get_cache, get_digest
+from ckanext.superset.tests import helpers
+
+DIGEST = 'ce90a87d38fa6a2d8fa20232c1cba6f3'
+
+
+def test_get_digest():
+    assert get_digest(f'/api/v1/chart/32/thumbnail/{DIGEST}/') == DIGEST
+    assert get_digest('Thumbnail Url') is None
+    assert get_digest(None) is None
+
+
+class TestThumbnailCache:
+
+    def test_put_and_get(self, tmp_path):
+        cache = ThumbnailCache(str(tmp_path), max_bytes=1000)
+        path = cache.put(32, 'abc', b'image')
+
+        assert cache.get(32, 'abc') == path
+        assert cache.get(32, 'other') is None
+
+    def test_new_digest_replaces_the_old_one(self, tmp_path):
+        cache = ThumbnailCache(str(tmp_path), max_bytes=1000)
+        cache.put(32, 'old', b'image')
+        cache.put(32, 'new', b'image')
+
+        assert cache.get(32, 'old') is None
+        assert cache.get(32, 'new')
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = ThumbnailCache(str(tmp_path), max_bytes=25)
+        for chart_id in (1, 2):
+            path = cache.put(chart_id, 'd', b'x' * 10)
+            os.utime(path, (chart_id, chart_id))
+        # Reading the first one makes it the most recent
+        cache.get(1, 'd')
+        cache.put(3, 'd', b'x' * 10)
+
+        assert cache.get(1, 'd')
+        assert cache.get(2, 'd') is None
+        assert cache.get(3, 'd')
+
+    def test_invalid_digest(self, tmp_path):
+        with pytest.raises(ValueError):
+            ThumbnailCache(str(tmp_path)).path(32, '../../etc')
+
+    def test_scans_the_directory_only_over_the_size(self, tmp_path, monkeypatch):
+        cache = ThumbnailCache(str(tmp_path), max_bytes=100)
+        cache.put(1, 'd', b'x' * 10)
+        scans = []
+        entries = cache._entries
+
+        def spy_entries():
+            scans.append(1)
+            return entries()
+
+        monkeypatch.setattr(cache, '_entries', spy_entries)
+        for chart_id in range(2, 10):
+            cache.put(chart_id, 'd', b'x' * 10)
+        assert scans == []
+
+        cache.put(10, 'd', b'x' * 20)
+        assert len(scans) == 1
+        assert cache.size == 90
+        assert len(os.listdir(tmp_path)) == 8
+
+    def test_shared_cache(self, tmp_path, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'ckanext.superset.thumbnails.cache_dir', str(tmp_path))
+        assert get_cache() is get_cache()
+        assert get_cache().directory == str(tmp_path)
+
+
+@pytest.fixture
+def large_png():
+    Image = pytest.importorskip('PIL.Image')
+    output = BytesIO()
+    Image.new('RGBA', (800, 400), (0, 128, 255, 128)).save(output, format='PNG')
+    return output.getvalue()
+
+
+class TestThumbnailVariants:
+
+    def test_resized_once(self, tmp_path, large_png):
+        from PIL import Image
+
+        cache = ThumbnailCache(str(tmp_path), max_bytes=10 ** 6)
+        cache.put(32, 'abc', large_png)
+        path = cache.get_variant(32, 'abc', 160, 'webp')
+
+        assert path.endswith('32-abc-w160.webp')
+        with Image.open(path) as image:
+            assert image.format == 'WEBP'
+            assert image.size == (160, 80)
+        mtime = os.stat(path).st_mtime_ns
+        assert cache.get_variant(32, 'abc', 160, 'webp') == path
+        assert os.stat(path).st_mtime_ns >= mtime
+
+    def test_jpeg_without_alpha(self, tmp_path, large_png):
+        from PIL import Image
+
+        cache = ThumbnailCache(str(tmp_path), max_bytes=10 ** 6)
+        cache.put(32, 'abc', large_png)
+        with Image.open(cache.get_variant(32, 'abc', 320, 'jpeg')) as image:
+            assert image.format == 'JPEG'
+            assert image.mode == 'RGB'
+
+    def test_not_cached_original(self, tmp_path, large_png):
+        assert ThumbnailCache(str(tmp_path)).get_variant(32, 'abc', 160, 'webp') is None
+
+    def test_original_removed_meanwhile(self, tmp_path, large_png, monkeypatch):
+        cache = ThumbnailCache(str(tmp_path), max_bytes=10 ** 6)
+        path = cache.put(32, 'abc', large_png)
+        # Evicted by another process between get() and open()
+        get = cache.get
+
+        def get_and_evict(chart_id, digest):
+            found = get(chart_id, digest)
+            os.remove(path)
+            return found
+
+        monkeypatch.setattr(cache, 'get', get_and_evict)
+        assert cache.get_variant(32, 'abc', 160, 'webp') is None
+
+    def test_variant_does_not_scan_the_cache(self, tmp_path, large_png, monkeypatch):
+        cache = ThumbnailCache(str(tmp_path), max_bytes=10 ** 6)
+        cache.put(32, 'abc', large_png)
+        monkeypatch.setattr(cache, 'evict', lambda: pytest.fail('evict() under the cache size'))
+        assert cache.get_variant(32, 'abc', 160, 'webp')
+
+    def test_unsupported_variant(self, tmp_path):
+        with pytest.raises(ValueError):
+            ThumbnailCache(str(tmp_path)).variant_path(32, 'abc', 1000, 'webp')
+        with pytest.raises(ValueError):
+            ThumbnailCache(str(tmp_path)).variant_path(32, 'abc', 160, 'gif')
+
+    def test_new_digest_drops_the_variants(self, tmp_path, large_png):
+        cache = ThumbnailCache(str(tmp_path), max_bytes=10 ** 6)
+        cache.put(32, 'old', large_png)
+        cache.get_variant(32, 'old', 160, 'webp')
+        cache.put(32, 'new', large_png)
+        cache.get_variant(32, 'new', 80, 'jpeg')
+
+        assert sorted(os.listdir(tmp_path)) == ['32-new-w80.jpg', '32-new.png']
+
+
+@pytest.mark.usefixtures('with_plugins')
+class TestChartImage:
+
+    @pytest.fixture
+    def sysadmin_headers(self, clean_db):
+        sysadmin = ckan_factories.SysadminWithToken()
+        return {'Authorization': sysadmin['token']}
+
+    @pytest.fixture(autouse=True)
+    def cache_dir(self, tmp_path, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'ckanext.superset.thumbnails.cache_dir', str(tmp_path))
+        return tmp_path
+
+    def test_served_and_cached(self, app_httpx_mocked, sysadmin_headers, cache_dir):
+        url = url_for('superset_images.chart_image', chart_id=32, d=DIGEST)
+        response = app_httpx_mocked.get(url, headers=sysadmin_headers)
+
+        assert response.status_code == 200
+        assert response.data == helpers.THUMBNAIL_PNG
+        assert response.headers['ETag'] == f'"32-{DIGEST}"'
+        assert 'immutable' in response.headers['Cache-Control']
+        assert os.listdir(cache_dir) == [f'32-{DIGEST}.png']
+
+    def test_cached_thumbnail_does_not_call_superset(self, app_httpx_mocked, sysadmin_headers, cache_dir, monkeypatch):
+        ThumbnailCache(str(cache_dir)).put(32, DIGEST, b'cached')
+        monkeypatch.setattr(helpers, 'get_api__v1__chart__32', None)
+
+        url = url_for('superset_images.chart_image', chart_id=32, d=DIGEST)
+        response = app_httpx_mocked.get(url, headers=sysadmin_headers)
+
+        assert response.data == b'cached'
+
+    def test_not_modified(self, app_httpx_mocked, sysadmin_headers):
+        url = url_for('superset_images.chart_image', chart_id=32, d=DIGEST)
+        headers = dict(sysadmin_headers, **{'If-None-Match': f'"32-{DIGEST}"'})
+        response = app_httpx_mocked.get(url, headers=headers, status=304)
+
+        assert response.status_code == 304
+
+    def test_without_digest_is_revalidated(self, app_httpx_mocked, sysadmin_headers):
+        url = url_for('superset_images.chart_image', chart_id=32)
+        response = app_httpx_mocked.get(url, headers=sysadmin_headers)
+
+        assert response.status_code == 200
+        assert 'immutable' not in response.headers['Cache-Control']
+
+    def test_variant(self, app_httpx_mocked, sysadmin_headers, cache_dir, large_png):
+        ThumbnailCache(str(cache_dir)).put(32, DIGEST, large_png)
+        url = url_for('superset_images.chart_image', chart_id=32, d=DIGEST, w=160, f='webp')
+        response = app_httpx_mocked.get(url, headers=sysadmin_headers)
+
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'image/webp'
+        assert response.headers['ETag'] == f'"32-{DIGEST}-w160.webp"'
+        assert len(response.data) < len(large_png)
+
+    def test_unsupported_variant(self, app_httpx_mocked, sysadmin_headers):
+        url = url_for('superset_images.chart_image', chart_id=32, d=DIGEST, w=1000)
+        response = app_httpx_mocked.get(url, headers=sysadmin_headers, status=400)
+
+        assert response.status_code == 400
+
+
+@pytest.fixture
+def pending_thumbnail(monkeypatch):
+    """ Superset answers 202 the first `pending` times the thumbnail is requested """
+    calls = {'pending': 1, 'count': 0}
+    ready = helpers.get_api__v1__chart__32__thumbnail__ce90a87d38fa6a2d8fa20232c1cba6f3
+
+    def thumbnail(request, params=None):
+        calls['count'] += 1
+        if calls['count'] <= calls['pending']:
+            return httpx.Response(202, json={'message': 'OK'})
+        return ready(request, params)
+
+    monkeypatch.setattr(helpers, 'get_api__v1__chart__32__thumbnail__ce90a87d38fa6a2d8fa20232c1cba6f3', thumbnail)
+    return calls
+
+
+@pytest.fixture
+def enqueued(monkeypatch):
+    """ Record the enqueued jobs instead of running them, forget the fetch states """
+    jobs = []
+    monkeypatch.setattr(toolkit, 'enqueue_job', lambda fn, args=None, **kwargs: jobs.append((fn, args)))
+    redis = thumbnail_jobs._redis()
+    for key in redis.scan_iter(f'{thumbnail_jobs.STATUS_PREFIX}*'):
+        redis.delete(key)
+    return jobs
+
+
+@pytest.mark.usefixtures('with_plugins')
+class TestPendingThumbnails:
+
+    @pytest.fixture
+    def sysadmin_headers(self, clean_db):
+        sysadmin = ckan_factories.SysadminWithToken()
+        return {'Authorization': sysadmin['token']}
+
+    @pytest.fixture(autouse=True)
+    def cache_dir(self, tmp_path, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'ckanext.superset.thumbnails.cache_dir', str(tmp_path))
+        return tmp_path
+
+    def test_placeholder_and_single_job(self, app_httpx_mocked, sysadmin_headers, pending_thumbnail, enqueued):
+        pending_thumbnail['pending'] = 2
+        url = url_for('superset_images.chart_image', chart_id=32, d=DIGEST)
+        for _ in range(2):
+            response = app_httpx_mocked.get(url, headers=sysadmin_headers)
+            assert response.status_code == 200
+            assert response.headers['X-Superset-Thumbnail'] == 'pending'
+            assert 'no-store' in response.headers['Cache-Control']
+
+        assert enqueued == [(thumbnail_jobs.fetch_thumbnail, [32, DIGEST])]
+        assert thumbnail_jobs.get_status(32, DIGEST) == 'pending'
+
+    def test_job_caches_the_thumbnail(self, app_httpx_mocked, pending_thumbnail, enqueued):
+        pending_thumbnail['pending'] = 2
+        thumbnail_jobs.enqueue_fetch(32, DIGEST)
+
+        assert thumbnail_jobs.fetch_thumbnail(32, DIGEST, delays=(0, 0)) == 'ready'
+        assert thumbnail_jobs.get_status(32, DIGEST) == 'ready'
+        assert pending_thumbnail['count'] == 3
+
+    def test_job_gives_up(self, app_httpx_mocked, pending_thumbnail, enqueued):
+        pending_thumbnail['pending'] = 10
+
+        assert thumbnail_jobs.fetch_thumbnail(32, DIGEST, delays=(0,)) == 'error'
+        assert thumbnail_jobs.get_status(32, DIGEST) == 'error'
+
+    def test_status_endpoint(self, app_httpx_mocked, sysadmin_headers, enqueued, cache_dir):
+        url = url_for('superset_images.chart_image_status', chart_id=32, d=DIGEST)
+        assert app_httpx_mocked.get(url, headers=sysadmin_headers).json['status'] == 'missing'
+
+        ThumbnailCache(str(cache_dir)).put(32, DIGEST, b'image')
+        assert app_httpx_mocked.get(url, headers=sysadmin_headers).json['status'] == 'ready'
+
+
+@pytest.fixture
+def catalog_thumbnails(monkeypatch):
+    """ Serve the thumbnails of all the charts in the chart list sample """
+    rows = json.loads(helpers._get_from_samples('chart.json'))['result']
+    requests = []
+
+    def thumbnail(request, params=None):
+        requests.append(request.url.path)
+        return httpx.Response(200, content=helpers.THUMBNAIL_PNG)
+
+    for row in rows:
+        name = 'get' + row['thumbnail_url'].rstrip('/').replace('/', '__')
+        monkeypatch.setattr(helpers, name, thumbnail, raising=False)
+    return requests
+
+
+@pytest.mark.usefixtures('with_plugins')
+class TestWarmThumbnails:
+
+    @pytest.fixture(autouse=True)
+    def cache_dir(self, tmp_path, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'ckanext.superset.thumbnails.cache_dir', str(tmp_path))
+        return tmp_path
+
+    def test_fetches_only_missing_thumbnails(self, async_httpx_mocked, catalog_thumbnails, enqueued):
+        stats = thumbnail_jobs.warm_thumbnails(max_concurrency=4)
+        assert stats['fetched'] == 20
+        assert stats['hits'] == 0
+        assert len(catalog_thumbnails) == 20
+
+        stats = thumbnail_jobs.warm_thumbnails()
+        assert stats['hits'] == 20
+        assert stats['fetched'] == 0
+        assert len(catalog_thumbnails) == 20
+        assert thumbnail_jobs.get_warm_stats() == stats
+
+    def test_force(self, async_httpx_mocked, catalog_thumbnails, enqueued):
+        thumbnail_jobs.warm_thumbnails()
+        stats = thumbnail_jobs.warm_thumbnails(force=True)
+
+        assert stats['fetched'] == 20
+        assert len(catalog_thumbnails) == 40
+
+    def test_failures_are_counted(self, async_httpx_mocked, enqueued):
+        stats = thumbnail_jobs.warm_thumbnails()
+
+        assert stats['failed'] == 20
+        assert os.listdir(thumbnail_jobs.get_cache().directory) == [thumbnail_jobs.WARM_STATS_FILE]